@@ -0,0 +1,71 @@
+# --- START OF FILE bench_client_setup.py ---
+"""
+Микробенчмарк затрат на подготовку клиентов Gemini перед вызовом модели.
+
+"before" повторяет прежнее поведение app.py/ocr_module.py: genai.configure,
+новый GenerativeModel с созданием клиента/канала и новый google.genai.Client
+на каждый запрос. "after" берет клиентов из общего реестра gemini_clients.
+Сетевые запросы не выполняются, ключ API может быть фиктивным.
+
+Запуск:
+    python benchmarks/bench_client_setup.py [--iterations 200]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import google.generativeai as genai  # noqa: E402
+from google.generativeai import client as genai_client_manager  # noqa: E402
+from google import genai as genai_module  # noqa: E402
+from gemini_clients import GeminiClientRegistry  # noqa: E402
+
+MODEL_NAME = "models/gemini-2.0-flash"
+
+
+def setup_before(api_key):
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(MODEL_NAME)
+    model._client = genai_client_manager.get_default_generative_client() # Как при первом generate_content
+    client = genai_module.Client(api_key=api_key)
+    return model, client
+
+
+def setup_after(registry):
+    return registry.generative_model(MODEL_NAME), registry.genai_client()
+
+
+def measure(func, iterations):
+    timings = []
+    for _ in range(iterations):
+        started_at = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started_at) * 1_000_000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+    api_key = os.getenv('GOOGLE_API_KEY') or 'benchmark-fake-key'
+
+    before = measure(lambda: setup_before(api_key), args.iterations)
+    registry = GeminiClientRegistry(api_key)
+    setup_after(registry) # Первое создание - один раз при старте
+    after = measure(lambda: setup_after(registry), args.iterations)
+    registry.shutdown()
+
+    print(f"{'mode':<8}{'median us':>12}{'mean us':>12}{'p95 us':>12}")
+    for name, timings in (('before', before), ('after', after)):
+        p95 = sorted(timings)[int(len(timings) * 0.95) - 1]
+        print(f"{name:<8}{statistics.median(timings):>12.1f}{statistics.mean(timings):>12.1f}{p95:>12.1f}")
+    print(f"speedup (median): {statistics.median(before) / max(statistics.median(after), 1e-9):.0f}x")
+
+
+if __name__ == '__main__':
+    main()
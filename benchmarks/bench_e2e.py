@@ -0,0 +1,284 @@
+# --- START OF FILE bench_e2e.py ---
+"""
+Сквозной нагрузочный бенчмарк /preprocess_receipt и /calculate_split.
+
+Поднимает локальную заглушку Gemini API (fake_gemini_server.py) с записанными
+ответами и заданной задержкой, запускает приложение через waitress или uvicorn (--server asgi)
+(ENV=prod) и параллельно загружает изображения из src/static/images.
+Печатает пропускную способность, p50/p95/p99 и разбивку по шагам (время вызовов
+модели по видам, измеренное заглушкой) и сохраняет результат в JSON для
+сравнения между коммитами.
+
+Запуск:
+    python benchmarks/bench_e2e.py --concurrency 16 --requests 64 --default-latency-ms 800 \\
+        --output bench_results/e2e.json [--compare bench_results/e2e-prev.json]
+"""
+
+import argparse
+import glob
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fake_gemini_server import FakeGeminiServer, parse_latency_spec
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+SRC_DIR = os.path.join(ROOT_DIR, 'src')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    """Перцентиль по ближайшему рангу."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies_ms, errors, wall_seconds, first_item_ms=None):
+    summary = {
+        "requests": len(latencies_ms) + errors,
+        "errors": errors,
+        "throughput_rps": round(len(latencies_ms) / wall_seconds, 2) if wall_seconds else 0.0,
+        "wall_seconds": round(wall_seconds, 3),
+        "p50_ms": round(percentile(latencies_ms, 0.50) or 0, 1),
+        "p95_ms": round(percentile(latencies_ms, 0.95) or 0, 1),
+        "p99_ms": round(percentile(latencies_ms, 0.99) or 0, 1),
+        "max_ms": round(max(latencies_ms), 1) if latencies_ms else 0.0,
+    }
+    if first_item_ms:
+        # Время до первой позиции в потоке (/preprocess_receipt_stream)
+        summary["first_item_p50_ms"] = round(percentile(first_item_ms, 0.50), 1)
+        summary["first_item_p95_ms"] = round(percentile(first_item_ms, 0.95), 1)
+    return summary
+
+
+def unique_image(image, index):
+    """Копия изображения с квадратом своего цвета в углу: и после нормализации (уменьшения) байты различаются."""
+    from PIL import Image
+    filename, data = image
+    with Image.open(io.BytesIO(data)) as source:
+        picture = source.convert('RGB')
+    side = max(8, max(picture.size) // 20)
+    picture.paste((index % 256, (index // 256) % 256, 128), (0, 0, side, side))
+    output = io.BytesIO()
+    picture.save(output, format='JPEG', quality=90)
+    return f"{os.path.splitext(filename)[0]}_{index}.jpg", output.getvalue()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def start_app(port, fake_endpoint, args):
+    env = dict(os.environ)
+    env.update({
+        "ENV": "prod",
+        "HOST": "127.0.0.1",
+        "PORT": str(port),
+        "GOOGLE_API_KEY": "benchmark-fake-key",
+        "GEMINI_API_ENDPOINT": fake_endpoint,
+        "LLM_BACKENDS": "gemini",
+        "RECEIPT_PIPELINE_MODE": args.mode,
+        "WAITRESS_THREADS": str(args.threads),
+    })
+    # Иллюстрации из static/images гладкие, проверка загрузок отклоняла бы их как размытые
+    env.setdefault("UPLOAD_MIN_SHARPNESS", "0")
+    # Свое общее хранилище на каждый запуск: результаты прошлых прогонов не должны попадать в замеры
+    env.setdefault("SHARED_STORE", "sqlite")
+    env.setdefault("SHARED_STORE_PATH", os.path.join(tempfile.mkdtemp(prefix="bench-shared-"), "store.sqlite3"))
+    if not args.cache:
+        env["RECEIPT_CACHE_MAX_BYTES"] = "0" # Каждая загрузка проходит весь конвейер
+        env["SHARED_STORE"] = "none"
+    log_file = open(os.devnull, 'w') if not args.app_log else open(args.app_log, 'w')
+    entry_point = 'asgi_app.py' if getattr(args, 'server', 'waitress') == 'asgi' else 'app.py'
+    process = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, entry_point)], cwd=SRC_DIR, env=env,
+                               stdout=log_file, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited with code {process.returncode} during startup.")
+        try:
+            if requests.get(f"{base_url}/robots.txt", timeout=1).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("App did not start within 60 seconds.")
+
+
+def run_phase(func, count, concurrency):
+    """func(index, started_at) -> (ok, payload, first_item_ms или None)."""
+    latencies, first_items, errors, payloads = [], [], 0, []
+
+    def one(index):
+        started_at = time.perf_counter()
+        try:
+            ok, payload, first_item_ms = func(index, started_at)
+        except requests.RequestException:
+            ok, payload, first_item_ms = False, None, None
+        return ok, (time.perf_counter() - started_at) * 1000, payload, first_item_ms
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for ok, latency_ms, payload, first_item_ms in executor.map(one, range(count)):
+            if ok:
+                latencies.append(latency_ms)
+                payloads.append(payload)
+                if first_item_ms is not None:
+                    first_items.append(first_item_ms)
+            else:
+                errors += 1
+    return summarize(latencies, errors, time.perf_counter() - started_at, first_items), payloads
+
+
+def read_event_stream(response, started_at):
+    """Читает SSE-ответ /preprocess_receipt_stream: (итоговый JSON или None, мс до первой позиции)."""
+    event, first_item_ms = None, None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith('event:'):
+            event = line[6:].strip()
+            if event == 'position' and first_item_ms is None:
+                first_item_ms = (time.perf_counter() - started_at) * 1000
+        elif line.startswith('data:') and event == 'done':
+            return json.loads(line[5:]), first_item_ms
+        elif line.startswith('data:') and event == 'error':
+            return None, first_item_ms
+    return None, first_item_ms
+
+
+def compare(current, previous_path):
+    with open(previous_path, 'r', encoding='utf-8') as f:
+        previous = json.load(f)
+    print(f"\ncompare with {previous_path} (commit {previous.get('commit')}):")
+    for endpoint, result in current["results"].items():
+        before = previous.get("results", {}).get(endpoint)
+        if not before:
+            continue
+        for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "first_item_p50_ms"):
+            if key not in result or key not in before:
+                continue
+            old, new = before.get(key) or 0, result.get(key) or 0
+            change = (new - old) / old if old else 0.0
+            print(f"  {endpoint:<27}{key:<20}{old:>10}{new:>10}{change:>+9.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=32, help='Загрузок /preprocess_receipt')
+    parser.add_argument('--split-requests', type=int, default=32, help='Запросов /calculate_split')
+    parser.add_argument('--threads', type=int, default=4, help='WAITRESS_THREADS приложения (4 - как у waitress)')
+    parser.add_argument('--mode', choices=('fused', 'multi'), default='fused')
+    parser.add_argument('--latency-ms', default='', help='Задержка заглушки по видам: ocr=1500,fused=2500,...')
+    parser.add_argument('--default-latency-ms', type=float, default=500.0)
+    parser.add_argument('--cache', action='store_true', help='Не отключать кэш результатов приложения')
+    parser.add_argument('--fake-rate-limit-rps', type=float, default=0, help='Квота заглушки: 429 сверх N запросов в секунду')
+    parser.add_argument('--stream', action='store_true', help='Загружать через /preprocess_receipt_stream (SSE)')
+    parser.add_argument('--images', nargs='*', help='Изображения (по умолчанию src/static/images/*)')
+    parser.add_argument('--server', choices=('waitress', 'asgi'), default='waitress',
+                        help='waitress - python src/app.py, asgi - python src/asgi_app.py (uvicorn)')
+    parser.add_argument('--unique-images', action='store_true',
+                        help='Делать каждую загрузку уникальной (без объединения одинаковых вызовов модели)')
+    parser.add_argument('--output', help='Куда сохранить результаты в JSON')
+    parser.add_argument('--compare', help='JSON предыдущего прогона для сравнения')
+    parser.add_argument('--app-log', help='Файл для вывода приложения')
+    args = parser.parse_args()
+
+    images = []
+    for path in args.images or sorted(glob.glob(os.path.join(SRC_DIR, 'static', 'images', '*'))):
+        with open(path, 'rb') as f:
+            images.append((os.path.basename(path), f.read()))
+
+    if args.unique_images:
+        images = [unique_image(images[index % len(images)], index) for index in range(args.requests)]
+
+    fake = FakeGeminiServer(latency_ms=parse_latency_spec(args.latency_ms), default_latency_ms=args.default_latency_ms,
+                            rate_limit_rps=args.fake_rate_limit_rps).start()
+    process, base_url = start_app(free_port(), fake.endpoint, args)
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+    try:
+        def upload(index, started_at):
+            filename, data = images[index % len(images)] if not args.unique_images else images[index]
+            if args.stream:
+                response = session.post(f"{base_url}/preprocess_receipt_stream", files={'receipt_image': (filename, data)},
+                                        timeout=300, stream=True)
+                payload, first_item_ms = read_event_stream(response, started_at) if response.status_code == 200 else (None, None)
+                return payload is not None, payload, first_item_ms
+            response = session.post(f"{base_url}/preprocess_receipt", files={'receipt_image': (filename, data)}, timeout=300)
+            return response.status_code == 200, response.json() if response.status_code == 200 else None, None
+
+        preprocess_result, payloads = run_phase(upload, args.requests, args.concurrency)
+        model_stages = fake.snapshot()
+
+        sample = next((p for p in payloads if p and p.get('positions_list')), None)
+        split_result = None
+        if sample and args.split_requests:
+            names = [item['name'] for item in sample['positions_list']]
+            split_payload = {
+                'extracted_text': sample['extracted_text'],
+                'positions_list': sample['positions_list'],
+                'total_amount': sample['total_amount_detected'],
+                'num_people': 2,
+                'tea_money': 100,
+                'item_assignments': {'Человек 1': names[::2], 'Человек 2': names[1::2]},
+            }
+
+            def split(index, started_at):
+                response = session.post(f"{base_url}/calculate_split", json=split_payload, timeout=300)
+                return response.status_code == 200, None, None
+
+            split_result, _ = run_phase(split, args.split_requests, args.concurrency)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+        fake.stop()
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "config": {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'app_log')},
+        "results": {"preprocess_receipt_stream" if args.stream else "preprocess_receipt": preprocess_result},
+        "model_stages": model_stages,
+    }
+    if split_result:
+        report["results"]["calculate_split"] = split_result
+
+    print(f"{'endpoint':<27}{'req':>6}{'err':>5}{'rps':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'1st item p50':>14}")
+    for endpoint, result in report["results"].items():
+        print(f"{endpoint:<27}{result['requests']:>6}{result['errors']:>5}{result['throughput_rps']:>8}"
+              f"{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}{result.get('first_item_p50_ms', '-'):>14}")
+    print("\nmodel calls by stage (measured at fake server):")
+    for kind, entry in sorted(model_stages.items()):
+        print(f"  {kind:<16}{entry['count']:>6} calls{entry['mean_ms']:>10} ms mean")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nresults written to {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# --- START OF FILE bench_image_preprocessing.py ---
+"""
+Офлайн-бенчмарк нормализации изображений перед OCR.
+
+Для каждого изображения из src/static/images (или переданных путей) показывает
+размер до/после, время нормализации, оценку числа токенов изображения в Gemini
+(плитки 768x768 по 258 токенов) и оценку времени загрузки при заданной скорости канала.
+
+Запуск:
+    python benchmarks/bench_image_preprocessing.py [--runs 5] [--uplink-mbps 10] [пути...]
+"""
+
+import argparse
+import glob
+import io
+import math
+import os
+import statistics
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+os.environ.setdefault("IMAGE_NORMALIZE", "True")
+
+from PIL import Image  # noqa: E402
+from image_preprocessing import normalize_image  # noqa: E402
+
+GEMINI_TILE_EDGE = 768
+GEMINI_TOKENS_PER_TILE = 258
+GEMINI_SMALL_IMAGE_EDGE = 384
+
+
+def estimate_image_tokens(width, height):
+    """Оценка токенов изображения по правилам тайлинга Gemini 2.0."""
+    if width <= GEMINI_SMALL_IMAGE_EDGE and height <= GEMINI_SMALL_IMAGE_EDGE:
+        return GEMINI_TOKENS_PER_TILE
+    return math.ceil(width / GEMINI_TILE_EDGE) * math.ceil(height / GEMINI_TILE_EDGE) * GEMINI_TOKENS_PER_TILE
+
+
+def image_size(image_bytes):
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        return image.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', help='Изображения (по умолчанию src/static/images/*)')
+    parser.add_argument('--runs', type=int, default=5, help='Повторов нормализации на изображение')
+    parser.add_argument('--uplink-mbps', type=float, default=10.0, help='Скорость канала для оценки времени загрузки')
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob(os.path.join(SRC_DIR, 'static', 'images', '*')))
+    bytes_per_ms = args.uplink_mbps * 1_000_000 / 8 / 1000
+
+    header = f"{'image':<24}{'bytes':>10}{'-> bytes':>10}{'saved':>8}{'tokens':>8}{'->':>6}{'norm ms':>9}{'upload ms':>11}{'->':>7}"
+    print(header)
+    print('-' * len(header))
+    total_before = total_after = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            original = f.read()
+        timings = []
+        for _ in range(args.runs):
+            started_at = time.perf_counter()
+            normalized, _ = normalize_image(original, os.path.basename(path))
+            timings.append((time.perf_counter() - started_at) * 1000)
+
+        tokens_before = estimate_image_tokens(*image_size(original))
+        tokens_after = estimate_image_tokens(*image_size(normalized))
+        saved = 1 - len(normalized) / len(original)
+        total_before += len(original)
+        total_after += len(normalized)
+        print(f"{os.path.basename(path)[:23]:<24}{len(original):>10}{len(normalized):>10}{saved:>8.0%}"
+              f"{tokens_before:>8}{tokens_after:>6}{statistics.median(timings):>9.1f}"
+              f"{len(original) / bytes_per_ms:>11.0f}{len(normalized) / bytes_per_ms:>7.0f}")
+
+    if total_before:
+        print('-' * len(header))
+        print(f"total: {total_before} -> {total_after} bytes ({1 - total_after / total_before:.0%} saved)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# --- START OF FILE bench_startup.py ---
+"""
+Бенчмарк холодного старта приложения.
+
+Для каждого режима STARTUP_WARMUP (lazy, background, eager) несколько раз
+запускает src/app.py под waitress (ENV=prod) с локальной заглушкой Gemini API
+(fake_gemini_server.py) и измеряет от запуска процесса:
+  * listen - первый ответ сервера (GET /robots.txt);
+  * page - первый ответ главной страницы;
+  * receipt - первый /preprocess_receipt (нужны SDK Gemini и клиенты).
+Также выводит этапы из /startup_stats приложения.
+
+С --imports печатает профиль импорта "import app" (python -X importtime):
+самые дорогие модули по суммарному времени и время по пакетам верхнего уровня.
+
+Запуск:
+    python benchmarks/bench_startup.py [--runs 3] [--modes lazy,background,eager]
+        [--imports [--top 25]] [--output bench_results/startup.json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+from bench_e2e import SRC_DIR, free_port
+from fake_gemini_server import FakeGeminiServer
+
+RECEIPT_IMAGE = os.path.join(SRC_DIR, 'static', 'images', 'example_contact.png')
+
+
+def app_env(port, fake_endpoint, mode):
+    env = dict(os.environ)
+    env.update({
+        "ENV": "prod",
+        "HOST": "127.0.0.1",
+        "PORT": str(port),
+        "GOOGLE_API_KEY": "benchmark-fake-key",
+        "GEMINI_API_ENDPOINT": fake_endpoint,
+        "LLM_BACKENDS": "gemini",
+        "STARTUP_WARMUP": mode,
+    })
+    return env
+
+
+def parse_importtime(stderr):
+    """Строки "import time: self | cumulative | module" -> [(модуль, self мкс, cumulative мкс, вложенность)]."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((name.strip(), int(self_us), int(cumulative_us), (len(name) - len(name.lstrip())) // 2))
+    return rows
+
+
+def import_profile(mode, top):
+    env = app_env(0, "http://127.0.0.1:1", mode)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=SRC_DIR, env=env,
+                            capture_output=True, text=True)
+    rows = parse_importtime(result.stderr)
+    total_us = sum(cumulative for _, _, cumulative, depth in rows if depth == 0)
+    print(f"\nImport profile of 'import app' (STARTUP_WARMUP={mode}): {total_us / 1000:.0f} ms")
+    print(f"{'module':<60}{'self ms':>10}{'cumulative ms':>15}")
+    for name, self_us, cumulative_us, depth in sorted(rows, key=lambda row: -row[2])[:top]:
+        print(f"{('  ' * depth + name)[:59]:<60}{self_us / 1000:>10.1f}{cumulative_us / 1000:>15.1f}")
+    packages = {}
+    for name, self_us, _, _ in rows:
+        packages[name.split(".")[0]] = packages.get(name.split(".")[0], 0) + self_us
+    print(f"\n{'package':<30}{'self ms':>10}")
+    for package, self_us in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f"{package:<30}{self_us / 1000:>10.1f}")
+    return {"total_ms": round(total_us / 1000, 1), "packages_ms": {package: round(us / 1000, 1) for package, us in packages.items()}}
+
+
+def wait_for(url, started_at, process, deadline_seconds=60):
+    while time.perf_counter() - started_at < deadline_seconds:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited with code {process.returncode} during startup.")
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return (time.perf_counter() - started_at) * 1000
+        except requests.RequestException:
+            time.sleep(0.005)
+    raise RuntimeError(f"{url} did not respond within {deadline_seconds} seconds.")
+
+
+def cold_start(mode, fake_endpoint, image_bytes):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    started_at = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, 'app.py')], cwd=SRC_DIR,
+                               env=app_env(port, fake_endpoint, mode), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        listen_ms = wait_for(f"{base_url}/robots.txt", started_at, process)
+        page_ms = wait_for(f"{base_url}/", started_at, process)
+        response = requests.post(f"{base_url}/preprocess_receipt", files={'receipt_image': ('receipt.png', image_bytes)}, timeout=120)
+        receipt_ms = (time.perf_counter() - started_at) * 1000
+        if response.status_code != 200:
+            raise RuntimeError(f"/preprocess_receipt answered {response.status_code}: {response.text[:200]}")
+        time.sleep(0.5) # Даем фоновому прогреву закончиться, чтобы увидеть его в /startup_stats
+        startup_stats = requests.get(f"{base_url}/startup_stats", timeout=5).json()
+    finally:
+        process.terminate()
+        process.wait()
+    return {"listen_ms": listen_ms, "page_ms": page_ms, "receipt_ms": receipt_ms, "startup_stats": startup_stats}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--modes', default='lazy,background,eager', help='Режимы STARTUP_WARMUP через запятую')
+    parser.add_argument('--imports', action='store_true', help='Напечатать профиль импорта app.py')
+    parser.add_argument('--top', type=int, default=25)
+    parser.add_argument('--output', help='Куда сохранить результаты в JSON')
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    with open(RECEIPT_IMAGE, 'rb') as f:
+        image_bytes = f.read()
+
+    results = {}
+    fake = FakeGeminiServer().start()
+    try:
+        print(f"{'mode':<12}{'listen ms':>12}{'page ms':>12}{'receipt ms':>12}   app marks (s)")
+        for mode in modes:
+            runs = [cold_start(mode, fake.endpoint, image_bytes) for _ in range(args.runs)]
+            summary = {key: round(statistics.median(run[key] for run in runs), 1) for key in ("listen_ms", "page_ms", "receipt_ms")}
+            summary["startup_stats"] = runs[-1]["startup_stats"]
+            results[mode] = summary
+            print(f"{mode:<12}{summary['listen_ms']:>12.0f}{summary['page_ms']:>12.0f}{summary['receipt_ms']:>12.0f}   "
+                  f"{summary['startup_stats']['marks']}")
+    finally:
+        fake.stop()
+
+    if args.imports:
+        results["imports"] = import_profile("lazy", args.top)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# --- START OF FILE bench_tiled_ocr.py ---
+"""
+Бенчмарк OCR длинных чеков: одним изображением или по полосам (src/tiled_ocr.py).
+
+Генерирует синтетические высокие чеки (по --lines строк), прогоняет их через
+normalize_image и одним вызовом OCR, и через TiledOcr (полосы параллельно и склейка),
+и сравнивает время и полноту строк (recall: доля строк чека, найденных в тексте;
+extra: лишние строки - повторы на стыках и обрезанные краем полосы).
+
+Модель по умолчанию - имитация (--model simulated): каждая строка чека помечена
+слева двоичным кодом номера, "модель" читает коды на присланном изображении и
+отвечает текстом найденных строк. Имитируются свойства, из-за которых длинный чек
+медленный и неполный: время ответа растет с числом строк ответа (токены вывода),
+строки ниже --legible-px пикселей не читаются, а после --attention-lines строк
+каждая следующая пропускается с вероятностью --drop-rate. Строка, обрезанная краем
+изображения, читается наполовину.
+
+С --model gemini вызывается настоящий OCR (LLM_BACKENDS, нужен GOOGLE_API_KEY).
+
+Запуск:
+    python benchmarks/bench_tiled_ocr.py [--lines 30,60,90,120] [--runs 3] [--model simulated|gemini]
+        [--base-ms 800] [--per-line-ms 60] [--output bench_results/tiled_ocr.json]
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+logging.disable(logging.WARNING) # Без построчных логов нормализации и склейки
+
+from PIL import Image, ImageDraw, ImageFont  # noqa: E402
+from image_preprocessing import normalize_image  # noqa: E402
+from tiled_ocr import TiledOcr  # noqa: E402
+
+FONT_PATHS = ("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "/Library/Fonts/Arial Unicode.ttf", "C:\\Windows\\Fonts\\arial.ttf")
+DISHES = ("Борщ", "Пельмени", "Салат Цезарь", "Шашлык из баранины", "Хачапури по-аджарски", "Чай черный", "Морс клюквенный",
+          "Лагман", "Плов", "Хинкали", "Сырники", "Уха", "Стейк рибай", "Паста карбонара", "Лимонад", "Эспрессо")
+# Код номера строки: стартовая клетка и CODE_BITS бит слева от текста
+CODE_BITS = 10
+CODE_CELL = 0.022 # ширина клетки - доля ширины чека
+CODE_LEFT = 0.02
+LINE_HEIGHT = 0.045 # высота строки - доля ширины чека
+RECALL_RATIO = 0.9 # строка найдена, если в тексте есть строка с таким сходством
+
+
+def receipt_lines(count, seed):
+    rng = random.Random(seed)
+    lines = []
+    for index in range(count):
+        dish, quantity, price = rng.choice(DISHES), rng.randint(1, 4), rng.randrange(150, 2000, 10)
+        lines.append(f"{index + 1:>3}. {dish} {quantity} x {price} = {quantity * price}")
+    return lines
+
+
+def render_receipt(lines, width=1000):
+    """Высокий чек: строка = код номера слева и текст; JPEG."""
+    line_height = int(width * LINE_HEIGHT)
+    cell = int(width * CODE_CELL)
+    margin = line_height * 2
+    image = Image.new("L", (width, margin * 2 + line_height * len(lines)), 255)
+    draw = ImageDraw.Draw(image)
+    font = next((ImageFont.truetype(path, int(line_height * 0.6)) for path in FONT_PATHS if os.path.exists(path)), None) \
+        or ImageFont.load_default()
+    code_left, text_left = int(width * CODE_LEFT), int(width * CODE_LEFT) + cell * (CODE_BITS + 2)
+    for index, text in enumerate(lines):
+        top = margin + index * line_height
+        bottom = top + int(line_height * 0.6)
+        bits = [1] + [(index + 1) >> bit & 1 for bit in reversed(range(CODE_BITS))]
+        for position, bit in enumerate(bits):
+            if bit:
+                draw.rectangle((code_left + position * cell, top, code_left + (position + 1) * cell - 1, bottom), fill=0)
+        draw.text((text_left, top), text, fill=0, font=font)
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+class SimulatedOcrModel:
+    """Имитация OCR-модели: читает коды строк с изображения (см. описание модуля)."""
+
+    def __init__(self, lines, base_ms, per_line_ms, legible_px, attention_lines, drop_rate, seed=0):
+        self.lines = lines
+        self.base_ms = base_ms
+        self.per_line_ms = per_line_ms
+        self.legible_px = legible_px
+        self.attention_lines = attention_lines
+        self.drop_rate = drop_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def decode(self, image_bytes):
+        """[(номер строки, высота кода в пикселях, обрезана ли краем)] сверху вниз."""
+        image = Image.open(io.BytesIO(image_bytes)).convert("L")
+        width, height = image.size
+        pixels = image.load()
+        cell = width * CODE_CELL
+        columns = [int(width * CODE_LEFT + (position + 0.5) * cell) for position in range(CODE_BITS + 1)]
+        bands, start = [], None
+        for y in range(height + 1):
+            dark = y < height and pixels[columns[0], y] < 128
+            if dark and start is None:
+                start = y
+            elif not dark and start is not None:
+                bands.append((start, y))
+                start = None
+        found = []
+        for top, bottom in bands:
+            rows = range(top + (bottom - top) // 4, max(top + (bottom - top) // 4 + 1, bottom - (bottom - top) // 4))
+            bits = [statistics.mean(pixels[x, y] for y in rows) < 128 for x in columns[1:]]
+            number = sum(bit << shift for shift, bit in enumerate(reversed(bits)))
+            if 1 <= number <= len(self.lines):
+                found.append((number - 1, bottom - top, top <= 1 or bottom >= height - 1))
+        return found
+
+    def ocr(self, image_bytes, filename):
+        output = []
+        for index, band_height, cut in self.decode(image_bytes):
+            if band_height < self.legible_px and not cut:
+                continue # Строка слишком мелкая для модели
+            with self._lock:
+                dropped = len(output) >= self.attention_lines and self._random.random() < self.drop_rate
+            if dropped:
+                continue
+            text = self.lines[index]
+            output.append(text[:len(text) // 2] if cut else text)
+        time.sleep((self.base_ms + self.per_line_ms * len(output)) / 1000)
+        with self._lock:
+            self.calls += 1
+        return "\n".join(output)
+
+
+def line_quality(lines, text):
+    """(recall, лишние строки): найденные строки чека и строки текста, не сопоставленные ни одной строке чека."""
+    output = [line.strip() for line in (text or "").splitlines() if line.strip()]
+    unused = list(output)
+    found = 0
+    for line in lines:
+        match = next((candidate for candidate in unused if SequenceMatcher(None, line, candidate).ratio() >= RECALL_RATIO), None)
+        if match is not None:
+            found += 1
+            unused.remove(match)
+    return found / len(lines), len(unused)
+
+
+def run_single(image_bytes, ocr):
+    started_at = time.perf_counter()
+    ocr_bytes, ocr_filename = normalize_image(image_bytes, "receipt.jpg")
+    text = ocr(ocr_bytes, ocr_filename)
+    return text, (time.perf_counter() - started_at) * 1000, 1
+
+
+def run_tiled(image_bytes, ocr, tiled_ocr):
+    started_at = time.perf_counter()
+    ocr_bytes, _ = normalize_image(image_bytes, "receipt.jpg")
+    tiles = tiled_ocr.split(image_bytes, "receipt.jpg", ocr_bytes)
+    if tiles is None:
+        return None, 0.0, 0
+    text = tiled_ocr.read(tiles, ocr)
+    return text, (time.perf_counter() - started_at) * 1000, len(tiles)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', default='30,60,90,120', help='Число строк синтетических чеков через запятую')
+    parser.add_argument('--runs', type=int, default=3, help='Чеков (с разными строками) на каждую длину')
+    parser.add_argument('--model', choices=('simulated', 'gemini'), default='simulated')
+    parser.add_argument('--base-ms', type=float, default=800, help='Имитация: задержка ответа без строк')
+    parser.add_argument('--per-line-ms', type=float, default=60, help='Имитация: время генерации одной строки ответа')
+    parser.add_argument('--legible-px', type=int, default=12, help='Имитация: строки ниже этой высоты не читаются')
+    parser.add_argument('--attention-lines', type=int, default=40, help='Имитация: после стольких строк ответа модель начинает пропускать')
+    parser.add_argument('--drop-rate', type=float, default=0.1, help='Имитация: вероятность пропуска строки после --attention-lines')
+    parser.add_argument('--min-aspect', type=float, default=2.5)
+    parser.add_argument('--tile-aspect', type=float, default=1.5)
+    parser.add_argument('--overlap', type=float, default=0.2)
+    parser.add_argument('--max-tiles', type=int, default=8)
+    parser.add_argument('--output', help='Куда сохранить результаты в JSON')
+    args = parser.parse_args()
+
+    executor = ThreadPoolExecutor(max_workers=args.max_tiles, thread_name_prefix="bench-tile")
+    tiled_ocr = TiledOcr(executor, min_aspect=args.min_aspect, tile_aspect=args.tile_aspect, overlap=args.overlap,
+                         max_tiles=args.max_tiles)
+    router = None
+    if args.model == 'gemini':
+        from llm_backends import create_router_from_env
+        router = create_router_from_env()
+
+    header = f"{'lines':>6}{'size':>12}{'tiles':>7}{'single ms':>11}{'tiled ms':>10}{'single recall':>15}{'tiled recall':>14}{'extra':>8}"
+    print(header)
+    print('-' * len(header))
+    results = []
+    for count in (int(value) for value in args.lines.split(',')):
+        rows = []
+        for run in range(args.runs):
+            lines = receipt_lines(count, seed=count * 1000 + run)
+            image_bytes = render_receipt(lines)
+            if router is None:
+                model = SimulatedOcrModel(lines, args.base_ms, args.per_line_ms, args.legible_px, args.attention_lines, args.drop_rate, seed=run)
+                ocr = model.ocr
+            else:
+                ocr = router.ocr
+            single_text, single_ms, _ = run_single(image_bytes, ocr)
+            tiled_text, tiled_ms, tiles = run_tiled(image_bytes, ocr, tiled_ocr)
+            if tiled_text is None: # Чек невысокий или OCR полосы не удался - читается целиком
+                tiled_text, tiled_ms = single_text, single_ms
+            single_recall, single_extra = line_quality(lines, single_text)
+            tiled_recall, tiled_extra = line_quality(lines, tiled_text)
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                size = f"{image.width}x{image.height}"
+            rows.append({"lines": count, "size": size, "tiles": tiles, "single_ms": single_ms, "tiled_ms": tiled_ms,
+                         "single_recall": single_recall, "tiled_recall": tiled_recall,
+                         "single_extra": single_extra, "tiled_extra": tiled_extra})
+        summary = {key: (statistics.mean(row[key] for row in rows) if key != "size" else rows[0][key]) for key in rows[0]}
+        results.append({"summary": summary, "runs": rows})
+        print(f"{count:>6}{summary['size']:>12}{summary['tiles']:>7.1f}{summary['single_ms']:>11.0f}{summary['tiled_ms']:>10.0f}"
+              f"{summary['single_recall']:>15.1%}{summary['tiled_recall']:>14.1%}{summary['tiled_extra']:>8.1f}")
+
+    print('-' * len(header))
+    print(json.dumps({key: value for key, value in tiled_ocr.stats().items() if key != "config"}))
+    executor.shutdown()
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"Saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
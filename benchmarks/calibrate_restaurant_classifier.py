@@ -0,0 +1,66 @@
+# --- START OF FILE calibrate_restaurant_classifier.py ---
+"""
+Подбор порогов локальной проверки "чек из ресторана?" (src/restaurant_classifier.py)
+на размеченных текстах: benchmarks/fixtures/restaurant_labels.json (магазины, аптеки,
+АЗС и заведения) и benchmarks/fixtures/ocr_texts.json.
+
+Печатает score каждого текста и решение при текущих порогах, а также пороги с запасом
+--margin: YES - выше самого высокого score не-ресторана, NO - ниже самого низкого score
+ресторана. Запас по умолчанию - вес одного признака заведения: один лишний или
+пропущенный признак не должен переворачивать локальное решение.
+
+Запуск:
+    python benchmarks/calibrate_restaurant_classifier.py [--margin 2.5] [--yes 3.5] [--no -1.5]
+Код возврата 1 - при заданных порогах хотя бы один текст решается локально неверно.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from restaurant_classifier import restaurant_score  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+LABEL_FILES = ('restaurant_labels.json', 'ocr_texts.json')
+
+
+def load_labelled_texts():
+    """[(имя, ресторан ли, текст)] из всех размеченных наборов."""
+    texts = []
+    for file_name in LABEL_FILES:
+        with open(os.path.join(FIXTURES_DIR, file_name), encoding='utf-8') as f:
+            texts.extend((fixture["name"], fixture["is_restaurant"], fixture["text"]) for fixture in json.load(f))
+    return texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--margin', type=float, default=2.5, help='Запас порогов от ближайшего текста другого класса')
+    parser.add_argument('--yes', type=float, default=3.5, help='Проверяемый порог RESTAURANT_CLASSIFIER_YES')
+    parser.add_argument('--no', type=float, default=-1.5, help='Проверяемый порог RESTAURANT_CLASSIFIER_NO')
+    args = parser.parse_args()
+
+    scored = [(name, label, restaurant_score(text)) for name, label, text in load_labelled_texts()]
+    wrong = 0
+    print(f"{'text':<28}{'label':>8}{'score':>8}  verdict")
+    for name, label, score in sorted(scored, key=lambda row: row[2]):
+        verdict = "yes" if score >= args.yes else "no" if score <= args.no else "llm"
+        mistake = (verdict == "yes" and not label) or (verdict == "no" and label)
+        wrong += mistake
+        print(f"{name:<28}{'rest' if label else 'other':>8}{score:>8.1f}  {verdict}{'  WRONG' if mistake else ''}")
+
+    max_other = max(score for _, label, score in scored if not label)
+    min_restaurant = min(score for _, label, score in scored if label)
+    local = sum(1 for _, _, score in scored if score >= args.yes or score <= args.no)
+    print(f"\nmax score of other receipts: {max_other}, min score of restaurants: {min_restaurant}")
+    print(f"suggested: RESTAURANT_CLASSIFIER_YES={max_other + args.margin} RESTAURANT_CLASSIFIER_NO={min_restaurant - args.margin}")
+    print(f"with --yes {args.yes} --no {args.no}: {local}/{len(scored)} decided locally, {wrong} wrong")
+    sys.exit(1 if wrong else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# --- START OF FILE check_text_compaction.py ---
+"""
+Оценка сжатия текста OCR (src/text_compaction.py) на наборе записанных текстов
+чеков benchmarks/fixtures/ocr_texts.json: токены до/после по этапам.
+
+Что после сжатия остаются все позиции, их цены и итог, проверяют тесты
+(tests/test_text_compaction.py, python -m pytest tests).
+
+С --live дополнительно вызывает Gemini (нужен GOOGLE_API_KEY) для исходного
+и сжатого текста и сравнивает извлеченные позиции, итог и проверку на ресторан.
+
+Запуск:
+    python benchmarks/check_text_compaction.py [--live] [--fixtures путь.json]
+Код возврата 1 - ответы Gemini разошлись (--live).
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+logging.disable(logging.INFO) # Без построчных логов сжатия
+
+import text_compaction  # noqa: E402
+from text_compaction import compact_for_stage, estimate_tokens  # noqa: E402
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'ocr_texts.json')
+STAGES = ("classify", "positions", "total", "split")
+
+
+def stage_tokens(fixture):
+    """Оценка токенов исходного и сжатого текста по этапам."""
+    raw_text = fixture["text"]
+    return {stage: (estimate_tokens(raw_text), estimate_tokens(compact_for_stage(stage, raw_text))) for stage in STAGES}
+
+
+def live_problems(fixture):
+    """Сравнивает ответы Gemini на исходный и сжатый текст."""
+    from gemini_backend import is_restaurant_check, get_positions, get_total_amount
+
+    def run():
+        positions = get_positions(fixture["text"])
+        return {
+            "is_restaurant": is_restaurant_check(fixture["text"]),
+            "positions": sorted((item.name, item.price) for item in positions.positions_list) if positions else None,
+            "total": get_total_amount(fixture["text"]),
+        }
+
+    text_compaction.TEXT_COMPACTION = False
+    raw_result = run()
+    text_compaction.TEXT_COMPACTION = True
+    compacted_result = run()
+    problems = [f"live {key}: {raw_result[key]} -> {compacted_result[key]}" for key in raw_result if raw_result[key] != compacted_result[key]]
+    if compacted_result["is_restaurant"] != fixture["is_restaurant"]:
+        problems.append(f"live is_restaurant: expected {fixture['is_restaurant']}, got {compacted_result['is_restaurant']}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures', default=FIXTURES_PATH)
+    parser.add_argument('--live', action='store_true', help='Сравнить ответы Gemini на исходный и сжатый текст')
+    args = parser.parse_args()
+
+    with open(args.fixtures, 'r', encoding='utf-8') as f:
+        fixtures = json.load(f)
+
+    failed = 0
+    totals = {stage: [0, 0] for stage in STAGES}
+    print(f"{'receipt':<22}" + "".join(f"{stage + ' tokens':>20}" for stage in STAGES) + ("  result" if args.live else ""))
+    for fixture in fixtures:
+        tokens = stage_tokens(fixture)
+        problems = live_problems(fixture) if args.live else []
+        for stage, (raw_tokens, compacted_tokens) in tokens.items():
+            totals[stage][0] += raw_tokens
+            totals[stage][1] += compacted_tokens
+        print(f"{fixture['name']:<22}" + "".join(f"{f'{raw} -> {compacted}':>20}" for raw, compacted in tokens.values())
+              + ("" if not args.live else "  ok" if not problems else "  FAIL"))
+        for problem in problems:
+            print(f"    {problem}")
+        failed += bool(problems)
+
+    print(f"{'total':<22}" + "".join(f"{f'-{100 * (1 - compacted / raw):.0f}%' if raw else '-':>20}" for raw, compacted in totals.values()))
+    if args.live:
+        print(f"{len(fixtures) - failed}/{len(fixtures)} receipts with the same Gemini answers after compaction")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
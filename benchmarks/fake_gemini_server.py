@@ -0,0 +1,231 @@
+# --- START OF FILE fake_gemini_server.py ---
+"""
+Локальная HTTP-заглушка Gemini API (generateContent) для бенчмарков.
+
+Определяет вид запроса по тексту промпта (OCR, fused, проверка, позиции, итог,
+деление), отвечает записанным ответом из fixtures/gemini_responses.json
+и добавляет настраиваемую задержку. Ведет счетчики вызовов и времени по видам.
+Поддерживает и потоковый streamGenerateContent (JSON-массив или alt=sse):
+ответ режется на части, первая приходит через first_chunk_fraction задержки.
+С rate_limit_rps имитирует квоту: сверх rate_limit_rps запросов за секунду - 429 RESOURCE_EXHAUSTED.
+
+Приложение направляется на заглушку переменными окружения:
+    GOOGLE_API_KEY=fake GEMINI_API_ENDPOINT=http://127.0.0.1:<port>
+
+Запуск отдельно:
+    python benchmarks/fake_gemini_server.py --port 8765 --latency-ms ocr=1500,fused=2500 --default-latency-ms 800
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'gemini_responses.json')
+
+STREAM_CHUNK_CHARS = 48
+
+# Уникальные фрагменты промптов из src/prompts.py -> вид запроса
+PROMPT_MARKERS = (
+    ("Выполни OCR для этого изображения и проанализируй", "fused"),
+    ("Выполни OCR для этого изображения", "ocr"),
+    ("Является ли этот текст чеком", "classify"),
+    ("Извлеки все позиции", "positions"),
+    ("Извлеки из этого чека итоговую сумму", "total"),
+    ("рассчитай варианты его разделения", "recommendations"),
+)
+
+
+def parse_latency_spec(spec):
+    """'ocr=1500,fused=2500' -> {'ocr': 1500.0, 'fused': 2500.0}"""
+    latencies = {}
+    for part in (spec or '').split(','):
+        if '=' in part:
+            kind, value = part.split('=', 1)
+            latencies[kind.strip()] = float(value)
+    return latencies
+
+
+def request_kind(body):
+    texts = []
+    for content in body.get('contents', []):
+        for part in content.get('parts', []):
+            if 'text' in part:
+                texts.append(part['text'])
+    joined = '\n'.join(texts)
+    for marker, kind in PROMPT_MARKERS:
+        if marker in joined:
+            return kind
+    return 'unknown'
+
+
+class FakeGeminiServer:
+    """HTTP-сервер с записанными ответами, задержкой и статистикой по видам запросов."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=None, default_latency_ms=0.0, jitter=0.1, fixtures_path=FIXTURES_PATH,
+                 first_chunk_fraction=0.3, rate_limit_rps=0):
+        with open(fixtures_path, 'r', encoding='utf-8') as f:
+            self.responses = json.load(f)
+        self.latency_ms = latency_ms or {}
+        self.default_latency_ms = default_latency_ms
+        self.jitter = jitter
+        self.first_chunk_fraction = first_chunk_fraction
+        self.rate_limit_rps = rate_limit_rps
+        self._window_started_at = 0.0
+        self._window_count = 0
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _delay_seconds(self, kind):
+        base = self.latency_ms.get(kind, self.default_latency_ms)
+        with self._lock:
+            factor = 1 + self._random.uniform(-self.jitter, self.jitter)
+        return max(base * factor, 0) / 1000.0
+
+    def _over_quota(self):
+        """Имитация квоты: счетчик запросов в текущем секундном окне."""
+        if not self.rate_limit_rps:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_started_at >= 1.0:
+                self._window_started_at, self._window_count = now, 0
+            self._window_count += 1
+            return self._window_count > self.rate_limit_rps
+
+    def _record(self, kind, elapsed_ms):
+        with self._lock:
+            entry = self.stats.setdefault(kind, {"count": 0, "total_ms": 0.0})
+            entry["count"] += 1
+            entry["total_ms"] += elapsed_ms
+
+    def snapshot(self):
+        with self._lock:
+            return {kind: dict(entry, mean_ms=round(entry["total_ms"] / entry["count"], 1)) for kind, entry in self.stats.items()}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                started_at = time.perf_counter()
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b'{}')
+                except json.JSONDecodeError:
+                    body = {}
+                kind = request_kind(body)
+                recorded = server.responses.get(kind)
+                streaming = ':streamGenerateContent' in self.path
+                if recorded is None or not (streaming or ':generateContent' in self.path):
+                    self._send(404, {"error": {"code": 404, "message": f"No recorded response for {kind} {self.path}"}})
+                    return
+                if server._over_quota():
+                    server._record("rate_limited", 0.0)
+                    self._send(429, {"error": {"code": 429, "message": "Resource has been exhausted (e.g. check quota).", "status": "RESOURCE_EXHAUSTED"}})
+                    return
+                delay = server._delay_seconds(kind)
+                if streaming:
+                    self._send_stream(recorded, delay, sse='alt=sse' in self.path)
+                else:
+                    time.sleep(delay)
+                    self._send(200, self._response_body(recorded["text"], recorded))
+                server._record(kind, (time.perf_counter() - started_at) * 1000)
+
+            @staticmethod
+            def _response_body(text, recorded=None):
+                body = {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}]}
+                if recorded is not None: # Последний (или единственный) ответ: причина остановки и токены
+                    body["candidates"][0]["finishReason"] = "STOP"
+                    body["usageMetadata"] = {
+                        "promptTokenCount": recorded.get("prompt_tokens", 0),
+                        "candidatesTokenCount": recorded.get("output_tokens", 0),
+                        "totalTokenCount": recorded.get("prompt_tokens", 0) + recorded.get("output_tokens", 0),
+                    }
+                return body
+
+            def _send_stream(self, recorded, delay, sse):
+                text = recorded["text"]
+                pieces = [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)] or [""]
+                first_delay = delay * server.first_chunk_fraction
+                next_delay = (delay - first_delay) / max(len(pieces) - 1, 1)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream' if sse else 'application/json; charset=utf-8')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                if not sse:
+                    self._write_chunk('[')
+                for index, piece in enumerate(pieces):
+                    time.sleep(first_delay if index == 0 else next_delay)
+                    body = json.dumps(self._response_body(piece, recorded if index == len(pieces) - 1 else None), ensure_ascii=False)
+                    if sse:
+                        self._write_chunk(f"data: {body}\r\n\r\n")
+                    else:
+                        self._write_chunk(("," if index else "") + body)
+                if not sse:
+                    self._write_chunk(']')
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+            def _write_chunk(self, text):
+                data = text.encode('utf-8')
+                self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+                self.wfile.flush()
+
+            def _send(self, status, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-gemini", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', default='', help='Задержка по видам: ocr=1500,fused=2500,...')
+    parser.add_argument('--default-latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.1, help='Относительный разброс задержки')
+    parser.add_argument('--rate-limit-rps', type=float, default=0, help='Имитация квоты: 429 сверх N запросов в секунду')
+    args = parser.parse_args()
+    server = FakeGeminiServer(args.host, args.port, parse_latency_spec(args.latency_ms), args.default_latency_ms, args.jitter,
+                              rate_limit_rps=args.rate_limit_rps)
+    print(f"Fake Gemini API on {server.endpoint}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,448 +1,554 @@
 # --- START OF FILE app.py ---
 
-from flask import Flask, request, render_template, jsonify, send_from_directory
+import time
+APP_LOAD_STARTED_AT = time.perf_counter() # Начало загрузки приложения (для /startup_stats)
+from flask import Flask, Request, Response, request, render_template, jsonify, send_from_directory
 from flask_sitemap import Sitemap
-import os,re
-import google.generativeai as genai
-from google import genai as genai_module
-from ocr_module import process_image_with_gemini
-from pydantic import BaseModel, ValidationError  
-from typing import Dict, List, Optional
-import logging
-import json # Для обработки данных от фронтенда
+import os,io
 # run_prod.py
 from dotenv import load_dotenv
-from waitress import serve
+# Загрузка переменных окружения из .env (до импорта модулей, читающих настройки)
+load_dotenv()
+from models import PositionItem, Positions, Recommendation, ReceiptExtraction
+from split_engine import compute_split
+from gemini_clients import shutdown_registry
+from llm_backends import create_router_from_env, clean_position_names, parse_total_amount
+from prompts import strip_json_fences
+from streaming_json import JsonStreamScanner
+from receipt_cache import image_cache_key, create_receipt_cache_from_env
+from near_duplicates import create_near_duplicate_index_from_env, NearDuplicateMatch
+from tiled_ocr import create_tiled_ocr_from_env
+from job_queue import create_job_queue_from_env
+from image_preprocessing import normalize_image
+from receipt_parser import create_rule_parser_from_env
+from restaurant_classifier import create_restaurant_classifier_from_env
+from receipt_sessions import create_session_store_from_env, create_split_memo_from_env, merge_assignments, SplitMemo
+from shared_store import (create_shared_store_from_env, encode_receipt_result, decode_receipt_result, encode_record, decode_record,
+                          pack_recommendation, unpack_recommendation)
+from gemini_governor import get_governor
+from static_assets import create_static_pipeline_from_env, create_page_cache_from_env
+from upload_admission import create_upload_admission_from_env, UploadRejected
+from werkzeug.exceptions import RequestEntityTooLarge
+from metrics import observe_stage, record_upload_bytes, record_cache_lookup, render_metrics
+from pydantic import ValidationError
+from typing import Dict, Iterator, List, Optional, Tuple
+import logging
+import json # Для обработки данных от фронтенда
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from startup import create_startup_profile_from_env
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class InMemoryUploadRequest(Request):
+    """Запрос, который держит загруженные файлы в памяти (без временных файлов Werkzeug)."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
 app = Flask(__name__)
-# Убедитесь, что папка uploads существует
-UPLOAD_FOLDER = 'uploads'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.request_class = InMemoryUploadRequest
 # Настройки для Flask-Sitemap
 app.config['SITEMAP_INCLUDE_RULES_WITHOUT_PARAMS'] = True # Включать правила без параметров (например, '/')
 app.config['SITEMAP_URL_SCHEME'] = 'https' # Используйте 'https', если ваш сайт работает по HTTPS
 
 sitemap = Sitemap(app=app) # <<< Инициализация Sitemap
 
-# --- Упрощенные Pydantic Модели ---
-# --- Новая Pydantic модель для проверки ---
-class RestaurantCheckResult(BaseModel):
-    is_restaurant: bool
-
-class PositionItem(BaseModel):
-    name: str
-    price: int # <--- Изменено на int
-
-class Positions(BaseModel):
-    positions_list: List[PositionItem]
-
-class PersonShare(BaseModel):
-    equally: int
-    who_more_eat_then_more_pay: int
-    who_more_cost_then_more_pay: int
-    proportional_division_by_the_cost_of_orders: int
+# LLM-бэкенды (LLM_BACKENDS) и маршрутизатор между ними; клиенты Gemini закрываются при выходе
+llm_router = create_router_from_env()
+atexit.register(shutdown_registry)
+
+# Режим обработки чека: "fused" - один мультимодальный вызов модели, "multi" - прежние четыре вызова
+RECEIPT_PIPELINE_MODE = os.getenv("RECEIPT_PIPELINE_MODE", "fused").lower()
+if RECEIPT_PIPELINE_MODE not in ("fused", "multi"):
+    logger.warning(f"Unknown RECEIPT_PIPELINE_MODE '{RECEIPT_PIPELINE_MODE}', using 'fused'.")
+    RECEIPT_PIPELINE_MODE = "fused"
+# Кэш результатов обработки чеков по хэшу изображения (RECEIPT_CACHE_*)
+receipt_cache = create_receipt_cache_from_env()
+# Общее для процессов (воркеров waitress) хранилище результатов чеков, сессий и делений (SHARED_STORE_*)
+shared_store = create_shared_store_from_env()
+SHARED_STORE_TTL = int(os.getenv("SHARED_STORE_TTL", receipt_cache.ttl_seconds))
+# Почти одинаковые фото того же чека (другой ракурс, пересъемка) по перцептивному хэшу (NEAR_DUPLICATE_*)
+near_duplicates = create_near_duplicate_index_from_env()
+# Длинные чеки: OCR перекрывающихся полос высокого фото параллельно (TILED_OCR_*)
+TILED_OCR_POOL_SIZE = int(os.getenv("TILED_OCR_POOL_SIZE", 8))
+tile_ocr_executor = ThreadPoolExecutor(max_workers=TILED_OCR_POOL_SIZE, thread_name_prefix="ocr-tile")
+tiled_ocr = create_tiled_ocr_from_env(tile_ocr_executor)
+# Параллельный (спекулятивный) запуск шагов после OCR в режиме "multi"
+POSTOCR_SPECULATIVE = os.getenv("POSTOCR_SPECULATIVE", "True").lower() == "true"
+POSTOCR_POOL_SIZE = int(os.getenv("POSTOCR_POOL_SIZE", 12))
+post_ocr_executor = ThreadPoolExecutor(max_workers=POSTOCR_POOL_SIZE, thread_name_prefix="post-ocr")
+# Локальный разбор итога и позиций правилами; при низкой уверенности - вызовы LLM (RULE_PARSER_*)
+rule_parser = create_rule_parser_from_env()
+# Локальная проверка "чек из ресторана?"; LLM - только для неуверенных случаев (RESTAURANT_CLASSIFIER_*)
+restaurant_classifier = create_restaurant_classifier_from_env(audit_executor=post_ocr_executor)
+# Запасной расчет деления через LLM, если позиции не удалось сопоставить локально
+SPLIT_LLM_FALLBACK = os.getenv("SPLIT_LLM_FALLBACK", "False").lower() == "true"
+# Пакетная обработка нескольких чеков: общий для всех запросов пул и лимит изображений в запросе
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", 10))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix="batch")
+# Проверка загрузок до вызовов модели (UPLOAD_*): размер, формат по сигнатуре, размеры кадра, пустые и размытые фото
+upload_admission = create_upload_admission_from_env()
+# Лимит тела запроса: больший Content-Length отклоняется (413) до чтения файлов; по умолчанию - пакет из BATCH_MAX_IMAGES файлов
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", upload_admission.max_bytes * BATCH_MAX_IMAGES + 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_REQUEST_BYTES
+# Сессии чеков (RECEIPT_SESSION_*): /calculate_split получает receipt_id вместо всего чека
+receipt_sessions = create_session_store_from_env(shared_store)
+# Готовые расчеты деления для одинаковых входных данных (SPLIT_MEMO_SIZE)
+split_memo = create_split_memo_from_env()
+# Максимальное время long-poll GET /jobs/<job_id>?wait=N (поток waitress занят на это время)
+JOB_MAX_WAIT = float(os.getenv("JOB_MAX_WAIT", 10))
+
+# Статика: URL с хэшем содержимого, gzip/brotli и WebP заранее, долгий кэш в браузере (STATIC_ASSETS)
+static_assets = create_static_pipeline_from_env(os.path.join(app.root_path, 'static'))
+if static_assets is not None:
+    app.view_functions['static'] = static_assets.serve
+
+    @app.url_defaults
+    def fingerprint_static_urls(endpoint, values):
+        # url_for('static', filename='style.css') -> /static/style.<хэш>.css
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = static_assets.fingerprinted(values['filename'])
+# Страницы без данных запроса рендерятся один раз и отдаются из памяти (PAGE_CACHE)
+page_cache = create_page_cache_from_env()
+
+# Pydantic модели вынесены в models.py, чтобы ими могли пользоваться другие модули
 
-class PersonShareItem(BaseModel):
-    name: str
-    shares: PersonShare
+# --- Маршруты Flask ---
 
-class Recommendation(BaseModel):
-    peoples_list: List[PersonShareItem]
+@app.route('/favicon.ico')
+def favicon():
+    # Убедитесь, что favicon.png находится в static/
+    return send_from_directory(os.path.join(app.root_path, 'static'),
+                               'favicon.png', mimetype='image/png')
 
+@app.route('/')
+def index():
+    return page_cache.serve('index', lambda: render_template('index.html'))
 
+@app.route('/share')
+def share():
+    # Эта страница может больше не понадобиться в старом виде,
+    # но оставим маршрут, если она используется для чего-то еще.
+    return page_cache.serve('share', lambda: render_template('share.html'))
 
+@app.route('/contacts')
+def contacts():
+    return page_cache.serve('contacts', lambda: render_template('contacts.html'))
 
-# --- Настройка Gemini (без изменений) ---
-def get_gemini_model(model_name="models/gemini-2.0-flash"):
-    # ... (код функции без изменений) ...
-    api_key = os.getenv('GOOGLE_API_KEY')
-    if not api_key:
-        logger.error("GOOGLE_API_KEY environment variable not set.")
-        raise ValueError("API key not configured.")
-    genai.configure(api_key=api_key)
-    return genai.GenerativeModel(model_name)
+@app.route('/privacy')
+def privacy():
+    return page_cache.serve('privacy', lambda: render_template('privacy.html'))
 
-# --- Новая функция для проверки ---
-def is_restaurant_check(extracted_text: str) -> Optional[bool]:
+# --- Конвейеры обработки чека ---
+def run_multi_call_pipeline(image_bytes: bytes, filename: str, extracted_text: Optional[str] = None) -> Tuple[Dict, int]:
     """
-    Проверяет, является ли текст чеком из ресторана, используя Gemini.
+    Исходный конвейер: OCR, затем отдельные вызовы модели для проверки, позиций и итога.
+    extracted_text - уже распознанный текст (например, при проверке похожего чека), OCR не повторяется.
     """
+    # Шаг 1: OCR
+    if extracted_text is None:
+        extracted_text = llm_router.ocr(image_bytes, filename)
+    if extracted_text is None:
+         logger.error("OCR processing failed.")
+         return {'error': 'Failed to process image with OCR'}, 500
     if not extracted_text:
-        logger.warning("No extracted text provided to is_restaurant_check.")
-        return False # Считаем, что пустой текст - не чек
-
-    prompt = f"""
-Проанализируй следующий текст:
---- ТЕКСТ ---
-{extracted_text}
---- КОНЕЦ ТЕКСТА --- """ + """
-
+         logger.warning("OCR resulted in empty text.")
+         # Возвращаем пустые данные, но с успехом
+         return {"positions_list": [], "is_restaurant": False, "extracted_text": "", "total_amount_detected": 0}, 200
+
+    logger.info(f"OCR extracted text (first 100 chars): {extracted_text[:100]}...")
+
+    if POSTOCR_SPECULATIVE:
+        return run_post_ocr_speculative(extracted_text)
+
+    # Шаг 2: Проверка на ресторан (локально, неуверенные случаи - через LLM)
+    is_restaurant_flag = restaurant_classifier.classify(extracted_text, llm_router.classify)
+
+    if is_restaurant_flag is None:
+        logger.error("Failed to determine if image is a restaurant check.")
+        is_restaurant_flag = False # Считаем не рестораном при ошибке
+    elif is_restaurant_flag is False:
+        logger.info("Image determined not to be a restaurant check.")
+        # Возвращаем результат с флагом False и пустыми данными
+        return {"positions_list": [], "is_restaurant": False, "extracted_text": extracted_text, "total_amount_detected": 0}, 200
+
+    # --- Шаги 3-4: позиции и итог сначала правилами; если сумма позиций не сошлась с итогом - через LLM ---
+    parsed_receipt = rule_parser.parse(extracted_text)
+    if parsed_receipt is not None:
+        positions_data, total_amount = parsed_receipt.positions, parsed_receipt.total_amount
+    else:
+        # --- Шаг 3: Если это ресторан, извлекаем ПОЗИЦИИ ---
+        logger.info("Check identified as restaurant, proceeding to get positions.")
+        positions_data = llm_router.extract_positions(extracted_text)
 
-Является ли этот текст чеком из ресторана, кафе, бара или похожего заведения общепита?
-Верни ответ СТРОГО в формате JSON с одним булевым полем 'is_restaurant'.
-Пример: {{ "is_restaurant": true }} или {{ "is_restaurant": false }}
-Не добавляй никаких других пояснений или текста вне JSON.
-"""
+        # --- Шаг 4: Извлекаем ИТОГОВУЮ СУММУ ОТДЕЛЬНО ---
+        logger.info("Proceeding to get total amount.")
+        total_amount = llm_router.extract_total(extracted_text) # Возвращает int, 0 при ошибке
+
+    # --- Шаг 5: Собираем финальный ответ ---
+    response_data = build_restaurant_response(extracted_text, positions_data, total_amount)
+
+    logger.info(f"Preprocess successful. is_restaurant=True, items={len(response_data['positions_list'])}, total_amount={total_amount}")
+    return response_data, 200
+
+def build_restaurant_response(extracted_text: str, positions_data: Optional[Positions], total_amount: int) -> Dict:
+    """Собирает ответ /preprocess_receipt для чека из ресторана."""
+    if positions_data is None:
+        logger.error("Failed to get positions data from LLM backend.")
+        positions_data = Positions(positions_list=[]) # Возвращаем пустой список при ошибке
+    response_data = positions_data.dict() # Получаем {'positions_list': [...]}
+    response_data['is_restaurant'] = True
+    response_data['extracted_text'] = extracted_text
+    response_data['total_amount_detected'] = total_amount # Добавляем сумму
+    return response_data
+
+def run_post_ocr_speculative(extracted_text: str) -> Tuple[Dict, int]:
+    """
+    Запускает проверку на ресторан, извлечение позиций и итога параллельно
+    в общем пуле потоков. Если чек не из ресторана, результаты позиций и итога
+    отбрасываются (еще не начатые задачи отменяются). Если позиции и итог
+    разобраны правилами, вызовы модели для них не делаются; если локальный
+    классификатор уверен, не делается и вызов проверки на ресторан.
+    """
+    is_restaurant_flag = restaurant_classifier.local_verdict(extracted_text, llm_router.classify)
+    if is_restaurant_flag is False:
+        return {"positions_list": [], "is_restaurant": False, "extracted_text": extracted_text, "total_amount_detected": 0}, 200
+    parsed_receipt = rule_parser.parse(extracted_text)
+    restaurant_future = positions_future = total_future = None
+    if is_restaurant_flag is None:
+        restaurant_future = post_ocr_executor.submit(restaurant_classifier.llm_verdict, extracted_text, llm_router.classify)
+    if parsed_receipt is None:
+        positions_future = post_ocr_executor.submit(llm_router.extract_positions, extracted_text)
+        total_future = post_ocr_executor.submit(llm_router.extract_total, extracted_text)
+
+    if restaurant_future is not None:
+        is_restaurant_flag = restaurant_future.result()
+    if is_restaurant_flag is False:
+        if parsed_receipt is None:
+            positions_future.cancel()
+            total_future.cancel()
+        logger.info("Image determined not to be a restaurant check, speculative results discarded.")
+        return {"positions_list": [], "is_restaurant": False, "extracted_text": extracted_text, "total_amount_detected": 0}, 200
+    if is_restaurant_flag is None:
+        logger.error("Failed to determine if image is a restaurant check.")
+
+    if parsed_receipt is not None:
+        positions_data, total_amount = parsed_receipt.positions, parsed_receipt.total_amount
+    else:
+        positions_data, total_amount = positions_future.result(), total_future.result()
+    response_data = build_restaurant_response(extracted_text, positions_data, total_amount)
+    logger.info(f"Preprocess successful (speculative). is_restaurant=True, items={len(response_data['positions_list'])}, total_amount={response_data['total_amount_detected']}")
+    return response_data, 200
+
+def run_fused_pipeline(image_bytes: bytes, filename: str) -> Tuple[Dict, int]:
+    """Объединенный конвейер: OCR, проверка, позиции и итог за один вызов модели."""
+    return build_fused_response(llm_router.extract_receipt(image_bytes, filename))
+
+def build_fused_response(extraction: Optional[ReceiptExtraction]) -> Tuple[Dict, int]:
+    """Собирает ответ /preprocess_receipt из результата объединенного вызова."""
+    if extraction is None:
+        logger.error("Fused extraction failed.")
+        return {'error': 'Failed to process image with OCR'}, 500
+    if not extraction.extracted_text:
+        logger.warning("Fused extraction resulted in empty text.")
+        return {"positions_list": [], "is_restaurant": False, "extracted_text": "", "total_amount_detected": 0}, 200
+    if not extraction.is_restaurant:
+        logger.info("Image determined not to be a restaurant check.")
+        return {"positions_list": [], "is_restaurant": False, "extracted_text": extraction.extracted_text, "total_amount_detected": 0}, 200
+
+    positions_data = clean_position_names(Positions(positions_list=extraction.positions_list))
+    total_amount = max(extraction.total_amount, 0)
+
+    response_data = positions_data.dict()
+    response_data['is_restaurant'] = True
+    response_data['extracted_text'] = extraction.extracted_text
+    response_data['total_amount_detected'] = total_amount
+
+    logger.info(f"Preprocess successful (fused). is_restaurant=True, items={len(response_data['positions_list'])}, total_amount={total_amount}")
+    return response_data, 200
+
+# --- Потоковая обработка чека (события по мере готовности шагов) ---
+def sse_event(event: str, data: Dict) -> str:
+    """Одно событие в формате server-sent events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def streamed_position(raw_item: Dict) -> Optional[Dict]:
+    """Проверяет и очищает позицию, разобранную из потока ответа модели."""
     try:
-        model = get_gemini_model() # Используем flash по умолчанию
-        response = model.generate_content(
-            prompt,
-            generation_config=genai.types.GenerationConfig(
-                response_mime_type="application/json",
-                response_schema=RestaurantCheckResult # Используем новую простую модель
-            )
-        )
-
-        # Парсинг и валидация
-        if hasattr(response, 'candidates') and response.candidates and hasattr(response.candidates[0], 'content') and hasattr(response.candidates[0].content, 'parts') and response.candidates[0].content.parts:
-             json_text = response.candidates[0].content.parts[0].text
-             logger.info(f"Received JSON from Gemini for restaurant check: {json_text}")
-             parsed_data = json.loads(json_text)
-             try:
-                 check_result = RestaurantCheckResult(**parsed_data)
-                 logger.info(f"Restaurant check result: {check_result.is_restaurant}")
-                 return check_result.is_restaurant
-             except ValidationError as e:
-                 logger.error(f"Pydantic validation failed for restaurant check: {e}. JSON: {json_text}")
-                 return None # Ошибка валидации
-        elif response.text: # Fallback
-             try:
-                 logger.info(f"Trying to parse restaurant check from response.text: {response.text}")
-                 parsed_data = json.loads(response.text)
-                 check_result = RestaurantCheckResult(**parsed_data)
-                 logger.info(f"Restaurant check result from response.text: {check_result.is_restaurant}")
-                 return check_result.is_restaurant
-             except Exception as parse_err:
-                 logger.error(f"Failed to parse JSON restaurant check from response.text: {parse_err}")
-                 return None
-        else:
-             logger.error("No usable content found in Gemini response for restaurant check.")
-             return None
-
-    except Exception as e:
-        logger.error(f"Error during Gemini API call for restaurant check: {e}", exc_info=True)
+        item = PositionItem(**raw_item)
+    except (ValidationError, TypeError):
+        logger.debug(f"Skipping invalid streamed position: {raw_item}")
         return None
+    return clean_position_names(Positions(positions_list=[item])).positions_list[0].dict()
 
-# --- Обновленная функция get_positions (только позиции) ---
-def get_positions(extracted_text: str) -> Optional[Positions]:
-    if not extracted_text:
-        logger.warning("No extracted text provided to get_positions.")
-        return Positions(positions_list=[]) # Возвращаем пустой список
-
-    # --- ИЗМЕНЕНО: Упрощенный промпт ---
-    prompt = f"""
-Анализируй следующий текст, извлеченный из изображения чека:
---- ТЕКСТ ЧЕКА ---
-{extracted_text}
---- КОНЕЦ ТЕКСТА ЧЕКА ---""" + """
-
-Твоя задача:
-1.  Извлеки все позиции (блюда, напитки) с их ценами. Игнорируй строки типа "Итого", "Скидка", "Обслуживание", "НДС", "Официант" и т.п. Формируй результат как СПИСОК объектов в поле 'positions_list'. Каждый объект в списке должен содержать два поля: 'name' (строка, название позиции) и 'price' (**целое число int**, округленная цена в рублях). Если позиций нет, верни ПУСТОЙ СПИСОК `[]` для 'positions_list'. Старайся нормализовать названия.
-2.  Верни результат СТРОГО в формате JSON, соответствующем структуре: {{ "positions_list": [{{ "name": "...", "price": ЦЕЛОЕ_ЧИСЛО }}] }}. **Только поле 'positions_list' должно присутствовать в ответе.** Не добавляй никаких других пояснений или текста вне JSON.
-3.  Любые кавычки (одинарные и двойные) и другие символы, которые могут вызвать ошибки типа Invalid or unexpected token в JavaScript, не должны присутствовать в твоем ответе, замени на что-то другое или удали.
-"""
+def parse_streamed_model(text: str, model_class):
+    """Валидирует полный текст потокового ответа как pydantic-модель (None при ошибке)."""
+    cleaned_json_text = strip_json_fences(text)
     try:
-        model = get_gemini_model()
-        response = model.generate_content(
-            prompt,
-            generation_config=genai.types.GenerationConfig(
-                response_mime_type="application/json",
-                # response_schema=Positions # Можно использовать Pydantic модель
-            )
-        )
-
-        positions_obj: Optional[Positions] = None
-
-        # --- Логика парсинга ответа (остается похожей, но ожидает только positions_list) ---
-        if hasattr(response, 'text') and response.text:
-             json_text = response.text
-             logger.info(f"Received JSON from Gemini for positions: {json_text[:500]}...")
-             # Удаляем возможные артефакты ```json ... ```
-             cleaned_json_text = re.sub(r'^```json\s*|\s*```$', '', json_text, flags=re.MULTILINE | re.DOTALL).strip()
-             try:
-                 parsed_data = json.loads(cleaned_json_text)
-                 # Валидируем структуру с помощью Pydantic
-                 positions_obj = Positions(**parsed_data)
-                 logger.info(f"Successfully parsed positions: {len(positions_obj.positions_list)} items")
-
-             except (json.JSONDecodeError, ValidationError) as e:
-                 logger.error(f"Pydantic validation or JSON parsing failed for positions: {e}. JSON: {cleaned_json_text}")
-                 return None # Ошибка валидации или парсинга, выходим
-        else:
-             logger.error("No usable content found in Gemini response for positions.")
-             return None # Нет данных от модели, выходим
-
-        # --- Очистка имен позиций (остается без изменений) ---
-        if positions_obj and isinstance(positions_obj.positions_list, list):
-            cleaned_count = 0
-            for item in positions_obj.positions_list:
-                if isinstance(item.name, str):
-                    original_name = item.name
-                    item.name = re.sub(r'[&"\'<>`]', '', item.name) # Удаляем небезопасные символы
-                    if item.name != original_name:
-                        cleaned_count += 1
-                        logger.debug(f"Cleaned item name: '{original_name}' -> '{item.name}'")
-            if cleaned_count > 0:
-                logger.info(f"Cleaned names for {cleaned_count} position(s).")
-        elif positions_obj and not isinstance(positions_obj.positions_list, list):
-             logger.warning("Parsed 'positions_list' is not a list after validation. Setting to empty list.")
-             positions_obj.positions_list = []
-
-        return positions_obj
-
-    except Exception as e:
-        logger.error(f"Error during Gemini API call or processing for positions: {e}", exc_info=True)
+        return model_class(**json.loads(cleaned_json_text))
+    except (json.JSONDecodeError, ValidationError, TypeError) as e:
+        logger.error(f"Pydantic validation or JSON parsing failed for streamed {model_class.__name__}: {e}. JSON: {cleaned_json_text[:500]}")
         return None
 
-# --- Новая функция get_total_amount (как ты предложил) ---
-def get_total_amount(extracted_text: str) -> int:
-    """Извлекает итоговую сумму из текста чека как целое число."""
-    if not extracted_text:
-        logger.warning("No extracted text provided to get_total_amount.")
-        return 0
-
-    prompt = f"""
-Тебе дан текст чека:
----Начало текста чека---
-{extracted_text}
----Конец текста чека---
-Извлеки из этого чека итоговую сумму (обычно находится в поле "Итого", "ИТОГ", "ВСЕГО К ОПЛАТЕ" или похожем).
-Ответ выдай СТРОГО в формате JSON с одним полем "total_amount", значение которого - ЦЕЛОЕ ЧИСЛО (int). Если в чеке указана десятичная часть суммы, округли до ближайшего целого числа рублей. Если итоговая сумма не найдена, верни 0.
-Пример ответа: {{ "total_amount": 1234 }}
-Не давай никаких пояснений, только JSON."""
-
-    try:
-        model = get_gemini_model()
-        response = model.generate_content(
-            prompt,
-            generation_config=genai.types.GenerationConfig(
-                response_mime_type="application/json",
-                # response_schema={"type": "object", "properties": {"total_amount": {"type": "integer"}}} # Можно указать схему
-            ),
-        )
-
-        # Парсинг ответа
-        if hasattr(response, 'text') and response.text:
-            json_text = response.text
-            logger.info(f"Received JSON from Gemini for total amount: {json_text}")
-            # Удаляем возможные артефакты ```json ... ```
-            cleaned_json_text = re.sub(r'^```json\s*|\s*```$', '', json_text, flags=re.MULTILINE | re.DOTALL).strip()
-            try:
-                parsed_data = json.loads(cleaned_json_text)
-                total_amount = parsed_data.get("total_amount")
-                if isinstance(total_amount, int):
-                    logger.info(f"Successfully parsed total amount: {total_amount}")
-                    return total_amount
-                elif isinstance(total_amount, (float, str)): # Попытка преобразовать, если пришло не int
-                    try:
-                        amount_int = int(round(float(str(total_amount).replace(',','.'))))
-                        logger.warning(f"Parsed total_amount was not int ({type(total_amount)}), converted to: {amount_int}")
-                        return amount_int
-                    except (ValueError, TypeError):
-                         logger.error(f"Could not convert parsed total_amount '{total_amount}' to int.")
-                         return 0
-                else:
-                    logger.error("Field 'total_amount' is missing or not a number in parsed data.")
-                    return 0
-            except (json.JSONDecodeError, ValidationError) as e:
-                logger.error(f"JSON parsing or validation failed for total amount: {e}. JSON: {cleaned_json_text}")
-                return 0
-        else:
-            logger.error("No usable content found in Gemini response for total amount.")
-            return 0
-
-    except Exception as e:
-        logger.error(f"Error during Gemini API call for total amount: {e}", exc_info=True)
-        return 0
-
+def replay_result_events(response_data: Dict) -> Iterator[Tuple[str, Dict]]:
+    """События шагов для готового результата (например, из кэша)."""
+    yield "ocr", {"extracted_text": response_data.get("extracted_text", "")}
+    yield "restaurant", {"is_restaurant": response_data.get("is_restaurant", False)}
+    for item in response_data.get("positions_list", []):
+        yield "position", item
+    yield "total", {"total_amount_detected": response_data.get("total_amount_detected", 0)}
 
-# --- Обновленная функция get_recommendations ---
-def get_recommendations(extracted_text: str, num_people: int, tea_money: float, item_assignments: Dict[str, List[str]]) -> Optional[Recommendation]:
-    if not extracted_text or num_people <= 0:
-        logger.warning("Invalid input for get_recommendations.")
-        return None
-
-    assignments_str = "\n".join([f"- {name}: {', '.join(items)}" for name, items in item_assignments.items()])
-    if not assignments_str:
-        assignments_str = "Распределение блюд по людям не указано."
-
-    tea_money_int = int(round(tea_money))
-
-    # --- ОБНОВЛЕННЫЙ ПРОМПТ без описаний ---
-    prompt = f"""
-Проанализируй счет из ресторана/кафе и рассчитай варианты его разделения на {num_people} человек.
-
---- ТЕКСТ СЧЕТА ---
-{extracted_text}
---- КОНЕЦ ТЕКСТА СЧЕТА ---
-
---- ДОПОЛНИТЕЛЬНАЯ ИНФОРМАЦИЯ ---
-- Количество человек: {num_people}
-- Желаемые чаевые (добавить к итогу, если не включены): {tea_money_int} (целое число рублей). Проверь, нет ли строк "Сервисный сбор", "Чаевые", или им подобных с этой же суммой (если округлять до целых рублей) в тексте счета - если есть, НЕ добавляй эти {tea_money_int} повторно.
-- Кто что ел/пил (если указано):
-{assignments_str}
-
---- ЗАДАЧА ---
-
-Рассчитай доли для КАЖДОГО человека (с учетом скидок из чека и добавленных чаевых, если они не были включены в сам чек) по следующим методам деления (все суммы округляй до целых рублей):
-1.  `equally`: Разделить итоговую сумму поровну.
-2.  `who_more_eat_then_more_pay`: Разделить так, чтобы те, кто съел БОЛЬШЕ позиций (по количеству штук), заплатили больше. Если распределение блюд по людям не указано, используй равное деление.
-3.  `who_more_cost_then_more_pay`: Разделить так, чтобы те, кто заказал на БОЛЬШУЮ СУММУ (сумма их блюд), заплатили больше. Если распределение блюд по людям не указано, используй равное деление.
-4.  `proportional_division_by_the_cost_of_orders`: Разделить итоговую сумму ПРОПОРЦИОНАЛЬНО стоимости заказа каждого человека. Если распределение блюд по людям не указано, используй равное деление.
-
-Сформируй СПИСОК объектов `peoples_list`. Каждый объект в списке должен представлять одного человека и иметь два поля:
-    - `name`: Имя человека (из `item_assignments`, если есть, иначе используй "Человек 1", "Человек 2" и т.д.).
-    - `shares`: Объект со следующими полями (все **целые числа int**, округленные до целого деньги): `equally`, `who_more_eat_then_more_pay`, `who_more_cost_then_more_pay`, `proportional_division_by_the_cost_of_orders`.
-
-Верни результат СТРОГО в формате JSON, соответствующем структуре:""" + """
-{
-  "peoples_list": [
-    {
-      "name": "Имя1",
-      "shares": {
-        "equally": ЦЕЛОЕ,
-        "who_more_eat_then_more_pay": ЦЕЛОЕ,
-        "who_more_cost_then_more_pay": ЦЕЛОЕ,
-        "proportional_division_by_the_cost_of_orders": ЦЕЛОЕ
-      }
-    },
-    {
-      "name": "Имя2",
-      "shares": {
-        "equally": ЦЕЛОЕ,
-        "who_more_eat_then_more_pay": ЦЕЛОЕ,
-        "who_more_cost_then_more_pay": ЦЕЛОЕ,
-        "proportional_division_by_the_cost_of_orders": ЦЕЛОЕ
-      }
-    }
-  ]
-}
-и так далее
-**Все числовые значения сумм должны быть ЦЕЛЫМИ ЧИСЛАМИ (int).** Не добавляй никаких других пояснений или текста вне JSON. Валюта по умолчанию, если другая явно не указана в чеке - Российский рубль.
-"""
-    # --- КОНЕЦ ОБНОВЛЕННОГО ПРОМПТА ---
+def stream_fused_pipeline(image_bytes: bytes, filename: str) -> Iterator[Tuple[str, object]]:
+    """
+    Объединенный конвейер с потоковым ответом модели: события ocr, restaurant,
+    position (каждая позиция) и total отдаются по мере разбора JSON.
+    Последнее событие - ("result", (response_data, status_code)).
+    """
+    scanner = JsonStreamScanner()
+    for chunk in llm_router.extract_receipt_stream(image_bytes, filename):
+        for kind, key, value in scanner.feed(chunk):
+            if kind == "item" and key == "positions_list":
+                item = streamed_position(value)
+                if item is not None:
+                    yield "position", item
+            elif kind == "field" and key == "is_restaurant":
+                yield "restaurant", {"is_restaurant": bool(value)}
+            elif kind == "field" and key == "extracted_text":
+                yield "ocr", {"extracted_text": value or ""}
+            elif kind == "field" and key == "total_amount":
+                yield "total", {"total_amount_detected": max(parse_total_amount(value) or 0, 0)}
+    extraction = parse_streamed_model(scanner.text, ReceiptExtraction) if scanner.text else None
+    yield "result", build_fused_response(extraction)
+
+def restaurant_verdict_events(is_restaurant_flag: Optional[bool], extracted_text: str) -> List[Tuple[str, object]]:
+    """Событие проверки на ресторан; для не-ресторана - вместе с итоговым результатом."""
+    if is_restaurant_flag is None:
+        logger.error("Failed to determine if image is a restaurant check.") # Как и без потока, продолжаем как с рестораном
+    events = [("restaurant", {"is_restaurant": is_restaurant_flag is not False})]
+    if is_restaurant_flag is False:
+        logger.info("Image determined not to be a restaurant check.")
+        events.append(("result", ({"positions_list": [], "is_restaurant": False, "extracted_text": extracted_text, "total_amount_detected": 0}, 200)))
+    return events
+
+def stream_multi_call_pipeline(image_bytes: bytes, filename: str, extracted_text: Optional[str] = None) -> Iterator[Tuple[str, object]]:
+    """
+    Конвейер из нескольких вызовов с потоковым извлечением позиций: после OCR
+    проверка на ресторан и итог считаются параллельно (при POSTOCR_SPECULATIVE),
+    а позиции отдаются по одной по мере генерации ответа модели (или сразу,
+    если их удалось разобрать правилами). extracted_text - уже распознанный текст.
+    """
+    if extracted_text is None:
+        extracted_text = llm_router.ocr(image_bytes, filename)
+    if extracted_text is None:
+        logger.error("OCR processing failed.")
+        yield "result", ({'error': 'Failed to process image with OCR'}, 500)
+        return
+    yield "ocr", {"extracted_text": extracted_text}
+    if not extracted_text:
+        logger.warning("OCR resulted in empty text.")
+        yield "result", ({"positions_list": [], "is_restaurant": False, "extracted_text": "", "total_amount_detected": 0}, 200)
+        return
+
+    is_restaurant_flag = restaurant_classifier.local_verdict(extracted_text, llm_router.classify)
+    if is_restaurant_flag is not None: # Локальный классификатор уверен - LLM для проверки не нужен
+        yield from restaurant_verdict_events(is_restaurant_flag, extracted_text)
+        if is_restaurant_flag is False:
+            return
+    parsed_receipt = rule_parser.parse(extracted_text)
+    restaurant_future = total_future = None
+    if POSTOCR_SPECULATIVE:
+        if is_restaurant_flag is None:
+            restaurant_future = post_ocr_executor.submit(restaurant_classifier.llm_verdict, extracted_text, llm_router.classify)
+        if parsed_receipt is None:
+            total_future = post_ocr_executor.submit(llm_router.extract_total, extracted_text)
+    elif is_restaurant_flag is None:
+        is_restaurant_flag = restaurant_classifier.llm_verdict(extracted_text, llm_router.classify)
+        yield from restaurant_verdict_events(is_restaurant_flag, extracted_text)
+        if is_restaurant_flag is False:
+            return
+
+    if parsed_receipt is not None: # Позиции и итог разобраны правилами - модель не нужна
+        for item in parsed_receipt.positions.positions_list:
+            yield "position", item.dict()
+        yield "total", {"total_amount_detected": parsed_receipt.total_amount}
+        if restaurant_future is not None:
+            is_restaurant_flag = restaurant_future.result()
+            yield from restaurant_verdict_events(is_restaurant_flag, extracted_text)
+            if is_restaurant_flag is False:
+                return
+        yield "result", (build_restaurant_response(extracted_text, parsed_receipt.positions, parsed_receipt.total_amount), 200)
+        return
+
+    scanner = JsonStreamScanner()
+    for chunk in llm_router.extract_positions_stream(extracted_text):
+        for kind, key, value in scanner.feed(chunk):
+            if kind == "item" and key == "positions_list":
+                item = streamed_position(value)
+                if item is not None:
+                    yield "position", item
+        # Вердикт отдаем, как только он готов, не дожидаясь конца списка позиций
+        if restaurant_future is not None and restaurant_future.done():
+            is_restaurant_flag = restaurant_future.result()
+            restaurant_future = None
+            yield from restaurant_verdict_events(is_restaurant_flag, extracted_text)
+            if is_restaurant_flag is False:
+                total_future.cancel()
+                return
+
+    if restaurant_future is not None:
+        is_restaurant_flag = restaurant_future.result()
+        yield from restaurant_verdict_events(is_restaurant_flag, extracted_text)
+        if is_restaurant_flag is False:
+            total_future.cancel()
+            return
+
+    positions_data = clean_position_names(parse_streamed_model(scanner.text, Positions)) if scanner.text else None
+    total_amount = total_future.result() if total_future is not None else llm_router.extract_total(extracted_text)
+    yield "total", {"total_amount_detected": total_amount}
+    response_data = build_restaurant_response(extracted_text, positions_data, total_amount)
+    logger.info(f"Preprocess successful (streamed). is_restaurant=True, items={len(response_data['positions_list'])}, total_amount={total_amount}")
+    yield "result", (response_data, 200)
+
+# --- Обработка загруженного чека (общая для синхронного маршрута и очереди задач) ---
+def admit_upload(image_bytes: bytes) -> Optional[Tuple[Dict, int]]:
+    """Проверка загрузки до кэша и вызовов модели: None - принято, иначе (JSON ошибки, статус)."""
     try:
-        client = genai_module.Client(api_key=os.getenv('GOOGLE_API_KEY'))
-
-        response_schema = {
-            "type": "object",
-            "properties": {
-                "peoples_list": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "name": {"type": "string"},
-                            "shares": {
-                                "type": "object",
-                                "properties": {
-                                    "equally": {"type": "integer"},
-                                    "who_more_eat_then_more_pay": {"type": "integer"},
-                                    "who_more_cost_then_more_pay": {"type": "integer"},
-                                    "proportional_division_by_the_cost_of_orders": {"type": "integer"}
-                                },
-                                "required": ["equally", "who_more_eat_then_more_pay", "who_more_cost_then_more_pay", "proportional_division_by_the_cost_of_orders"]
-                            }
-                        },
-                        "required": ["name", "shares"]
-                    }
-                }
-            },
-            "required": ["peoples_list"]
-        }
-
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=prompt,
-            config={
-                'response_mime_type': 'application/json',
-                'response_schema': response_schema,
-            },
-        )
-
-        logger = logging.getLogger(__name__)
-
-        try:
-            # Попытка получить объект Recommendation вручную
-            logger.info("Direct parsing of Recommendation object.")
-            raw_text = None
-
-            # Извлекаем текстовый ответ
-            if hasattr(response, 'text') and response.text:
-                raw_text = response.text
-            elif (hasattr(response, 'candidates') and response.candidates and 
-                hasattr(response.candidates[0], 'content') and hasattr(response.candidates[0].content, 'parts') and 
-                response.candidates[0].content.parts):
-                raw_text = response.candidates[0].content.parts[0].text
-
-            if raw_text:
-                logger.info(f"Raw response text received: {raw_text[:1000]}...")
-                # Удаляем возможные артефакты ```json ... ```
-                cleaned_json_text = re.sub(r'^```json\s*|\s*```$', '', raw_text, flags=re.MULTILINE | re.DOTALL).strip()
-                # Попытка распарсить JSON вручную
-                try:
-                    parsed_data = json.loads(cleaned_json_text)
-
-                    # Создаем объект через Pydantic
-                    recommendation_obj = Recommendation(**parsed_data)
-
-                except (json.JSONDecodeError, ValidationError) as parse_err:
-                    logger.error(f"Failed to parse response into Recommendation: {parse_err}. JSON: {cleaned_json_text}")
-                    return None
-            else:
-                logger.error("Could not retrieve raw response text.")
-                return None
-
-
-            # Проверяем список людей
-            if not isinstance(recommendation_obj.peoples_list, list):
-                logger.warning("Parsed 'peoples_list' is not a list. Setting to empty list.")
-                recommendation_obj.peoples_list = []
-
-            logger.info(f"Successfully accessed parsed recommendations. People count: {len(recommendation_obj.peoples_list)}")
-
-            return recommendation_obj
-
-        except Exception as e:
-            logger.error(f"Error during Gemini API call for recommendations: {e}", exc_info=True)
-            return None
-
-
-    except Exception as e:
-        logger.error(f"Error during Gemini API call for recommendations: {e}", exc_info=True)
+        upload_admission.check(image_bytes)
+    except UploadRejected as rejection:
+        return rejection.response()
+    return None
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    # Content-Length больше MAX_CONTENT_LENGTH: тело не читается
+    response_data, status_code = upload_admission.reject_request(request.content_length).response()
+    return jsonify(response_data), status_code
+
+def lookup_cached_receipt(image_bytes: bytes) -> Tuple[str, Optional[Dict]]:
+    """Ключ кэша изображения и закэшированный результат (None при промахе)."""
+    record_upload_bytes("raw", len(image_bytes))
+    cache_key = image_cache_key(image_bytes)
+    cached_data = receipt_cache.get(cache_key)
+    if cached_data is None and shared_store is not None:
+        # Чек мог обработать другой процесс
+        shared_result = shared_store.read(f"receipt:{cache_key}", decode_receipt_result)
+        if shared_result is not None:
+            cached_data = shared_result[0]
+            receipt_cache.put(cache_key, cached_data)
+    record_cache_lookup(cached_data is not None)
+    if cached_data is not None:
+        logger.info(f"Receipt cache hit for {cache_key[:12]}.")
+        cached_data['cache_hit'] = True
+    return cache_key, cached_data
+
+def prepare_image_for_ocr(image_bytes: bytes, original_filename: str) -> Tuple[bytes, str]:
+    """Уменьшает и перекодирует фото перед OCR (меньше байт на загрузку и токенов изображения)."""
+    started_at = time.perf_counter()
+    ocr_bytes, ocr_filename = normalize_image(image_bytes, original_filename)
+    observe_stage("normalize", time.perf_counter() - started_at)
+    record_upload_bytes("normalized", len(ocr_bytes))
+    return ocr_bytes, ocr_filename
+
+def read_long_receipt(image_bytes: bytes, original_filename: str, ocr_bytes: bytes) -> Optional[str]:
+    """Текст высокого чека, распознанный по полосам, или None (обычное фото или OCR полос не удался)."""
+    tiles = tiled_ocr.split(image_bytes, original_filename, ocr_bytes)
+    if tiles is None:
         return None
+    started_at = time.perf_counter()
+    extracted_text = tiled_ocr.read(tiles, llm_router.ocr)
+    observe_stage("ocr_tiled", time.perf_counter() - started_at, failed=extracted_text is None)
+    return extracted_text
 
-# --- Маршруты Flask ---
-
-@app.route('/favicon.ico')
-def favicon():
-    # Убедитесь, что favicon.png находится в static/
-    return send_from_directory(os.path.join(app.root_path, 'static'),
-                               'favicon.png', mimetype='image/png')
-
-@app.route('/')
-def index():
-    return render_template('index.html')
+def reuse_near_duplicate(near_match: NearDuplicateMatch, ocr_bytes: bytes, ocr_filename: str,
+                         extracted_text: Optional[str] = None) -> Tuple[Optional[Dict], Optional[str]]:
+    """
+    Проверяет похожие по хэшу чеки: OCR новой загрузки и сравнение итогов. Возвращает
+    (результат похожего чека, текст) или (None, текст OCR), чтобы конвейер продолжился без повторного OCR.
+    extracted_text - уже распознанный текст (длинный чек по полосам).
+    """
+    if extracted_text is None:
+        extracted_text = llm_router.ocr(ocr_bytes, ocr_filename)
+    if extracted_text is None:
+        return None, None
+    return near_duplicates.confirm(near_match, extracted_text), extracted_text
 
-@app.route('/share')
-def share():
-    # Эта страница может больше не понадобиться в старом виде,
-    # но оставим маршрут, если она используется для чего-то еще.
-    return render_template('share.html')
+def process_receipt_image(image_bytes: bytes, original_filename: str, cache_key: str) -> Tuple[Dict, int]:
+    """
+    Полная обработка чека, не найденного в кэше; успешный результат кладется в кэш.
+    С общим хранилищем тот же чек, который уже обрабатывает другой процесс, не отправляется
+    модели второй раз: результат ждется в хранилище.
+    """
+    if shared_store is None:
+        return run_receipt_pipeline(image_bytes, original_filename, cache_key)
+    result, source = shared_store.get_or_compute(
+        f"receipt:{cache_key}", lambda: run_receipt_pipeline(image_bytes, original_filename, cache_key),
+        encode_receipt_result, decode_receipt_result, SHARED_STORE_TTL)
+    if source != "computed":
+        logger.info(f"Receipt {cache_key[:12]} taken from the shared store ({source}).")
+        receipt_cache.put(cache_key, result[0])
+        result[0]['cache_hit'] = True
+    return result
+
+def run_receipt_pipeline(image_bytes: bytes, original_filename: str, cache_key: str) -> Tuple[Dict, int]:
+    """Нормализация, проверка похожих чеков и конвейер модели (fused или multi)."""
+    logger.info(f"Image {original_filename} received ({len(image_bytes)} bytes).")
+    ocr_bytes, ocr_filename = prepare_image_for_ocr(image_bytes, original_filename)
+
+    near_match = near_duplicates.lookup(ocr_bytes)
+    extracted_text = read_long_receipt(image_bytes, original_filename, ocr_bytes)
+    if near_match.candidates:
+        response_data, extracted_text = reuse_near_duplicate(near_match, ocr_bytes, ocr_filename, extracted_text)
+        if response_data is not None:
+            return finish_receipt_result(response_data, 200, cache_key)
+
+    # Текст уже есть (длинный чек по полосам, проверка похожего чека) - продолжаем с него шагами конвейера multi
+    pipeline_mode = effective_pipeline_mode(extracted_text)
+    if pipeline_mode == "multi":
+        response_data, status_code = run_multi_call_pipeline(ocr_bytes, ocr_filename, extracted_text)
+    else:
+        response_data, status_code = run_fused_pipeline(ocr_bytes, ocr_filename)
+    if status_code == 200:
+        near_duplicates.add(near_match, response_data)
+    return finish_receipt_result(response_data, status_code, cache_key, pipeline_mode)
 
-@app.route('/contacts')
-def contacts():
-    return render_template('contacts.html')
+def effective_pipeline_mode(extracted_text: Optional[str]) -> str:
+    """Конвейер, которым пойдет чек: с уже распознанным текстом - всегда шаги multi."""
+    return "multi" if RECEIPT_PIPELINE_MODE == "multi" or extracted_text is not None else "fused"
 
-@app.route('/privacy')
-def privacy():
-    return render_template('privacy.html')
+def finish_receipt_result(response_data: Dict, status_code: int, cache_key: str, pipeline_mode: Optional[str] = None) -> Tuple[Dict, int]:
+    """
+    Помечает результат конвейера и кладет успешный в кэш. pipeline_mode - каким конвейером
+    обработан чек (None - результат похожего чека: остается его режим).
+    """
+    response_data['pipeline_mode'] = pipeline_mode or response_data.get('pipeline_mode') or RECEIPT_PIPELINE_MODE
+    if status_code == 200:
+        receipt_cache.put(cache_key, response_data)
+    response_data['cache_hit'] = False
+    return response_data, status_code
+
+def attach_receipt_session(response_data: Dict, status_code: int) -> Dict:
+    """Создает сессию для успешно разобранного чека из ресторана и добавляет receipt_id в ответ."""
+    if status_code != 200 or not response_data.get('is_restaurant'):
+        return response_data
+    try:
+        positions = Positions(positions_list=response_data.get('positions_list') or [])
+    except ValidationError as e:
+        logger.error(f"Receipt session not created, invalid positions_list: {e}")
+        return response_data
+    response_data['receipt_id'] = receipt_sessions.create(positions, response_data.get('total_amount_detected') or 0,
+                                                          response_data.get('extracted_text') or '')
+    return response_data
+
+def process_receipt_job(image_bytes: bytes, original_filename: str, cache_key: str) -> Tuple[Dict, int]:
+    response_data, status_code = process_receipt_image(image_bytes, original_filename, cache_key)
+    return attach_receipt_session(response_data, status_code), status_code
+
+# Очередь задач (JOB_*): обработка чеков в отдельном ограниченном пуле, а не в потоках waitress
+receipt_jobs = create_job_queue_from_env(process_receipt_job)
+atexit.register(receipt_jobs.shutdown)
 
 # --- Обновленный маршрут /preprocess_receipt ---
 @app.route('/preprocess_receipt', methods=['POST'])
@@ -452,133 +558,479 @@ def preprocess_receipt():
         logger.warning("Preprocess request failed: No image file provided.")
         return jsonify({'error': 'No image file provided'}), 400
 
-    # Сохраняем файл временно (путь можно сделать уникальным при необходимости)
-    original_filename = image_file.filename # Безопаснее использовать secure_filename, но для простоты оставим так
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], original_filename)
+    # Изображение обрабатывается в памяти, без сохранения на диск
+    original_filename = image_file.filename
 
     try:
-        image_file.save(filepath)
-        logger.info(f"Image saved temporarily to {filepath}")
-
-        # Шаг 1: OCR
-        extracted_text = process_image_with_gemini(filepath)
-        if extracted_text is None:
-             logger.error("OCR processing failed.")
-             return jsonify({'error': 'Failed to process image with OCR'}), 500
-        if not extracted_text:
-             logger.warning("OCR resulted in empty text.")
-             # Возвращаем пустые данные, но с успехом
-             return jsonify({"positions_list": [], "is_restaurant": False, "extracted_text": "", "total_amount_detected": 0}), 200
+        image_bytes = image_file.read()
+        rejection = admit_upload(image_bytes)
+        if rejection is not None:
+            return jsonify(rejection[0]), rejection[1]
 
-        logger.info(f"OCR extracted text (first 100 chars): {extracted_text[:100]}...")
+        # Повторная загрузка того же изображения - отдаем результат из кэша
+        cache_key, cached_data = lookup_cached_receipt(image_bytes)
+        if cached_data is not None:
+            return jsonify(attach_receipt_session(cached_data, 200)), 200
 
-        # Шаг 2: Проверка на ресторан
-        is_restaurant_flag = is_restaurant_check(extracted_text)
+        response_data, status_code = process_receipt_image(image_bytes, original_filename, cache_key)
+        return jsonify(attach_receipt_session(response_data, status_code)), status_code
 
-        if is_restaurant_flag is None:
-            logger.error("Failed to determine if image is a restaurant check.")
-            is_restaurant_flag = False # Считаем не рестораном при ошибке
-        elif is_restaurant_flag is False:
-            logger.info("Image determined not to be a restaurant check.")
-            # Возвращаем результат с флагом False и пустыми данными
-            return jsonify({"positions_list": [], "is_restaurant": False, "extracted_text": extracted_text, "total_amount_detected": 0}), 200
+    except Exception as e:
+        logger.error(f"Error during preprocess_receipt: {e}", exc_info=True)
+        return jsonify({'error': 'An internal server error occurred during preprocessing.'}), 500
 
-        # --- Шаг 3: Если это ресторан, извлекаем ПОЗИЦИИ ---
-        logger.info("Check identified as restaurant, proceeding to get positions.")
-        positions_data = get_positions(extracted_text)
+def process_batch_image(image_bytes: bytes, original_filename: str) -> Tuple[Dict, int]:
+    """Обработка одного чека из пакета (с учетом кэша); ошибки не прерывают остальные чеки."""
+    try:
+        rejection = admit_upload(image_bytes)
+        if rejection is not None:
+            return rejection
+        cache_key, cached_data = lookup_cached_receipt(image_bytes)
+        if cached_data is not None:
+            return cached_data, 200
+        return process_receipt_image(image_bytes, original_filename, cache_key)
+    except Exception as e:
+        logger.error(f"Error processing batch image {original_filename}: {e}", exc_info=True)
+        return {'error': 'An internal server error occurred during preprocessing.'}, 500
 
-        if positions_data is None:
-            logger.error("Failed to get positions data from Gemini.")
-            # Можно вернуть ошибку или пустой список позиций
-            positions_data = Positions(positions_list=[]) # Возвращаем пустой список при ошибке
-            # return jsonify({'error': 'Failed to extract items from the restaurant check'}), 500
+def combine_batch_results(filenames: List[str], results: List[Tuple[Dict, int]]) -> Dict:
+    """
+    Объединяет результаты чеков пакета: общий positions_list (у каждой позиции
+    source и receipt_index), итоги по чекам и общий итог по чекам из ресторанов.
+    """
+    positions_list, receipts, texts = [], [], []
+    grand_total = 0
+    for index, (filename, (response_data, status_code)) in enumerate(zip(filenames, results)):
+        source = f"receipt_{index + 1}"
+        receipt = {'receipt_index': index, 'source': source, 'filename': filename, 'status': status_code}
+        if status_code != 200:
+            receipt['error'] = response_data.get('error', 'Failed to process receipt')
+            if 'rejected' in response_data:
+                receipt['rejected'] = response_data['rejected']
+            receipts.append(receipt)
+            continue
+        receipt['is_restaurant'] = response_data.get('is_restaurant', False)
+        receipt['total_amount_detected'] = response_data.get('total_amount_detected', 0) if receipt['is_restaurant'] else 0
+        receipt['positions_count'] = len(response_data.get('positions_list', [])) if receipt['is_restaurant'] else 0
+        receipt['cache_hit'] = response_data.get('cache_hit', False)
+        receipts.append(receipt)
+        if not receipt['is_restaurant']:
+            continue
+        grand_total += receipt['total_amount_detected']
+        texts.append(f"--- {source} ({filename}) ---\n{response_data.get('extracted_text', '')}")
+        for item in response_data.get('positions_list', []):
+            positions_list.append(dict(item, source=source, receipt_index=index))
+    return {
+        'positions_list': positions_list,
+        'is_restaurant': any(receipt.get('is_restaurant') for receipt in receipts),
+        'extracted_text': "\n\n".join(texts),
+        'total_amount_detected': grand_total,
+        'receipts': receipts,
+        'pipeline_mode': RECEIPT_PIPELINE_MODE,
+    }
 
-        # --- Шаг 4: Извлекаем ИТОГОВУЮ СУММУ ОТДЕЛЬНО ---
-        logger.info("Proceeding to get total amount.")
-        total_amount = get_total_amount(extracted_text) # Возвращает int, 0 при ошибке
+@app.route('/preprocess_receipts', methods=['POST'])
+def preprocess_receipts():
+    """
+    Пакетная обработка нескольких чеков (поле receipt_images, несколько файлов).
+    Чеки обрабатываются параллельно в общем пуле BATCH_CONCURRENCY, поэтому время
+    ответа близко к самому медленному чеку. Ответ совместим с /calculate_split.
+    """
+    image_files = [image_file for image_file in request.files.getlist('receipt_images') if image_file]
+    if not image_files:
+        logger.warning("Batch preprocess request failed: No image files provided.")
+        return jsonify({'error': 'No image files provided'}), 400
+    if len(image_files) > BATCH_MAX_IMAGES:
+        logger.warning(f"Batch preprocess request rejected: {len(image_files)} images, limit {BATCH_MAX_IMAGES}.")
+        return jsonify({'error': f'Too many images, at most {BATCH_MAX_IMAGES} per request'}), 400
+
+    filenames = [image_file.filename for image_file in image_files]
+    futures = [batch_executor.submit(process_batch_image, image_file.read(), image_file.filename) for image_file in image_files]
+    results = [future.result() for future in futures]
+
+    response_data = combine_batch_results(filenames, results)
+    succeeded = sum(1 for _, status_code in results if status_code == 200)
+    logger.info(f"Batch preprocess finished: {succeeded}/{len(results)} receipts, items={len(response_data['positions_list'])}, total_amount={response_data['total_amount_detected']}")
+    if not succeeded:
+        response_data['error'] = 'Failed to process all receipts'
+        return jsonify(response_data), 500
+    return jsonify(attach_receipt_session(response_data, 200)), 200
+
+def job_response(job) -> Dict:
+    """Состояние задачи для ответа API; результат - тот же JSON, что у /preprocess_receipt."""
+    data = {'job_id': job.job_id, 'status': job.status, 'poll_url': f"/jobs/{job.job_id}"}
+    if job.status == "queued":
+        data['queue_position'] = receipt_jobs.queue_position(job)
+    if job.started_at is not None:
+        data['wait_ms'] = round(1000 * (job.started_at - job.submitted_at), 1)
+    if job.finished_at is not None:
+        data['run_ms'] = round(1000 * (job.finished_at - job.started_at), 1)
+        data['result_status'] = job.status_code
+        data['result'] = job.result
+    return data
+
+@app.route('/jobs/preprocess_receipt', methods=['POST'])
+def submit_preprocess_job():
+    """
+    Ставит обработку чека в очередь: 202 с job_id (опрос - GET /jobs/<job_id>),
+    429 с Retry-After, если очередь заполнена. Результат из кэша - сразу готовая задача.
+    """
+    image_file = request.files.get('receipt_image')
+    if not image_file:
+        logger.warning("Job submit failed: No image file provided.")
+        return jsonify({'error': 'No image file provided'}), 400
 
-        # --- Шаг 5: Собираем финальный ответ ---
-        response_data = positions_data.dict() # Получаем {'positions_list': [...]}
-        response_data['is_restaurant'] = True
-        response_data['extracted_text'] = extracted_text
-        response_data['total_amount_detected'] = total_amount # Добавляем сумму
+    image_bytes = image_file.read()
+    rejection = admit_upload(image_bytes)
+    if rejection is not None:
+        return jsonify(rejection[0]), rejection[1]
+    cache_key, cached_data = lookup_cached_receipt(image_bytes)
+    if cached_data is not None:
+        job = receipt_jobs.add_completed(attach_receipt_session(cached_data, 200), 200)
+    else:
+        job = receipt_jobs.submit(image_bytes, image_file.filename, cache_key)
+    if job is None:
+        retry_after = receipt_jobs.retry_after_seconds()
+        logger.warning(f"Receipt job queue is full, rejecting upload (Retry-After: {retry_after}s).")
+        return jsonify({'error': 'Server is busy, please retry later.', 'retry_after': retry_after}), 429, {'Retry-After': str(retry_after)}
+    return jsonify(job_response(job)), 202, {'Location': f"/jobs/{job.job_id}"}
+
+@app.route('/jobs/<job_id>')
+def get_preprocess_job(job_id):
+    """Состояние задачи. ?wait=N - long-poll до N секунд (не больше JOB_MAX_WAIT)."""
+    try:
+        wait_seconds = min(max(float(request.args.get('wait', 0)), 0.0), JOB_MAX_WAIT)
+    except ValueError:
+        return jsonify({'error': 'Invalid wait value'}), 400
+    job = receipt_jobs.wait(job_id, wait_seconds)
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    return jsonify(job_response(job)), 200
+
+@app.route('/job_stats')
+def job_stats():
+    # Длина очереди, занятость пула и средние времена ожидания/выполнения задач
+    return jsonify(receipt_jobs.stats()), 200
+
+def stream_receipt_pipeline(image_bytes: bytes, original_filename: str, cache_key: str) -> Iterator[Tuple[str, object]]:
+    """
+    Потоковый run_receipt_pipeline: события ocr, restaurant, position, total (для похожего чека -
+    повтор его результата) и в конце ("result", (ответ, статус)); успешный результат - в кэше.
+    """
+    logger.info(f"Image {original_filename} received for streaming ({len(image_bytes)} bytes).")
+    ocr_bytes, ocr_filename = prepare_image_for_ocr(image_bytes, original_filename)
+
+    near_match = near_duplicates.lookup(ocr_bytes)
+    extracted_text = read_long_receipt(image_bytes, original_filename, ocr_bytes)
+    if near_match.candidates:
+        response_data, extracted_text = reuse_near_duplicate(near_match, ocr_bytes, ocr_filename, extracted_text)
+        if response_data is not None:
+            response_data, _ = finish_receipt_result(response_data, 200, cache_key)
+            yield from replay_result_events(response_data)
+            yield "result", (response_data, 200)
+            return
+
+    pipeline_mode = effective_pipeline_mode(extracted_text)
+    if pipeline_mode == "multi":
+        events = stream_multi_call_pipeline(ocr_bytes, ocr_filename, extracted_text)
+    else:
+        events = stream_fused_pipeline(ocr_bytes, ocr_filename)
+    for event, data in events:
+        if event != "result":
+            yield event, data
+            continue
+        response_data, status_code = data
+        if status_code == 200:
+            near_duplicates.add(near_match, response_data)
+        yield "result", finish_receipt_result(response_data, status_code, cache_key, pipeline_mode)
+
+@app.route('/preprocess_receipt_stream', methods=['POST'])
+def preprocess_receipt_stream():
+    """
+    Потоковый вариант /preprocess_receipt (text/event-stream). События:
+    ocr, restaurant, position (по одной), total и в конце done - с тем же JSON,
+    что возвращает /preprocess_receipt, - или error ({"status", "error"}).
+    """
+    image_file = request.files.get('receipt_image')
+    if not image_file:
+        logger.warning("Preprocess stream request failed: No image file provided.")
+        return jsonify({'error': 'No image file provided'}), 400
 
-        logger.info(f"Preprocess successful. is_restaurant=True, items={len(response_data['positions_list'])}, total_amount={total_amount}")
-        return jsonify(response_data), 200
+    original_filename = image_file.filename
+    image_bytes = image_file.read()
+    rejection = admit_upload(image_bytes)
+    if rejection is not None:
+        return jsonify(rejection[0]), rejection[1]
 
-    except Exception as e:
-        logger.error(f"Error during preprocess_receipt: {e}", exc_info=True)
-        return jsonify({'error': 'An internal server error occurred during preprocessing.'}), 500
-    finally:
-        # Удаляем временный файл
-        if os.path.exists(filepath):
+    def generate():
+        try:
+            cache_key, cached_data = lookup_cached_receipt(image_bytes)
+            claim_token = None
+            if cached_data is None and shared_store is not None:
+                # Как process_receipt_image: тот же чек, который уже обрабатывает другой запрос или процесс,
+                # ждем в общем хранилище, а не отправляем модели второй раз
+                shared_result, source, claim_token = shared_store.claim(f"receipt:{cache_key}", decode_receipt_result)
+                if shared_result is not None:
+                    logger.info(f"Receipt {cache_key[:12]} taken from the shared store ({source}).")
+                    cached_data = shared_result[0]
+                    receipt_cache.put(cache_key, cached_data)
+                    cached_data['cache_hit'] = True
+            if cached_data is not None:
+                for event, data in replay_result_events(cached_data):
+                    yield sse_event(event, data)
+                yield sse_event("done", attach_receipt_session(cached_data, 200))
+                return
+
+            result = None
             try:
-                os.remove(filepath)
-                logger.info(f"Temporary file {filepath} deleted.")
-            except Exception as e:
-                logger.error(f"Error deleting temporary file {filepath}: {e}")
+                for event, data in stream_receipt_pipeline(image_bytes, original_filename, cache_key):
+                    if event == "result":
+                        result = data
+                    else:
+                        yield sse_event(event, data)
+            finally: # Результат - в хранилище до события done; аренда снимается и при ошибке или обрыве соединения
+                if shared_store is not None:
+                    shared_store.finish_claim(f"receipt:{cache_key}", claim_token, result, encode_receipt_result, SHARED_STORE_TTL)
+            response_data, status_code = result
+            if status_code != 200:
+                yield sse_event("error", dict(response_data, status=status_code))
+                return
+            yield sse_event("done", attach_receipt_session(response_data, status_code))
+        except Exception as e:
+            logger.error(f"Error during preprocess_receipt_stream: {e}", exc_info=True)
+            yield sse_event("error", {'status': 500, 'error': 'An internal server error occurred during preprocessing.'})
+
+    # X-Accel-Buffering: no - чтобы прокси (nginx) не копил события до конца ответа
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/backend_stats')
+def backend_stats():
+    # Скользящие задержки и доля ошибок LLM-бэкендов по операциям
+    return jsonify(llm_router.stats()), 200
+
+@app.route('/governor_stats')
+def governor_stats():
+    # Квоты моделей Gemini, повторы при 429/5xx и объединенные одинаковые запросы
+    return jsonify(get_governor().stats()), 200
+
+@app.route('/metrics')
+def metrics():
+    # Метрики по шагам конвейера в формате Prometheus (задержки, токены, размеры загрузок, кэш, ошибки)
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/parser_stats')
+def parser_stats():
+    # Доля чеков, разобранных правилами без LLM, и причины перехода к LLM
+    return jsonify(rule_parser.stats()), 200
+
+@app.route('/session_stats')
+def session_stats():
+    # Сессии чеков (число, размер, вытеснения) и попадания в кэш рассчитанных делений
+    return jsonify({'sessions': receipt_sessions.stats(), 'split_memo': split_memo.stats()}), 200
+
+@app.route('/classifier_stats')
+def classifier_stats():
+    # Доля проверок "ресторан?", решенных локально, и согласие с LLM (для подбора порогов)
+    return jsonify(restaurant_classifier.stats()), 200
+
+@app.route('/admission_stats')
+def admission_stats():
+    # Загрузки, отклоненные до вызовов модели, по причинам (размер, формат, размеры кадра, пустые, размытые)
+    return jsonify(upload_admission.stats()), 200
+
+@app.route('/static_stats')
+def static_stats():
+    # Размер статики до и после сжатия и WebP (для проверки конвейера статики)
+    return jsonify(static_assets.stats() if static_assets is not None else {'enabled': False}), 200
+
+@app.route('/startup_stats')
+def startup_stats():
+    # Этапы холодного старта (загрузка, открытие порта, прогрев) и время задач прогрева
+    return jsonify(startup_profile.stats()), 200
+
+@app.route('/tiled_ocr_stats')
+def tiled_ocr_stats():
+    # Высокие чеки, распознанные по полосам, и стыки полос без общих строк
+    return jsonify(tiled_ocr.stats()), 200
+
+@app.route('/near_duplicate_stats')
+def near_duplicate_stats():
+    # Найденные похожие чеки, подтвержденные по итогу и ложные совпадения
+    return jsonify(near_duplicates.stats()), 200
+
+@app.route('/shared_store_stats')
+def shared_store_stats():
+    # Общее хранилище процессов: попадания, ожидания чужого расчета, размер файла
+    return jsonify(shared_store.stats() if shared_store is not None else {'backend': None}), 200
+
+@app.route('/cache_stats')
+def cache_stats():
+    # Счетчики кэша результатов обработки чеков (для подбора размера)
+    return jsonify(receipt_cache.stats()), 200
+
+class SplitRequest:
+    """Проверенные входные данные /calculate_split."""
+    __slots__ = ("session", "positions_data", "extracted_text", "num_people", "tea_money", "item_assignments",
+                 "total_amount", "memo_key")
+
+    def __init__(self, session, positions_data, extracted_text, num_people, tea_money, item_assignments, total_amount, memo_key):
+        self.session = session
+        self.positions_data = positions_data
+        self.extracted_text = extracted_text
+        self.num_people = num_people
+        self.tea_money = tea_money
+        self.item_assignments = item_assignments
+        self.total_amount = total_amount
+        self.memo_key = memo_key
+
+    @property
+    def llm_fallback_allowed(self) -> bool:
+        return bool(SPLIT_LLM_FALLBACK and self.extracted_text)
+
+def parse_split_request(data) -> Tuple[Optional[SplitRequest], Optional[Tuple[Dict, int]]]:
+    """
+    Проверяет JSON /calculate_split. Возвращает (входные данные, None) или (None, (ответ, код)),
+    если запрос ошибочный или такой расчет уже есть в памяти.
+    """
+    if not data:
+        logger.error("Calculate split request failed: No JSON data provided.")
+        return None, ({'error': 'No JSON data provided'}, 400)
+
+    session = None
+    receipt_id = data.get('receipt_id')
+    if receipt_id:
+        session = receipt_sessions.get(str(receipt_id))
+        if session is None:
+            logger.warning(f"Calculate split request failed: receipt session {receipt_id} not found or expired.")
+            return None, ({'error': 'Receipt session not found or expired', 'session_expired': True}, 404)
+
+    extracted_text = data.get('extracted_text') or (session.extracted_text if session else None)
+    num_people_str = data.get('num_people') or (session.num_people if session else None)
+    tea_money_str = data.get('tea_money', session.tea_money if session else '0') # По умолчанию 0
+    item_assignments = data.get('item_assignments') # Ожидаем Dict[str, List[str]]
+    assignment_changes = data.get('assignment_changes')
+    if session is not None and item_assignments is None:
+        item_assignments = session.item_assignments
+        if isinstance(assignment_changes, dict):
+            item_assignments = merge_assignments(item_assignments, assignment_changes)
+    positions_raw = data.get('positions_list') # Позиции, полученные из /preprocess_receipt
+    total_amount_raw = data.get('total_amount', session.total_amount if session else 0)
+
+    # Валидация входных данных
+    positions_data = session.positions if session is not None and positions_raw is None else None
+    if isinstance(positions_raw, list):
+        try:
+            positions_data = Positions(positions_list=positions_raw)
+        except ValidationError as e:
+            logger.error(f"Calculate split request failed: Invalid positions_list: {e}")
+            return None, ({'error': 'Invalid positions_list value'}, 400)
+    if positions_data is None and not (SPLIT_LLM_FALLBACK and extracted_text):
+        logger.error("Calculate split request failed: Missing positions_list.")
+        return None, ({'error': 'Missing positions_list'}, 400)
+    if not num_people_str:
+        logger.error("Calculate split request failed: Missing num_people.")
+        return None, ({'error': 'Missing num_people'}, 400)
+    if not isinstance(item_assignments, dict):
+         # Если распределения нет, передаем пустой словарь
+         item_assignments = {}
+         logger.warning("item_assignments not provided or not a dict, using empty for calculation.")
+         # Не возвращаем ошибку, просто считаем без распределения
+
+    try:
+        num_people = int(num_people_str)
+        if num_people <= 0:
+            raise ValueError("Number of people must be positive.")
+    except ValueError:
+        logger.error(f"Calculate split request failed: Invalid num_people value '{num_people_str}'.")
+        return None, ({'error': 'Invalid num_people value'}, 400)
+
+    try:
+        # Заменяем запятую на точку для безопасности
+        tea_money = float(str(tea_money_str).replace(',', '.'))
+        if tea_money < 0:
+            raise ValueError("Tea money cannot be negative.")
+    except ValueError:
+        logger.error(f"Calculate split request failed: Invalid tea_money value '{tea_money_str}'.")
+        return None, ({'error': 'Invalid tea_money value'}, 400)
+
+    try:
+        total_amount = int(round(float(str(total_amount_raw or 0).replace(',', '.'))))
+    except ValueError:
+        logger.error(f"Calculate split request failed: Invalid total_amount value '{total_amount_raw}'.")
+        return None, ({'error': 'Invalid total_amount value'}, 400)
+
+    # Тот же чек с теми же параметрами уже считали - отдаем готовый ответ
+    receipt_key = session.receipt_id if session is not None and positions_raw is None else \
+        (positions_data.json() if positions_data is not None else extracted_text)
+    memo_key = SplitMemo.make_key(receipt_key, total_amount, num_people, tea_money, item_assignments)
+    memoized = split_memo.get(memo_key)
+    if memoized is None and shared_store is not None:
+        memoized = shared_store.read(f"split:{memo_key}", lambda data: unpack_recommendation(decode_record(data)).dict())
+        if memoized is not None:
+            split_memo.put(memo_key, memoized)
+    if memoized is not None:
+        logger.info("Split recommendations served from memo.")
+        if session is not None:
+            receipt_sessions.save_state(session, num_people, tea_money, item_assignments)
+        return None, (memoized, 200)
+
+    logger.info(f"Calculating split for {num_people} people, tea: {tea_money}, assignments: {len(item_assignments)} people assigned.")
+    return SplitRequest(session, positions_data, extracted_text, num_people, tea_money, item_assignments, total_amount, memo_key), None
+
+def compute_split_locally(split_request: SplitRequest) -> Optional[Recommendation]:
+    """Локальный расчет деления (None - позиции не сопоставились или их нет)."""
+    if split_request.positions_data is None:
+        return None
+    started_at = time.perf_counter()
+    recommendations = compute_split(split_request.positions_data, split_request.total_amount, split_request.num_people,
+                                    split_request.tea_money, split_request.item_assignments)
+    observe_stage("split_local", time.perf_counter() - started_at, failed=recommendations is None)
+    return recommendations
+
+def finish_split(split_request: SplitRequest, recommendations: Optional[Recommendation]) -> Tuple[Dict, int]:
+    """Ответ /calculate_split; успешный расчет запоминается, а состояние сессии сохраняется."""
+    if recommendations is None:
+        logger.error("Failed to compute splitting recommendations.")
+        return {'error': 'Failed to generate splitting recommendations'}, 500
+
+    logger.info("Recommendations generated successfully.")
+    # Возвращаем результат в виде словаря
+    response_data = recommendations.dict()
+    split_memo.put(split_request.memo_key, response_data)
+    if shared_store is not None:
+        shared_store.write(f"split:{split_request.memo_key}", recommendations,
+                           lambda value: encode_record(pack_recommendation(value)), SHARED_STORE_TTL)
+    if split_request.session is not None: # Следующие изменения распределения - относительно этого состояния
+        receipt_sessions.save_state(split_request.session, split_request.num_people, split_request.tea_money,
+                                    split_request.item_assignments)
+    return response_data, 200
 
 # --- НОВЫЙ МАРШРУТ ДЛЯ РАСЧЕТА ---
 @app.route('/calculate_split', methods=['POST'])
 def calculate_split():
     """
     Эндпоинт для второго шага: расчет рекомендаций по делению.
-    Принимает: JSON с 'extracted_text', 'num_people', 'tea_money', 'item_assignments'
-    Возвращает: JSON с рекомендациями или ошибку.
+    Принимает: JSON с 'positions_list', 'total_amount', 'num_people', 'tea_money', 'item_assignments'
+    (и 'extracted_text' для запасного расчета через LLM).
+    Либо 'receipt_id' из /preprocess_receipt: позиции, итог и прошлое состояние берутся из сессии,
+    а в запросе достаточно измененных полей - 'num_people', 'tea_money' и 'assignment_changes'
+    ({"Имя": [...]} заменяет позиции человека, {"Имя": null} удаляет его) или полного 'item_assignments'.
+    Возвращает: JSON с рекомендациями или ошибку (404, если сессия истекла - нужно прислать чек целиком).
     """
     try:
-        data = request.get_json()
-        if not data:
-            logger.error("Calculate split request failed: No JSON data provided.")
-            return jsonify({'error': 'No JSON data provided'}), 400
-
-        extracted_text = data.get('extracted_text')
-        num_people_str = data.get('num_people')
-        tea_money_str = data.get('tea_money', '0') # По умолчанию 0
-        item_assignments = data.get('item_assignments') # Ожидаем Dict[str, List[str]]
-
-        # Валидация входных данных
-        if not extracted_text:
-            logger.error("Calculate split request failed: Missing extracted_text.")
-            return jsonify({'error': 'Missing extracted_text'}), 400
-        if not num_people_str:
-            logger.error("Calculate split request failed: Missing num_people.")
-            return jsonify({'error': 'Missing num_people'}), 400
-        if not isinstance(item_assignments, dict):
-             # Если распределения нет, передаем пустой словарь
-             item_assignments = {}
-             logger.warning("item_assignments not provided or not a dict, using empty for calculation.")
-             # Не возвращаем ошибку, просто считаем без распределения
+        split_request, early_response = parse_split_request(request.get_json())
+        if early_response is not None:
+            return jsonify(early_response[0]), early_response[1]
 
-        try:
-            num_people = int(num_people_str)
-            if num_people <= 0:
-                raise ValueError("Number of people must be positive.")
-        except ValueError:
-            logger.error(f"Calculate split request failed: Invalid num_people value '{num_people_str}'.")
-            return jsonify({'error': 'Invalid num_people value'}), 400
-
-        try:
-            # Заменяем запятую на точку для безопасности
-            tea_money = float(str(tea_money_str).replace(',', '.'))
-            if tea_money < 0:
-                raise ValueError("Tea money cannot be negative.")
-        except ValueError:
-            logger.error(f"Calculate split request failed: Invalid tea_money value '{tea_money_str}'.")
-            return jsonify({'error': 'Invalid tea_money value'}), 400
-
-        logger.info(f"Calculating split for {num_people} people, tea: {tea_money}, assignments: {len(item_assignments)} people assigned.")
+        # Считаем локально; LLM - только запасной вариант (SPLIT_LLM_FALLBACK), если позиции не удалось сопоставить
+        recommendations = compute_split_locally(split_request)
+        if recommendations is None and split_request.llm_fallback_allowed:
+            logger.warning("Local split failed, falling back to LLM recommendations.")
+            recommendations = llm_router.split(split_request.extracted_text, split_request.num_people,
+                                               split_request.tea_money, split_request.item_assignments)
 
-        # Получаем рекомендации (вызываем функцию get_recommendations)
-        recommendations = get_recommendations(extracted_text, num_people, tea_money, item_assignments)
-
-        if recommendations is None:
-            logger.error("Failed to get recommendations from Gemini.")
-            return jsonify({'error': 'Failed to generate splitting recommendations'}), 500
-
-        logger.info("Recommendations generated successfully.")
-        # Возвращаем результат в виде словаря
-        return jsonify(recommendations.dict()), 200
+        response_data, status_code = finish_split(split_request, recommendations)
+        return jsonify(response_data), status_code
 
     except Exception as e:
         logger.error(f"Error during calculate_split: {e}", exc_info=True)
@@ -596,18 +1048,37 @@ def site_map():
 def robots_txt():
     return send_from_directory(app.root_path, 'robots.txt')
 
-# Загрузка переменных окружения из .env
-load_dotenv()
+# Прогрев после старта (STARTUP_WARMUP): SDK настроенных LLM-бэкендов и WebP-варианты картинок
+startup_profile = create_startup_profile_from_env(APP_LOAD_STARTED_AT)
+warmup_tasks = {'llm_backends': llm_router.warm_up}
+if static_assets is not None:
+    warmup_tasks['static_assets'] = static_assets.warm_up
+startup_profile.mark("loaded")
+if startup_profile.mode == "eager":
+    startup_profile.start_warmup(warmup_tasks)
+
+@app.before_request
+def start_warmup_on_first_request():
+    # Под другим WSGI-сервером момент открытия порта неизвестен - прогрев начинается с первым запросом
+    startup_profile.start_warmup(warmup_tasks)
 
 env = os.getenv("ENV", "dev")
 port = int(os.getenv("PORT", 5000))
 host = os.getenv("HOST", "0.0.0.0")
 debug = os.getenv("DEBUG", "False").lower() == "true"
+threads = int(os.getenv("WAITRESS_THREADS", 4)) # По умолчанию как у waitress
 
 if __name__ == '__main__':
     if env == "dev":
         print(f"🔧 Запуск в режиме разработки на http://127.0.0.1:{port}")
+        startup_profile.start_warmup(warmup_tasks)
         app.run(host="0.0.0.0", port=port, debug=debug)
     else:
+        from waitress import create_server # Нужен только при запуске через этот файл
         print(f"🚀 Запуск в продакшн на http://0.0.0.0:{port} через Waitress")
-        serve(app, host=host, port=port)
+        # max_request_body_size: waitress обрывает слишком большое тело еще при приеме, не буферизуя его целиком
+        server = create_server(app, host=host, port=port, threads=threads,
+                               max_request_body_size=UPLOAD_MAX_REQUEST_BYTES) # Порт открыт здесь
+        startup_profile.mark("listening")
+        startup_profile.start_warmup(warmup_tasks)
+        server.run()
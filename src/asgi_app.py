@@ -0,0 +1,278 @@
+# --- START OF FILE asgi_app.py ---
+# Асинхронный (ASGI) режим: /preprocess_receipt и /calculate_split ждут ответов модели в event loop,
+# без потока на запрос; остальные маршруты Flask выполняются в пуле потоков через a2wsgi.
+#
+# Запуск (те же ENV, PORT, HOST из .env):
+#     python src/asgi_app.py
+# или внешним сервером: uvicorn asgi_app:application --app-dir src
+
+import asyncio
+import io
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from a2wsgi import WSGIMiddleware
+
+from app import (app, InMemoryUploadRequest, llm_router, restaurant_classifier, rule_parser, startup_profile, warmup_tasks,
+                 POSTOCR_SPECULATIVE, lookup_cached_receipt, prepare_image_for_ocr,
+                 finish_receipt_result, effective_pipeline_mode, attach_receipt_session, build_fused_response, build_restaurant_response,
+                 parse_split_request, compute_split_locally, finish_split, admit_upload, upload_admission, near_duplicates,
+                 receipt_cache, shared_store, SHARED_STORE_TTL, tiled_ocr, env, host, port)
+from shared_store import encode_receipt_result, decode_receipt_result
+from gemini_clients import aclose_registry_async
+
+logger = logging.getLogger(__name__)
+
+# Потоки для маршрутов Flask (страницы, поток SSE, пакеты, задачи) и синхронных бэкендов без async-клиента
+ASGI_SYNC_THREADS = int(os.getenv("ASGI_SYNC_THREADS", 16))
+# Наибольший размер тела запроса, который читается в память (как MAX_CONTENT_LENGTH у Flask)
+ASGI_MAX_BODY_BYTES = int(os.getenv("ASGI_MAX_BODY_BYTES", app.config.get("MAX_CONTENT_LENGTH") or 32 * 1024 * 1024))
+
+NOT_RESTAURANT = {"positions_list": [], "is_restaurant": False, "total_amount_detected": 0}
+
+flask_application = WSGIMiddleware(app, workers=ASGI_SYNC_THREADS)
+_warmup_on_listen = False # python asgi_app.py запускает прогрев сам, когда порт уже открыт
+
+
+# --- Асинхронные конвейеры (те же шаги, что run_fused_pipeline / run_multi_call_pipeline в app.py) ---
+async def run_fused_pipeline_async(image_bytes: bytes, filename: str) -> Tuple[Dict, int]:
+    return build_fused_response(await llm_router.extract_receipt_async(image_bytes, filename))
+
+async def extract_positions_and_total_async(extracted_text: str):
+    return await asyncio.gather(llm_router.extract_positions_async(extracted_text), llm_router.extract_total_async(extracted_text))
+
+async def run_multi_call_pipeline_async(image_bytes: bytes, filename: str, extracted_text: Optional[str] = None) -> Tuple[Dict, int]:
+    """
+    OCR, затем проверка на ресторан и извлечение позиций и итога. Как в app.py: правила и локальный
+    классификатор избавляют от вызовов модели, а с POSTOCR_SPECULATIVE позиции и итог запрашиваются
+    одновременно с проверкой и отменяются, если чек не из ресторана. extracted_text - уже распознанный текст.
+    """
+    if extracted_text is None:
+        extracted_text = await llm_router.ocr_async(image_bytes, filename)
+    if extracted_text is None:
+        logger.error("OCR processing failed.")
+        return {'error': 'Failed to process image with OCR'}, 500
+    if not extracted_text:
+        logger.warning("OCR resulted in empty text.")
+        return dict(NOT_RESTAURANT, extracted_text=""), 200
+
+    is_restaurant_flag = restaurant_classifier.local_verdict(extracted_text, llm_router.classify)
+    if is_restaurant_flag is False:
+        return dict(NOT_RESTAURANT, extracted_text=extracted_text), 200
+    parsed_receipt = rule_parser.parse(extracted_text)
+    restaurant_task = extraction_task = None
+    if is_restaurant_flag is None:
+        restaurant_task = asyncio.ensure_future(restaurant_classifier.llm_verdict_async(extracted_text, llm_router.classify_async))
+    if parsed_receipt is None and (POSTOCR_SPECULATIVE or restaurant_task is None):
+        extraction_task = asyncio.ensure_future(extract_positions_and_total_async(extracted_text))
+
+    if restaurant_task is not None:
+        is_restaurant_flag = await restaurant_task
+    if is_restaurant_flag is False:
+        if extraction_task is not None:
+            extraction_task.cancel()
+        logger.info("Image determined not to be a restaurant check.")
+        return dict(NOT_RESTAURANT, extracted_text=extracted_text), 200
+    if is_restaurant_flag is None:
+        logger.error("Failed to determine if image is a restaurant check.")
+
+    if parsed_receipt is not None:
+        positions_data, total_amount = parsed_receipt.positions, parsed_receipt.total_amount
+    else:
+        positions_data, total_amount = await (extraction_task or extract_positions_and_total_async(extracted_text))
+    response_data = build_restaurant_response(extracted_text, positions_data, total_amount)
+    logger.info(f"Preprocess successful (async). is_restaurant=True, items={len(response_data['positions_list'])}, total_amount={total_amount}")
+    return response_data, 200
+
+
+async def run_receipt_pipeline_async(image_bytes: bytes, filename: str, cache_key: str) -> Tuple[Dict, int]:
+    """Как run_receipt_pipeline в app.py: нормализация, проверка похожих чеков и конвейер модели."""
+    logger.info(f"Image {filename} received ({len(image_bytes)} bytes).")
+    ocr_bytes, ocr_filename = await asyncio.to_thread(prepare_image_for_ocr, image_bytes, filename)
+    near_match = await asyncio.to_thread(near_duplicates.lookup, ocr_bytes)
+    extracted_text = None
+    tiles = await asyncio.to_thread(tiled_ocr.split, image_bytes, filename, ocr_bytes)
+    if tiles is not None: # Длинный чек: полосы распознаются одновременно
+        extracted_text = await tiled_ocr.read_async(tiles, llm_router.ocr_async)
+    if near_match.candidates: # Как reuse_near_duplicate в app.py: OCR и сравнение итогов
+        if extracted_text is None:
+            extracted_text = await llm_router.ocr_async(ocr_bytes, ocr_filename)
+        near_data = near_duplicates.confirm(near_match, extracted_text) if extracted_text is not None else None
+        if near_data is not None:
+            return await asyncio.to_thread(finish_receipt_result, near_data, 200, cache_key)
+
+    pipeline_mode = effective_pipeline_mode(extracted_text)
+    if pipeline_mode == "multi":
+        response_data, status_code = await run_multi_call_pipeline_async(ocr_bytes, ocr_filename, extracted_text)
+    else:
+        response_data, status_code = await run_fused_pipeline_async(ocr_bytes, ocr_filename)
+    if status_code == 200:
+        near_duplicates.add(near_match, response_data)
+    return await asyncio.to_thread(finish_receipt_result, response_data, status_code, cache_key, pipeline_mode)
+
+
+# --- Маршруты ---
+# Проверка загрузки (декодирование и оценка резкости), хэш и чтение/запись кэша на диске, сессии и общее
+# хранилище (SQLite) блокируют поток - они выполняются в пуле потоков, чтобы не останавливать event loop
+async def preprocess_receipt_async(scope, body: bytes) -> Tuple[Dict, int]:
+    image_file = parse_multipart(scope, body).files.get('receipt_image')
+    if not image_file:
+        logger.warning("Preprocess request failed: No image file provided.")
+        return {'error': 'No image file provided'}, 400
+
+    original_filename = image_file.filename
+    try:
+        image_bytes = image_file.read()
+        rejection = await asyncio.to_thread(admit_upload, image_bytes)
+        if rejection is not None:
+            return rejection
+        cache_key, cached_data = await asyncio.to_thread(lookup_cached_receipt, image_bytes)
+        if cached_data is not None:
+            return await asyncio.to_thread(attach_receipt_session, cached_data, 200), 200
+
+        if shared_store is None:
+            response_data, status_code = await run_receipt_pipeline_async(image_bytes, original_filename, cache_key)
+        else: # Как process_receipt_image в app.py: тот же чек в другом процессе ждем в общем хранилище
+            (response_data, status_code), source = await shared_store.get_or_compute_async(
+                f"receipt:{cache_key}", lambda: run_receipt_pipeline_async(image_bytes, original_filename, cache_key),
+                encode_receipt_result, decode_receipt_result, SHARED_STORE_TTL)
+            if source != "computed":
+                await asyncio.to_thread(receipt_cache.put, cache_key, response_data)
+                response_data['cache_hit'] = True
+        return await asyncio.to_thread(attach_receipt_session, response_data, status_code), status_code
+
+    except Exception as e:
+        logger.error(f"Error during async preprocess_receipt: {e}", exc_info=True)
+        return {'error': 'An internal server error occurred during preprocessing.'}, 500
+
+async def calculate_split_async(scope, body: bytes) -> Tuple[Dict, int]:
+    try:
+        split_request, early_response = await asyncio.to_thread(parse_split_request, json.loads(body) if body else None)
+        if early_response is not None:
+            return early_response
+
+        recommendations = await asyncio.to_thread(compute_split_locally, split_request)
+        if recommendations is None and split_request.llm_fallback_allowed:
+            logger.warning("Local split failed, falling back to LLM recommendations.")
+            recommendations = await llm_router.split_async(split_request.extracted_text, split_request.num_people,
+                                                           split_request.tea_money, split_request.item_assignments)
+        return await asyncio.to_thread(finish_split, split_request, recommendations)
+
+    except Exception as e:
+        logger.error(f"Error during async calculate_split: {e}", exc_info=True)
+        return {'error': 'An internal server error occurred during calculation.'}, 500
+
+ASYNC_ROUTES = {
+    ("POST", "/preprocess_receipt"): preprocess_receipt_async,
+    ("POST", "/calculate_split"): calculate_split_async,
+}
+
+
+# --- ASGI ---
+def parse_multipart(scope, body: bytes) -> InMemoryUploadRequest:
+    """Разбирает multipart/form-data тем же классом запроса, что и Flask (файлы в памяти)."""
+    headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "PATH_INFO": scope["path"],
+        "CONTENT_TYPE": headers.get("content-type", ""),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "SERVER_NAME": host,
+        "SERVER_PORT": str(port),
+    }
+    return InMemoryUploadRequest(environ)
+
+def content_length(scope) -> Optional[int]:
+    for name, value in scope["headers"]:
+        if name == b"content-length":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+async def read_body(receive) -> Optional[bytes]:
+    """Тело запроса или None, если оно больше ASGI_MAX_BODY_BYTES."""
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return b""
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > ASGI_MAX_BODY_BYTES:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+async def send_json(send, data: Dict, status_code: int) -> None:
+    payload = (app.json.dumps(data) + "\n").encode("utf-8")
+    await send({"type": "http.response.start", "status": status_code,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())]})
+    await send({"type": "http.response.body", "body": payload})
+
+async def lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            asyncio.get_running_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=ASGI_SYNC_THREADS, thread_name_prefix="asgi-sync"))
+            if not _warmup_on_listen:
+                startup_profile.start_warmup(warmup_tasks)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await aclose_registry_async()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def application(scope, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    handler = ASYNC_ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if handler is None:
+        await flask_application(scope, receive, send)
+        return
+    declared_length = content_length(scope)
+    body = await read_body(receive) if declared_length is None or declared_length <= ASGI_MAX_BODY_BYTES else None
+    if body is None:
+        # Тело больше лимита: по Content-Length - не читая его, без заголовка - как только превышен лимит
+        await send_json(send, *upload_admission.reject_request(declared_length).response())
+        return
+    response_data, status_code = await handler(scope, body)
+    await send_json(send, response_data, status_code)
+
+
+async def serve() -> None:
+    """uvicorn в текущем event loop; прогрев (STARTUP_WARMUP) начинается, когда порт уже открыт."""
+    import uvicorn # Нужен только при запуске через этот файл
+
+    server = uvicorn.Server(uvicorn.Config(application, host=host, port=port, access_log=env == "dev"))
+
+    async def warm_up_when_listening():
+        while not server.started and not server.should_exit:
+            await asyncio.sleep(0.01)
+        startup_profile.mark("listening")
+        startup_profile.start_warmup(warmup_tasks)
+
+    warmup_waiter = asyncio.ensure_future(warm_up_when_listening())
+    try:
+        await server.serve()
+    finally:
+        warmup_waiter.cancel()
+
+
+if __name__ == '__main__':
+    _warmup_on_listen = True
+    if env == "dev":
+        print(f"🔧 Запуск (ASGI) в режиме разработки на http://127.0.0.1:{port}")
+        host = "0.0.0.0"
+    else:
+        print(f"🚀 Запуск (ASGI) в продакшн на http://{host}:{port} через uvicorn")
+    asyncio.run(serve())
@@ -0,0 +1,413 @@
+# --- START OF FILE gemini_backend.py ---
+# Функции работы с Gemini (перенесены из app.py) и бэкенд Gemini для маршрутизатора LLM
+
+from pydantic import ValidationError
+from typing import Dict, Iterator, List, Optional
+import logging
+import json
+import re
+import time
+
+from models import RestaurantCheckResult, Positions, Recommendation
+from gemini_clients import init_registry, get_registry, generation_config
+from ocr_module import (process_image_with_gemini, extract_receipt_with_gemini, extract_receipt_stream_with_gemini,
+                        stream_chunk_text, process_image_with_gemini_async, extract_receipt_with_gemini_async,
+                        generate_content_async)
+from prompts import (build_restaurant_check_prompt, build_positions_prompt, build_total_amount_prompt,
+                     build_recommendations_prompt, RECOMMENDATION_RESPONSE_SCHEMA)
+from llm_backends import LLMBackend, clean_position_names
+from gemini_governor import get_governor
+from metrics import timed_stage, observe_stage
+
+logger = logging.getLogger(__name__)
+
+GEMINI_MODEL_NAME = "models/gemini-2.0-flash"
+
+# --- Настройка Gemini: общий для процесса реестр клиентов (gemini_clients.py) ---
+def get_gemini_model(model_name=GEMINI_MODEL_NAME):
+    # Модель создается один раз и переиспользуется всеми потоками
+    return get_registry().generative_model(model_name)
+
+# --- Новая функция для проверки ---
+@timed_stage("classify")
+def is_restaurant_check(extracted_text: str) -> Optional[bool]:
+    """
+    Проверяет, является ли текст чеком из ресторана, используя Gemini.
+    """
+    if not extracted_text:
+        logger.warning("No extracted text provided to is_restaurant_check.")
+        return False # Считаем, что пустой текст - не чек
+
+    prompt = build_restaurant_check_prompt(extracted_text)
+    try:
+        model = get_gemini_model() # Используем flash по умолчанию
+        # Квота, повторы при 429/5xx и объединение одинаковых запросов - в gemini_governor.py
+        response = get_governor().call(
+            "classify", GEMINI_MODEL_NAME, model.generate_content,
+            prompt,
+            generation_config=generation_config(
+                response_mime_type="application/json",
+                response_schema=RestaurantCheckResult # Используем новую простую модель
+            ),
+            dedupe_key=prompt,
+        )
+        return _parse_restaurant_check(response)
+
+    except Exception as e:
+        logger.error(f"Error during Gemini API call for restaurant check: {e}", exc_info=True)
+        return None
+
+@timed_stage("classify")
+async def is_restaurant_check_async(extracted_text: str) -> Optional[bool]:
+    """is_restaurant_check через асинхронный клиент google.genai (ASGI-режим)."""
+    if not extracted_text:
+        logger.warning("No extracted text provided to is_restaurant_check_async.")
+        return False
+
+    prompt = build_restaurant_check_prompt(extracted_text)
+    try:
+        response = await generate_content_async("classify", prompt, response_schema=RestaurantCheckResult, dedupe_key=prompt)
+        return _parse_restaurant_check(response)
+    except Exception as e:
+        logger.error(f"Error during async Gemini API call for restaurant check: {e}", exc_info=True)
+        return None
+
+def _parse_restaurant_check(response) -> Optional[bool]:
+    # Парсинг и валидация
+    if hasattr(response, 'candidates') and response.candidates and hasattr(response.candidates[0], 'content') and hasattr(response.candidates[0].content, 'parts') and response.candidates[0].content.parts:
+         json_text = response.candidates[0].content.parts[0].text
+         logger.info(f"Received JSON from Gemini for restaurant check: {json_text}")
+         parsed_data = json.loads(json_text)
+         try:
+             check_result = RestaurantCheckResult(**parsed_data)
+             logger.info(f"Restaurant check result: {check_result.is_restaurant}")
+             return check_result.is_restaurant
+         except ValidationError as e:
+             logger.error(f"Pydantic validation failed for restaurant check: {e}. JSON: {json_text}")
+             return None # Ошибка валидации
+    elif response.text: # Fallback
+         try:
+             logger.info(f"Trying to parse restaurant check from response.text: {response.text}")
+             parsed_data = json.loads(response.text)
+             check_result = RestaurantCheckResult(**parsed_data)
+             logger.info(f"Restaurant check result from response.text: {check_result.is_restaurant}")
+             return check_result.is_restaurant
+         except Exception as parse_err:
+             logger.error(f"Failed to parse JSON restaurant check from response.text: {parse_err}")
+             return None
+    else:
+         logger.error("No usable content found in Gemini response for restaurant check.")
+         return None
+
+# --- Обновленная функция get_positions (только позиции) ---
+@timed_stage("positions")
+def get_positions(extracted_text: str) -> Optional[Positions]:
+    if not extracted_text:
+        logger.warning("No extracted text provided to get_positions.")
+        return Positions(positions_list=[]) # Возвращаем пустой список
+
+    prompt = build_positions_prompt(extracted_text)
+    try:
+        model = get_gemini_model()
+        response = get_governor().call(
+            "positions", GEMINI_MODEL_NAME, model.generate_content,
+            prompt,
+            generation_config=generation_config(
+                response_mime_type="application/json",
+                # response_schema=Positions # Можно использовать Pydantic модель
+            ),
+            dedupe_key=prompt,
+        )
+        return _parse_positions(response)
+
+    except Exception as e:
+        logger.error(f"Error during Gemini API call or processing for positions: {e}", exc_info=True)
+        return None
+
+@timed_stage("positions")
+async def get_positions_async(extracted_text: str) -> Optional[Positions]:
+    """get_positions через асинхронный клиент google.genai (ASGI-режим)."""
+    if not extracted_text:
+        logger.warning("No extracted text provided to get_positions_async.")
+        return Positions(positions_list=[])
+
+    prompt = build_positions_prompt(extracted_text)
+    try:
+        response = await generate_content_async("positions", prompt, dedupe_key=prompt)
+        return _parse_positions(response)
+    except Exception as e:
+        logger.error(f"Error during async Gemini API call or processing for positions: {e}", exc_info=True)
+        return None
+
+def _parse_positions(response) -> Optional[Positions]:
+    positions_obj: Optional[Positions] = None
+
+    # --- Логика парсинга ответа (остается похожей, но ожидает только positions_list) ---
+    if hasattr(response, 'text') and response.text:
+         json_text = response.text
+         logger.info(f"Received JSON from Gemini for positions: {json_text[:500]}...")
+         # Удаляем возможные артефакты ```json ... ```
+         cleaned_json_text = re.sub(r'^```json\s*|\s*```$', '', json_text, flags=re.MULTILINE | re.DOTALL).strip()
+         try:
+             parsed_data = json.loads(cleaned_json_text)
+             # Валидируем структуру с помощью Pydantic
+             positions_obj = Positions(**parsed_data)
+             logger.info(f"Successfully parsed positions: {len(positions_obj.positions_list)} items")
+
+         except (json.JSONDecodeError, ValidationError) as e:
+             logger.error(f"Pydantic validation or JSON parsing failed for positions: {e}. JSON: {cleaned_json_text}")
+             return None # Ошибка валидации или парсинга, выходим
+    else:
+         logger.error("No usable content found in Gemini response for positions.")
+         return None # Нет данных от модели, выходим
+
+    # --- Очистка имен позиций (остается без изменений) ---
+    return clean_position_names(positions_obj)
+
+def get_positions_stream(extracted_text: str) -> Iterator[str]:
+    """Потоковый вариант get_positions: отдает JSON ответа модели по мере генерации."""
+    if not extracted_text:
+        logger.warning("No extracted text provided to get_positions_stream.")
+        yield json.dumps({"positions_list": []})
+        return
+
+    prompt = build_positions_prompt(extracted_text)
+    started_at = time.perf_counter()
+    produced = False
+    try:
+        model = get_gemini_model()
+        chunks = get_governor().stream(
+            "positions", GEMINI_MODEL_NAME, model.generate_content,
+            prompt,
+            generation_config=generation_config(response_mime_type="application/json"),
+        )
+        for chunk in chunks:
+            text = stream_chunk_text(chunk)
+            if text:
+                produced = True
+                yield text
+    finally:
+        observe_stage("positions", time.perf_counter() - started_at, failed=not produced)
+
+# --- Новая функция get_total_amount (как ты предложил) ---
+@timed_stage("total", failed=lambda amount: not amount) # 0 - ошибка извлечения
+def get_total_amount(extracted_text: str) -> int:
+    """Извлекает итоговую сумму из текста чека как целое число."""
+    if not extracted_text:
+        logger.warning("No extracted text provided to get_total_amount.")
+        return 0
+
+    prompt = build_total_amount_prompt(extracted_text)
+
+    try:
+        model = get_gemini_model()
+        response = get_governor().call(
+            "total", GEMINI_MODEL_NAME, model.generate_content,
+            prompt,
+            generation_config=generation_config(
+                response_mime_type="application/json",
+                # response_schema={"type": "object", "properties": {"total_amount": {"type": "integer"}}} # Можно указать схему
+            ),
+            dedupe_key=prompt,
+        )
+        return _parse_total_amount(response)
+
+    except Exception as e:
+        logger.error(f"Error during Gemini API call for total amount: {e}", exc_info=True)
+        return 0
+
+@timed_stage("total", failed=lambda amount: not amount)
+async def get_total_amount_async(extracted_text: str) -> int:
+    """get_total_amount через асинхронный клиент google.genai (ASGI-режим)."""
+    if not extracted_text:
+        logger.warning("No extracted text provided to get_total_amount_async.")
+        return 0
+
+    prompt = build_total_amount_prompt(extracted_text)
+    try:
+        response = await generate_content_async("total", prompt, dedupe_key=prompt)
+        return _parse_total_amount(response)
+    except Exception as e:
+        logger.error(f"Error during async Gemini API call for total amount: {e}", exc_info=True)
+        return 0
+
+def _parse_total_amount(response) -> int:
+    # Парсинг ответа
+    if hasattr(response, 'text') and response.text:
+        json_text = response.text
+        logger.info(f"Received JSON from Gemini for total amount: {json_text}")
+        # Удаляем возможные артефакты ```json ... ```
+        cleaned_json_text = re.sub(r'^```json\s*|\s*```$', '', json_text, flags=re.MULTILINE | re.DOTALL).strip()
+        try:
+            parsed_data = json.loads(cleaned_json_text)
+            total_amount = parsed_data.get("total_amount")
+            if isinstance(total_amount, int):
+                logger.info(f"Successfully parsed total amount: {total_amount}")
+                return total_amount
+            elif isinstance(total_amount, (float, str)): # Попытка преобразовать, если пришло не int
+                try:
+                    amount_int = int(round(float(str(total_amount).replace(',','.'))))
+                    logger.warning(f"Parsed total_amount was not int ({type(total_amount)}), converted to: {amount_int}")
+                    return amount_int
+                except (ValueError, TypeError):
+                     logger.error(f"Could not convert parsed total_amount '{total_amount}' to int.")
+                     return 0
+            else:
+                logger.error("Field 'total_amount' is missing or not a number in parsed data.")
+                return 0
+        except (json.JSONDecodeError, ValidationError) as e:
+            logger.error(f"JSON parsing or validation failed for total amount: {e}. JSON: {cleaned_json_text}")
+            return 0
+    else:
+        logger.error("No usable content found in Gemini response for total amount.")
+        return 0
+
+
+# --- Обновленная функция get_recommendations ---
+@timed_stage("split")
+def get_recommendations(extracted_text: str, num_people: int, tea_money: float, item_assignments: Dict[str, List[str]]) -> Optional[Recommendation]:
+    if not extracted_text or num_people <= 0:
+        logger.warning("Invalid input for get_recommendations.")
+        return None
+
+    prompt = build_recommendations_prompt(extracted_text, num_people, tea_money, item_assignments)
+    # --- КОНЕЦ ОБНОВЛЕННОГО ПРОМПТА ---
+    try:
+        client = get_registry().genai_client()
+
+        response = get_governor().call(
+            "split", 'gemini-2.0-flash', client.models.generate_content,
+            model='gemini-2.0-flash',
+            contents=prompt,
+            config={
+                'response_mime_type': 'application/json',
+                'response_schema': RECOMMENDATION_RESPONSE_SCHEMA,
+            },
+            dedupe_key=prompt,
+        )
+        return _parse_recommendation(response)
+
+    except Exception as e:
+        logger.error(f"Error during Gemini API call for recommendations: {e}", exc_info=True)
+        return None
+
+@timed_stage("split")
+async def get_recommendations_async(extracted_text: str, num_people: int, tea_money: float, item_assignments: Dict[str, List[str]]) -> Optional[Recommendation]:
+    """get_recommendations через асинхронный клиент google.genai (ASGI-режим)."""
+    if not extracted_text or num_people <= 0:
+        logger.warning("Invalid input for get_recommendations_async.")
+        return None
+
+    prompt = build_recommendations_prompt(extracted_text, num_people, tea_money, item_assignments)
+    try:
+        response = await generate_content_async("split", prompt, response_schema=RECOMMENDATION_RESPONSE_SCHEMA, dedupe_key=prompt)
+        return _parse_recommendation(response)
+    except Exception as e:
+        logger.error(f"Error during async Gemini API call for recommendations: {e}", exc_info=True)
+        return None
+
+def _parse_recommendation(response) -> Optional[Recommendation]:
+    try:
+        # Попытка получить объект Recommendation вручную
+        logger.info("Direct parsing of Recommendation object.")
+        raw_text = None
+
+        # Извлекаем текстовый ответ
+        if hasattr(response, 'text') and response.text:
+            raw_text = response.text
+        elif (hasattr(response, 'candidates') and response.candidates and 
+            hasattr(response.candidates[0], 'content') and hasattr(response.candidates[0].content, 'parts') and 
+            response.candidates[0].content.parts):
+            raw_text = response.candidates[0].content.parts[0].text
+
+        if raw_text:
+            logger.info(f"Raw response text received: {raw_text[:1000]}...")
+            # Удаляем возможные артефакты ```json ... ```
+            cleaned_json_text = re.sub(r'^```json\s*|\s*```$', '', raw_text, flags=re.MULTILINE | re.DOTALL).strip()
+            # Попытка распарсить JSON вручную
+            try:
+                parsed_data = json.loads(cleaned_json_text)
+
+                # Создаем объект через Pydantic
+                recommendation_obj = Recommendation(**parsed_data)
+
+            except (json.JSONDecodeError, ValidationError) as parse_err:
+                logger.error(f"Failed to parse response into Recommendation: {parse_err}. JSON: {cleaned_json_text}")
+                return None
+        else:
+            logger.error("Could not retrieve raw response text.")
+            return None
+
+
+        # Проверяем список людей
+        if not isinstance(recommendation_obj.peoples_list, list):
+            logger.warning("Parsed 'peoples_list' is not a list. Setting to empty list.")
+            recommendation_obj.peoples_list = []
+
+        logger.info(f"Successfully accessed parsed recommendations. People count: {len(recommendation_obj.peoples_list)}")
+
+        return recommendation_obj
+
+    except Exception as e:
+        logger.error(f"Error while parsing Gemini recommendations: {e}", exc_info=True)
+        return None
+
+
+class GeminiBackend(LLMBackend):
+    """Бэкенд Google Gemini: OCR через ocr_module, текстовые шаги - функции выше."""
+    name = "gemini"
+
+    def __init__(self):
+        # Реестр клиентов создается при старте, сами SDK импортируются при первом обращении (см. gemini_clients.py)
+        init_registry()
+
+    def warm_up(self):
+        registry = get_registry()
+        get_gemini_model()
+        from google.generativeai import client as genai_client_manager
+        genai_client_manager.get_default_generative_client() # Транспорт, который GenerativeModel создает при первом запросе
+        registry.genai_client()
+
+    def ocr(self, image_bytes, filename):
+        return process_image_with_gemini(image_bytes, filename)
+
+    def extract_receipt(self, image_bytes, filename):
+        return extract_receipt_with_gemini(image_bytes, filename)
+
+    def classify(self, extracted_text):
+        return is_restaurant_check(extracted_text)
+
+    def extract_positions(self, extracted_text):
+        return get_positions(extracted_text)
+
+    def extract_receipt_stream(self, image_bytes, filename):
+        return extract_receipt_stream_with_gemini(image_bytes, filename)
+
+    def extract_positions_stream(self, extracted_text):
+        return get_positions_stream(extracted_text)
+
+    def extract_total(self, extracted_text):
+        # get_total_amount возвращает 0 и при ошибке - даем маршрутизатору попробовать другой бэкенд
+        return get_total_amount(extracted_text) or None
+
+    def split(self, extracted_text, num_people, tea_money, item_assignments):
+        return get_recommendations(extracted_text, num_people, tea_money, item_assignments)
+
+    # Асинхронные варианты (ASGI-режим): клиент google.genai.aio, без потока на каждый вызов
+    async def ocr_async(self, image_bytes, filename):
+        return await process_image_with_gemini_async(image_bytes, filename)
+
+    async def extract_receipt_async(self, image_bytes, filename):
+        return await extract_receipt_with_gemini_async(image_bytes, filename)
+
+    async def classify_async(self, extracted_text):
+        return await is_restaurant_check_async(extracted_text)
+
+    async def extract_positions_async(self, extracted_text):
+        return await get_positions_async(extracted_text)
+
+    async def extract_total_async(self, extracted_text):
+        return await get_total_amount_async(extracted_text) or None
+
+    async def split_async(self, extracted_text, num_people, tea_money, item_assignments):
+        return await get_recommendations_async(extracted_text, num_people, tea_money, item_assignments)
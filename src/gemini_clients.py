@@ -0,0 +1,169 @@
+# --- START OF FILE gemini_clients.py ---
+
+import logging
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+if TYPE_CHECKING: # SDK импортируются при первом обращении к модели (холодный старт без ~0.7 с импорта)
+    import google.generativeai as genai
+    from google import genai as genai_module
+
+logger = logging.getLogger(__name__)
+
+# Размер пула keep-alive соединений клиента google.genai (httpx)
+GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", 32))
+GEMINI_MAX_KEEPALIVE = int(os.getenv("GEMINI_MAX_KEEPALIVE", 16))
+# Пул асинхронного клиента (ASGI-режим): одно соединение на каждый одновременный вызов модели
+GEMINI_ASYNC_MAX_CONNECTIONS = int(os.getenv("GEMINI_ASYNC_MAX_CONNECTIONS", 512))
+GEMINI_ASYNC_MAX_KEEPALIVE = int(os.getenv("GEMINI_ASYNC_MAX_KEEPALIVE", 64))
+# Альтернативный адрес API (например, локальная заглушка из benchmarks/fake_gemini_server.py)
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+
+
+def generation_config(**kwargs) -> Any:
+    """genai.types.GenerationConfig без импорта google.generativeai при загрузке модулей."""
+    import google.generativeai as genai
+    return genai.types.GenerationConfig(**kwargs)
+
+
+class GeminiClientRegistry:
+    """
+    Общие для процесса клиенты Gemini.
+
+    genai.configure вызывается один раз, GenerativeModel создается один раз на модель
+    (он держит долгоживущий канал к API), а клиент google.genai использует
+    пул keep-alive соединений httpx. Безопасен для потоков waitress.
+    SDK импортируются и настраиваются при первом обращении (или в прогреве после старта).
+    """
+
+    def __init__(self, api_key: Optional[str]):
+        self._api_key = api_key
+        self._lock = threading.Lock()
+        self._models: Dict[str, "genai.GenerativeModel"] = {}
+        self._genai_client: Optional["genai_module.Client"] = None
+        self._configured = False
+        self._closed = False
+        if not api_key:
+            logger.error("GOOGLE_API_KEY environment variable not set.")
+
+    def _require_api_key(self):
+        if not self._api_key:
+            logger.error("GOOGLE_API_KEY environment variable not set.")
+            raise ValueError("API key not configured.")
+        if self._closed:
+            raise RuntimeError("Gemini client registry is shut down.")
+
+    def generativeai(self) -> "genai":
+        """Модуль google.generativeai после genai.configure (для GenerativeModel и Files API)."""
+        if self._configured:
+            import google.generativeai as genai
+            return genai
+        with self._lock:
+            self._require_api_key()
+            import google.generativeai as genai
+            if not self._configured:
+                if GEMINI_API_ENDPOINT:
+                    genai.configure(api_key=self._api_key, transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+                    logger.info(f"Gemini API endpoint overridden: {GEMINI_API_ENDPOINT}")
+                else:
+                    genai.configure(api_key=self._api_key)
+                self._configured = True
+            return genai
+
+    def generative_model(self, model_name: str = "models/gemini-2.0-flash") -> "genai.GenerativeModel":
+        """Возвращает общий GenerativeModel для model_name (создает при первом обращении)."""
+        model = self._models.get(model_name)
+        if model is not None:
+            return model
+        genai = self.generativeai()
+        with self._lock:
+            self._require_api_key()
+            model = self._models.get(model_name)
+            if model is None:
+                model = genai.GenerativeModel(model_name)
+                self._models[model_name] = model
+                logger.info(f"Created shared GenerativeModel for {model_name}.")
+            return model
+
+    def genai_client(self) -> "genai_module.Client":
+        """Возвращает общий клиент google.genai с пулом соединений (асинхронный вариант - .aio)."""
+        if self._genai_client is not None:
+            return self._genai_client
+        with self._lock:
+            self._require_api_key()
+            if self._genai_client is None:
+                import httpx
+                from google import genai as genai_module
+                limits = httpx.Limits(max_connections=GEMINI_MAX_CONNECTIONS, max_keepalive_connections=GEMINI_MAX_KEEPALIVE)
+                async_limits = httpx.Limits(max_connections=GEMINI_ASYNC_MAX_CONNECTIONS, max_keepalive_connections=GEMINI_ASYNC_MAX_KEEPALIVE)
+                self._genai_client = genai_module.Client(
+                    api_key=self._api_key,
+                    http_options=genai_module.types.HttpOptions(client_args={"limits": limits}, async_client_args={"limits": async_limits},
+                                                                base_url=GEMINI_API_ENDPOINT),
+                )
+                logger.info("Created shared google.genai client.")
+            return self._genai_client
+
+    async def aclose_async(self) -> None:
+        """Закрывает соединения асинхронного клиента (вызывать из того же event loop до shutdown())."""
+        client = self._genai_client
+        if client is not None:
+            try:
+                await client.aio.aclose()
+            except Exception as e:
+                logger.error(f"Error closing async google.genai client: {e}")
+
+    def shutdown(self) -> None:
+        """Закрывает соединения клиентов. После вызова реестр использовать нельзя."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._genai_client is not None:
+                try:
+                    self._genai_client.close()
+                except Exception as e:
+                    logger.error(f"Error closing google.genai client: {e}")
+                self._genai_client = None
+            if self._models:
+                try:
+                    from google.generativeai import client as genai_client_manager
+                    genai_client_manager.get_default_generative_client().transport.close()
+                except Exception as e:
+                    logger.error(f"Error closing GenerativeModel transport: {e}")
+                self._models.clear()
+        logger.info("Gemini client registry shut down.")
+
+
+_registry: Optional[GeminiClientRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def init_registry(api_key: Optional[str] = None) -> GeminiClientRegistry:
+    """Создает общий реестр клиентов (вызывается один раз при старте приложения)."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = GeminiClientRegistry(api_key or os.getenv('GOOGLE_API_KEY'))
+        return _registry
+
+
+def get_registry() -> GeminiClientRegistry:
+    """Возвращает общий реестр клиентов, создавая его при необходимости."""
+    return _registry if _registry is not None else init_registry()
+
+
+def shutdown_registry() -> None:
+    """Закрывает общий реестр клиентов, если он был создан."""
+    global _registry
+    with _registry_lock:
+        if _registry is not None:
+            _registry.shutdown()
+            _registry = None
+
+
+async def aclose_registry_async() -> None:
+    """Закрывает асинхронный клиент общего реестра, если реестр был создан (остановка ASGI-сервера)."""
+    if _registry is not None:
+        await _registry.aclose_async()
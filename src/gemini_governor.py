@@ -0,0 +1,352 @@
+# --- START OF FILE gemini_governor.py ---
+# Общий "регулятор" запросов к Gemini: квота по моделям, повторы с джиттером и объединение одинаковых запросов
+
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Iterator, Optional, Tuple, TypeVar, Union
+
+import httpx
+import requests
+
+from metrics import record_token_usage, record_governor_event
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Коды ответа, после которых запрос имеет смысл повторить (квота и временные ошибки сервера)
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+_RETRYABLE_TRANSPORT_ERRORS = (ConnectionError, TimeoutError, httpx.TransportError,
+                               requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+class QuotaWaitTimeout(Exception):
+    """Свободная квота модели не появилась в пределах бюджета времени запроса."""
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """429/5xx от google.api_core и google.genai (атрибут code) или сетевой сбой."""
+    try:
+        code = int(getattr(error, "code", None))
+    except (TypeError, ValueError):
+        code = None
+    return code in RETRYABLE_STATUS_CODES or isinstance(error, _RETRYABLE_TRANSPORT_ERRORS)
+
+
+def normalize_model_name(model_name: str) -> str:
+    """"models/gemini-2.0-flash" и "gemini-2.0-flash" - одна и та же квота."""
+    return model_name[len("models/"):] if model_name.startswith("models/") else model_name
+
+
+class TokenBucket:
+    """Ведро токенов: rate_per_minute запросов в минуту с запасом burst на всплески."""
+
+    def __init__(self, rate_per_minute: float, burst: int):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Берет токен, если он есть (0.0), иначе возвращает, сколько секунд ждать следующего."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate_per_second)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate_per_second if self.rate_per_second > 0 else float("inf")
+
+    def acquire(self, deadline: float) -> bool:
+        """Берет токен, ожидая его не дольше deadline (time.monotonic()). False - не дождались."""
+        while True:
+            wait = self._reserve()
+            if not wait:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, deadline: float) -> bool:
+        """acquire() для event loop: ожидание не занимает поток."""
+        while True:
+            wait = self._reserve()
+            if not wait:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+    def penalize(self) -> None:
+        """Сервер ответил 429 - квота исчерпана раньше, чем считало ведро: забираем запас."""
+        with self._lock:
+            self._tokens = min(self._tokens, 0.0)
+
+
+class GeminiGovernor:
+    """
+    Все вызовы моделей Gemini проходят через call():
+    1. single-flight: одинаковый запрос (тот же этап и dedupe_key), уже выполняющийся
+       в другом потоке, не отправляется повторно - ждем и берем его ответ;
+    2. квота: перед каждой попыткой берется токен из ведра модели (rate_limits);
+    3. повторы: 429/5xx и сетевые сбои повторяются с экспоненциальной задержкой
+       и полным джиттером, пока укладываемся в budget_seconds и max_retries.
+    call_async() делает то же для корутин (асинхронный клиент google.genai в ASGI-режиме),
+    stream() - для потоковых ответов (generate_content(stream=True)).
+    """
+
+    def __init__(self, rate_limits: Dict[str, float], default_rpm: float, burst: int,
+                 max_retries: int, budget_seconds: float, backoff_base: float, backoff_max: float):
+        self.rate_limits = {normalize_model_name(name): rpm for name, rpm in rate_limits.items()}
+        self.default_rpm = default_rpm
+        self.burst = burst
+        self.max_retries = max_retries
+        self.budget_seconds = budget_seconds
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._in_flight: Dict[Tuple[str, str], Future] = {}
+        self._in_flight_async: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._stats = {"calls": 0, "coalesced": 0, "retries": 0, "throttled": 0, "quota_timeouts": 0, "failed": 0}
+
+    def _bucket(self, model_name: str) -> TokenBucket:
+        model_name = normalize_model_name(model_name)
+        with self._lock:
+            bucket = self._buckets.get(model_name)
+            if bucket is None:
+                bucket = TokenBucket(self.rate_limits.get(model_name, self.default_rpm), self.burst)
+                self._buckets[model_name] = bucket
+            return bucket
+
+    def _count(self, event: str, stage: str) -> None:
+        with self._lock:
+            self._stats[event] += 1
+        record_governor_event(event, stage)
+
+    def call(self, stage: str, model_name: str, func: Callable[..., T], *args,
+             dedupe_key: Optional[Union[str, bytes]] = None, **kwargs) -> T:
+        """
+        Выполняет func(*args, **kwargs) с учетом квоты model_name и повторами.
+        dedupe_key - содержимое запроса (промпт или байты изображения) для объединения
+        одинаковых одновременных вызовов; None - не объединять.
+        Ошибки, которые не удалось преодолеть повторами, пробрасываются вызывающему.
+        """
+        if dedupe_key is None:
+            return self._call_with_retries(stage, model_name, func, args, kwargs)
+
+        key = self._dedupe_key(stage, dedupe_key)
+        with self._lock:
+            leader_future = self._in_flight.get(key)
+            if leader_future is None:
+                future = self._in_flight[key] = Future()
+        if leader_future is not None:
+            self._count("coalesced", stage)
+            logger.info(f"Coalesced identical in-flight Gemini call for {stage}.")
+            return leader_future.result()
+
+        try:
+            result = self._call_with_retries(stage, model_name, func, args, kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    async def call_async(self, stage: str, model_name: str, func: Callable[..., Awaitable[T]], *args,
+                         dedupe_key: Optional[Union[str, bytes]] = None, **kwargs) -> T:
+        """call() для корутины func: ожидание квоты и паузы между повторами не занимают поток."""
+        if dedupe_key is None:
+            return await self._call_with_retries_async(stage, model_name, func, args, kwargs)
+
+        key = self._dedupe_key(stage, dedupe_key)
+        leader_future = self._in_flight_async.get(key) # Только из потока event loop - без блокировки
+        if leader_future is not None:
+            self._count("coalesced", stage)
+            logger.info(f"Coalesced identical in-flight async Gemini call for {stage}.")
+            try:
+                return await asyncio.shield(leader_future)
+            except asyncio.CancelledError:
+                if not leader_future.cancelled():
+                    raise # Отменили сам этот запрос
+                # Запрос-лидер отменен (например, чек оказался не из ресторана) - выполняем вызов сами
+                return await self._call_with_retries_async(stage, model_name, func, args, kwargs)
+        future = self._in_flight_async[key] = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda done: done.cancelled() or done.exception()) # Без "exception was never retrieved"
+
+        try:
+            result = await self._call_with_retries_async(stage, model_name, func, args, kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._in_flight_async.pop(key, None)
+
+    def stream(self, stage: str, model_name: str, func: Callable[..., Iterator[T]], *args, **kwargs) -> Iterator[T]:
+        """
+        Фрагменты потокового ответа func(*args, stream=True, **kwargs) с учетом квоты model_name.
+        Ошибка до первого фрагмента (в том числе при самом вызове или первом чтении потока)
+        повторяется так же, как в call(). После первого фрагмента повтор продублировал бы уже
+        отданный текст, поэтому ошибка учитывается как failed и пробрасывается вызывающему.
+        Токены учитываются по последнему фрагменту.
+        """
+        bucket = self._bucket(model_name)
+        deadline = time.monotonic() + self.budget_seconds
+        attempt = 0
+        while True:
+            wait_started = time.monotonic()
+            if not bucket.acquire(deadline):
+                raise self._quota_timeout(stage, model_name)
+            self._before_attempt(stage, wait_started)
+            last_chunk = None
+            try:
+                for chunk in func(*args, stream=True, **kwargs):
+                    last_chunk = chunk
+                    yield chunk
+            except Exception as e:
+                if last_chunk is not None:
+                    self._count("failed", stage)
+                    logger.warning(f"Gemini stream for {stage} failed mid-response with {type(e).__name__}: {e}; not retrying.")
+                    raise
+                delay = self._retry_delay(stage, e, bucket, attempt, deadline)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            record_token_usage(stage, last_chunk)
+            return
+
+    @staticmethod
+    def _dedupe_key(stage: str, dedupe_key: Union[str, bytes]) -> Tuple[str, str]:
+        digest = hashlib.sha256(dedupe_key.encode("utf-8") if isinstance(dedupe_key, str) else dedupe_key).hexdigest()
+        return stage, digest
+
+    def _before_attempt(self, stage: str, wait_started: float) -> None:
+        if time.monotonic() - wait_started > 0.001:
+            self._count("throttled", stage)
+        self._count("calls", stage)
+
+    def _quota_timeout(self, stage: str, model_name: str) -> QuotaWaitTimeout:
+        self._count("quota_timeouts", stage)
+        return QuotaWaitTimeout(f"No {normalize_model_name(model_name)} quota available within {self.budget_seconds}s for {stage}.")
+
+    def _retry_delay(self, stage: str, error: Exception, bucket: TokenBucket, attempt: int, deadline: float) -> Optional[float]:
+        """Пауза перед повтором attempt+1 после error; None - ошибку нужно пробросить вызывающему."""
+        if not is_retryable_error(error):
+            return None
+        if getattr(error, "code", None) == 429:
+            bucket.penalize()
+        delay = self._random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if attempt + 1 > self.max_retries or time.monotonic() + delay >= deadline:
+            self._count("failed", stage)
+            return None
+        self._count("retries", stage)
+        logger.warning(f"Gemini call for {stage} failed with {type(error).__name__}: {error}; retry {attempt + 1}/{self.max_retries} in {delay:.2f}s.")
+        return delay
+
+    def _call_with_retries(self, stage: str, model_name: str, func: Callable[..., T], args, kwargs) -> T:
+        bucket = self._bucket(model_name)
+        deadline = time.monotonic() + self.budget_seconds
+        attempt = 0
+        while True:
+            wait_started = time.monotonic()
+            if not bucket.acquire(deadline):
+                raise self._quota_timeout(stage, model_name)
+            self._before_attempt(stage, wait_started)
+            try:
+                response = func(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(stage, e, bucket, attempt, deadline)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            record_token_usage(stage, response)
+            return response
+
+    async def _call_with_retries_async(self, stage: str, model_name: str, func: Callable[..., Awaitable[T]], args, kwargs) -> T:
+        bucket = self._bucket(model_name)
+        deadline = time.monotonic() + self.budget_seconds
+        attempt = 0
+        while True:
+            wait_started = time.monotonic()
+            if not await bucket.acquire_async(deadline):
+                raise self._quota_timeout(stage, model_name)
+            self._before_attempt(stage, wait_started)
+            try:
+                response = await func(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(stage, e, bucket, attempt, deadline)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            record_token_usage(stage, response)
+            return response
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._in_flight) + len(self._in_flight_async)
+            stats["buckets"] = {name: {"rpm": bucket.rate_per_second * 60, "burst": bucket.burst} for name, bucket in self._buckets.items()}
+        stats.update(default_rpm=self.default_rpm, max_retries=self.max_retries, budget_seconds=self.budget_seconds)
+        return stats
+
+
+def parse_rate_limits(spec: str) -> Dict[str, float]:
+    """"gemini-2.0-flash=2000,gemini-2.5-pro=150" -> {модель: запросов в минуту}."""
+    limits = {}
+    for part in spec.split(","):
+        if "=" in part:
+            name, value = part.split("=", 1)
+            limits[name.strip()] = float(value)
+    return limits
+
+
+def create_governor_from_env() -> GeminiGovernor:
+    """Создает регулятор по GEMINI_RPM, GEMINI_RATE_LIMITS и GEMINI_RETRY_*."""
+    return GeminiGovernor(
+        rate_limits=parse_rate_limits(os.getenv("GEMINI_RATE_LIMITS", "")),
+        default_rpm=float(os.getenv("GEMINI_RPM", 2000)),
+        burst=int(os.getenv("GEMINI_BURST", 20)),
+        max_retries=int(os.getenv("GEMINI_RETRY_MAX", 4)),
+        budget_seconds=float(os.getenv("GEMINI_RETRY_BUDGET_SECONDS", 20)),
+        backoff_base=float(os.getenv("GEMINI_RETRY_BACKOFF_BASE", 0.5)),
+        backoff_max=float(os.getenv("GEMINI_RETRY_BACKOFF_MAX", 8)),
+    )
+
+
+_governor: Optional[GeminiGovernor] = None
+_governor_lock = threading.Lock()
+
+
+def get_governor() -> GeminiGovernor:
+    """Общий для процесса регулятор (создается при первом обращении)."""
+    global _governor
+    if _governor is None:
+        with _governor_lock:
+            if _governor is None:
+                _governor = create_governor_from_env()
+    return _governor
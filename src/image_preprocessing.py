@@ -0,0 +1,141 @@
+# --- START OF FILE image_preprocessing.py ---
+
+import io
+import logging
+import os
+import time
+from typing import Optional, Tuple
+
+from PIL import Image, ImageFilter, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Настройки нормализации (переменные окружения IMAGE_*)
+IMAGE_NORMALIZE = os.getenv("IMAGE_NORMALIZE", "True").lower() == "true"
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", 1600))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 80))
+IMAGE_GRAYSCALE = os.getenv("IMAGE_GRAYSCALE", "True").lower() == "true"
+IMAGE_AUTOCROP = os.getenv("IMAGE_AUTOCROP", "True").lower() == "true"
+
+# Обрезка применяется, только если найденный лист занимает разумную долю кадра
+AUTOCROP_MIN_AREA = 0.2
+AUTOCROP_MAX_AREA = 0.95
+AUTOCROP_MARGIN = 0.02
+AUTOCROP_PROBE_EDGE = 256
+
+
+def _otsu_threshold(gray_image: Image.Image) -> int:
+    """Порог Оцу по гистограмме яркости (отделяет светлую бумагу от фона)."""
+    histogram = gray_image.histogram()[:256]
+    total = sum(histogram)
+    sum_all = sum(i * count for i, count in enumerate(histogram))
+    sum_background = 0
+    weight_background = 0
+    best_threshold, best_variance = 127, 0.0
+    for threshold in range(256):
+        weight_background += histogram[threshold]
+        if weight_background == 0:
+            continue
+        weight_foreground = total - weight_background
+        if weight_foreground == 0:
+            break
+        sum_background += threshold * histogram[threshold]
+        mean_background = sum_background / weight_background
+        mean_foreground = (sum_all - sum_background) / weight_foreground
+        variance = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_threshold, best_variance = threshold, variance
+    return best_threshold
+
+
+def find_paper_bbox(image: Image.Image) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Ищет на фото светлый прямоугольник чека.
+
+    Returns:
+        Tuple[int, int, int, int]: Рамка (left, upper, right, lower) в координатах
+        исходного изображения, или None, если обрезать не стоит.
+    """
+    probe = image.convert("L")
+    probe.thumbnail((AUTOCROP_PROBE_EDGE, AUTOCROP_PROBE_EDGE))
+    threshold = _otsu_threshold(probe)
+    # Бумага - светлые пиксели; MinFilter убирает мелкие блики на фоне
+    mask = probe.point(lambda value: 255 if value > threshold else 0).filter(ImageFilter.MinFilter(5))
+    bbox = mask.getbbox()
+    if not bbox:
+        return None
+
+    area_ratio = ((bbox[2] - bbox[0]) * (bbox[3] - bbox[1])) / float(probe.width * probe.height)
+    if not AUTOCROP_MIN_AREA <= area_ratio <= AUTOCROP_MAX_AREA:
+        return None
+
+    scale_x = image.width / float(probe.width)
+    scale_y = image.height / float(probe.height)
+    margin_x = int(image.width * AUTOCROP_MARGIN)
+    margin_y = int(image.height * AUTOCROP_MARGIN)
+    return (
+        max(0, int(bbox[0] * scale_x) - margin_x),
+        max(0, int(bbox[1] * scale_y) - margin_y),
+        min(image.width, int(bbox[2] * scale_x) + margin_x),
+        min(image.height, int(bbox[3] * scale_y) + margin_y),
+    )
+
+
+def load_receipt_image(image_bytes: bytes) -> Tuple[Image.Image, Tuple[int, int]]:
+    """
+    Открывает фото чека в полном разрешении: поворот по EXIF, обрезка по листу
+    (IMAGE_AUTOCROP), оттенки серого (IMAGE_GRAYSCALE). Возвращает изображение
+    и исходный размер кадра.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    image = ImageOps.exif_transpose(image)
+    if image.mode == "P":
+        image = image.convert("RGBA") # Палитра с прозрачностью иначе конвертируется с предупреждением
+    original_size = image.size
+
+    if IMAGE_AUTOCROP:
+        bbox = find_paper_bbox(image)
+        if bbox:
+            image = image.crop(bbox)
+
+    image = image.convert("L") if IMAGE_GRAYSCALE else image.convert("RGB")
+    return image, original_size
+
+
+def normalize_image(image_bytes: bytes, filename: str) -> Tuple[bytes, str]:
+    """
+    Готовит фото чека к OCR: поворот по EXIF, обрезка по листу, оттенки серого,
+    уменьшение до IMAGE_MAX_EDGE и перекодирование в JPEG с качеством IMAGE_JPEG_QUALITY.
+
+    Args:
+        image_bytes (bytes): Исходные байты изображения.
+        filename (str): Исходное имя файла.
+
+    Returns:
+        Tuple[bytes, str]: Нормализованные байты и имя файла (с расширением .jpg).
+        Если нормализация не дала выигрыша или не удалась, возвращается оригинал.
+    """
+    if not IMAGE_NORMALIZE:
+        return image_bytes, filename
+
+    started_at = time.perf_counter()
+    try:
+        image, original_size = load_receipt_image(image_bytes)
+        image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+        normalized_bytes = output.getvalue()
+    except Exception as e:
+        logger.error(f"Image normalization failed for {filename}: {e}", exc_info=True)
+        return image_bytes, filename
+
+    elapsed_ms = (time.perf_counter() - started_at) * 1000
+    if len(normalized_bytes) >= len(image_bytes):
+        logger.info(f"Image normalization skipped for {filename}: {len(normalized_bytes)} bytes >= original {len(image_bytes)} bytes ({elapsed_ms:.1f} ms).")
+        return image_bytes, filename
+
+    logger.info(f"Image normalized: {filename} {original_size[0]}x{original_size[1]} {len(image_bytes)} bytes -> "
+                f"{image.width}x{image.height} {len(normalized_bytes)} bytes in {elapsed_ms:.1f} ms.")
+    normalized_filename = f"{os.path.splitext(filename or 'image')[0]}.jpg"
+    return normalized_bytes, normalized_filename
@@ -0,0 +1,175 @@
+# --- START OF FILE job_queue.py ---
+
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+
+from metrics import observe_stage
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних задач учитывается в средних временах ожидания и выполнения
+TIMING_WINDOW = 100
+
+
+class ReceiptJob:
+    """Задача обработки чека: статус queued -> running -> done | failed."""
+
+    __slots__ = ("job_id", "status", "submitted_at", "started_at", "finished_at", "result", "status_code", "done_event", "payload")
+
+    def __init__(self, payload: Optional[Tuple] = None):
+        self.job_id = uuid.uuid4().hex
+        self.status = "queued"
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Optional[Dict] = None
+        self.status_code: Optional[int] = None
+        self.done_event = threading.Event()
+        self.payload = payload # Аргументы обработчика; освобождаются после выполнения
+
+
+class ReceiptJobQueue:
+    """
+    Очередь задач обработки чеков с ограниченным пулом потоков.
+
+    Задачи выполняются в отдельном пуле из workers потоков, поэтому потоки
+    waitress не заняты на время вызовов модели. Если в очереди уже max_queue
+    ожидающих задач, submit возвращает None (маршрут отвечает 429).
+    Завершенные задачи хранятся result_ttl_seconds, затем удаляются.
+    """
+
+    def __init__(self, handler: Callable[..., Tuple[Dict, int]], workers: int, max_queue: int, result_ttl_seconds: int):
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.result_ttl_seconds = result_ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="receipt-job")
+        self._jobs: "OrderedDict[str, ReceiptJob]" = OrderedDict() # В порядке поступления
+        self._queued: "OrderedDict[str, ReceiptJob]" = OrderedDict()
+        self._running = 0
+        self._wait_times = deque(maxlen=TIMING_WINDOW)
+        self._run_times = deque(maxlen=TIMING_WINDOW)
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "expired": 0}
+
+    def submit(self, *args) -> Optional[ReceiptJob]:
+        """Ставит задачу в очередь. None - очередь заполнена."""
+        with self._lock:
+            self._expire(time.time())
+            if len(self._queued) >= self.max_queue:
+                self._stats["rejected"] += 1
+                return None
+            job = ReceiptJob(payload=args)
+            self._jobs[job.job_id] = job
+            self._queued[job.job_id] = job
+            self._stats["submitted"] += 1
+        self._executor.submit(self._run, job)
+        return job
+
+    def add_completed(self, result: Dict, status_code: int) -> ReceiptJob:
+        """Регистрирует уже готовый результат (например, из кэша) как завершенную задачу."""
+        job = ReceiptJob()
+        job.started_at = job.finished_at = job.submitted_at
+        self._finish(job, result, status_code)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._stats["submitted"] += 1
+            self._stats["completed" if job.status == "done" else "failed"] += 1
+        return job
+
+    def _run(self, job: ReceiptJob) -> None:
+        with self._lock:
+            self._queued.pop(job.job_id, None)
+            self._running += 1
+            job.status = "running"
+            job.started_at = time.time()
+            self._wait_times.append(job.started_at - job.submitted_at)
+        observe_stage("job_queue_wait", job.started_at - job.submitted_at)
+        try:
+            result, status_code = self.handler(*job.payload)
+        except Exception as e:
+            logger.error(f"Receipt job {job.job_id} failed: {e}", exc_info=True)
+            result, status_code = {'error': 'An internal server error occurred during preprocessing.'}, 500
+        job.payload = None
+        job.finished_at = time.time()
+        self._finish(job, result, status_code)
+        with self._lock:
+            self._running -= 1
+            self._run_times.append(job.finished_at - job.started_at)
+            self._stats["completed" if job.status == "done" else "failed"] += 1
+
+    @staticmethod
+    def _finish(job: ReceiptJob, result: Dict, status_code: int) -> None:
+        job.result = result
+        job.status_code = status_code
+        job.status = "done" if status_code == 200 else "failed"
+        job.done_event.set()
+
+    def get(self, job_id: str) -> Optional[ReceiptJob]:
+        with self._lock:
+            self._expire(time.time())
+            return self._jobs.get(job_id)
+
+    def wait(self, job_id: str, timeout: float) -> Optional[ReceiptJob]:
+        """Long-poll: ждет завершения задачи не дольше timeout секунд."""
+        job = self.get(job_id)
+        if job is not None and timeout > 0:
+            job.done_event.wait(timeout)
+        return job
+
+    def queue_position(self, job: ReceiptJob) -> Optional[int]:
+        """Позиция задачи среди ожидающих (0 - следующая), None - задача уже не в очереди."""
+        with self._lock:
+            for position, job_id in enumerate(self._queued):
+                if job_id == job.job_id:
+                    return position
+        return None
+
+    def retry_after_seconds(self) -> int:
+        """Оценка, через сколько секунд в очереди освободится место."""
+        with self._lock:
+            mean_run = sum(self._run_times) / len(self._run_times) if self._run_times else 5.0
+            return max(1, math.ceil(mean_run * (len(self._queued) - self.max_queue + 1) / self.workers))
+
+    def _expire(self, now: float) -> None:
+        """Удаляет завершенные задачи старше result_ttl_seconds (вызывать под self._lock)."""
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.result_ttl_seconds]
+        for job_id in expired:
+            del self._jobs[job_id]
+        self._stats["expired"] += len(expired)
+
+    def stats(self) -> Dict:
+        """Длина очереди, занятость пула, средние ожидание и выполнение, счетчики задач."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["queue_length"] = len(self._queued)
+            stats["running"] = self._running
+            stats["workers"] = self.workers
+            stats["max_queue"] = self.max_queue
+            stats["stored_jobs"] = len(self._jobs)
+            stats["mean_wait_ms"] = round(1000 * sum(self._wait_times) / len(self._wait_times), 1) if self._wait_times else 0.0
+            stats["mean_run_ms"] = round(1000 * sum(self._run_times) / len(self._run_times), 1) if self._run_times else 0.0
+            oldest = next(iter(self._queued.values()), None)
+            stats["oldest_queued_ms"] = round(1000 * (time.time() - oldest.submitted_at), 1) if oldest else 0.0
+        return stats
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_job_queue_from_env(handler: Callable[..., Tuple[Dict, int]]) -> ReceiptJobQueue:
+    """Создает очередь задач по переменным окружения JOB_*."""
+    return ReceiptJobQueue(
+        handler,
+        workers=int(os.getenv("JOB_WORKERS", 4)),
+        max_queue=int(os.getenv("JOB_MAX_QUEUE", 32)),
+        result_ttl_seconds=int(os.getenv("JOB_RESULT_TTL", 10 * 60)),
+    )
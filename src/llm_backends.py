@@ -0,0 +1,559 @@
+# --- START OF FILE llm_backends.py ---
+# Единый интерфейс LLM-бэкендов (OCR, проверка, извлечение, деление) и маршрутизатор между ними
+
+import asyncio
+import base64
+import json
+import logging
+import mimetypes
+import os
+import random
+import re
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterator, List, Optional
+
+import requests
+from pydantic import ValidationError
+
+from models import RestaurantCheckResult, Positions, PositionItem, Recommendation, ReceiptExtraction
+from prompts import (OCR_PROMPT, FUSED_EXTRACTION_PROMPT, build_restaurant_check_prompt, build_positions_prompt,
+                     build_total_amount_prompt, build_recommendations_prompt, strip_json_fences)
+from split_engine import compute_split
+from upload_admission import sniff_image_type
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ("ocr", "extract_receipt", "classify", "extract_positions", "extract_total", "split",
+              "extract_receipt_stream", "extract_positions_stream")
+
+
+# --- Очистка имен позиций от символов, ломающих JS на фронтенде ---
+def clean_position_names(positions_obj: Optional[Positions]) -> Optional[Positions]:
+    if positions_obj and isinstance(positions_obj.positions_list, list):
+        cleaned_count = 0
+        for item in positions_obj.positions_list:
+            if isinstance(item.name, str):
+                original_name = item.name
+                item.name = re.sub(r'[&"\'<>`]', '', item.name) # Удаляем небезопасные символы
+                if item.name != original_name:
+                    cleaned_count += 1
+                    logger.debug(f"Cleaned item name: '{original_name}' -> '{item.name}'")
+        if cleaned_count > 0:
+            logger.info(f"Cleaned names for {cleaned_count} position(s).")
+    elif positions_obj and not isinstance(positions_obj.positions_list, list):
+         logger.warning("Parsed 'positions_list' is not a list after validation. Setting to empty list.")
+         positions_obj.positions_list = []
+
+    return positions_obj
+
+
+def parse_total_amount(total_amount) -> Optional[int]:
+    """Приводит total_amount из ответа модели к int (None, если это не число)."""
+    if isinstance(total_amount, bool):
+        return None
+    if isinstance(total_amount, int):
+        return total_amount
+    if isinstance(total_amount, (float, str)):
+        try:
+            return int(round(float(str(total_amount).replace(',', '.'))))
+        except (ValueError, TypeError):
+            return None
+    return None
+
+
+def has_result(result) -> bool:
+    """Ответ бэкенда удачный: не None и не пустой текст (пустой OCR - тоже сбой, его не разобрать)."""
+    return result is not None and not (isinstance(result, str) and not result.strip())
+
+
+class LLMBackend:
+    """
+    Интерфейс LLM-бэкенда. Каждый метод возвращает None при ошибке (extract_total тоже -
+    0 вместо ошибки маршрутизатор отдает уже после всех бэкендов, как get_total_amount).
+    Неподдерживаемые операции бросают NotImplementedError, и маршрутизатор переходит
+    к следующему бэкенду.
+    """
+    name = "base"
+
+    def ocr(self, image_bytes: bytes, filename: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def extract_receipt(self, image_bytes: bytes, filename: str) -> Optional[ReceiptExtraction]:
+        raise NotImplementedError
+
+    def classify(self, extracted_text: str) -> Optional[bool]:
+        raise NotImplementedError
+
+    def extract_positions(self, extracted_text: str) -> Optional[Positions]:
+        raise NotImplementedError
+
+    def extract_total(self, extracted_text: str) -> Optional[int]:
+        raise NotImplementedError
+
+    def split(self, extracted_text: str, num_people: int, tea_money: float,
+              item_assignments: Dict[str, List[str]]) -> Optional[Recommendation]:
+        raise NotImplementedError
+
+    # Потоковые варианты отдают JSON ответа модели по частям (для /preprocess_receipt_stream).
+    # По умолчанию - одним куском из обычного вызова; пустой поток означает ошибку.
+    def extract_receipt_stream(self, image_bytes: bytes, filename: str) -> Iterator[str]:
+        extraction = self.extract_receipt(image_bytes, filename)
+        if extraction is not None:
+            yield json.dumps(extraction.dict(), ensure_ascii=False)
+
+    def extract_positions_stream(self, extracted_text: str) -> Iterator[str]:
+        positions = self.extract_positions(extracted_text)
+        if positions is not None:
+            yield json.dumps(positions.dict(), ensure_ascii=False)
+
+    def warm_up(self) -> None:
+        """Импортирует SDK и создает клиентов заранее (прогрев после старта), чтобы их не ждал первый запрос."""
+
+    # Асинхронные варианты для ASGI-режима. По умолчанию синхронный метод выполняется в пуле потоков
+    # event loop; бэкенды с асинхронным клиентом (gemini) переопределяют их и не занимают поток на вызов.
+    async def ocr_async(self, image_bytes: bytes, filename: str) -> Optional[str]:
+        return await asyncio.to_thread(self.ocr, image_bytes, filename)
+
+    async def extract_receipt_async(self, image_bytes: bytes, filename: str) -> Optional[ReceiptExtraction]:
+        return await asyncio.to_thread(self.extract_receipt, image_bytes, filename)
+
+    async def classify_async(self, extracted_text: str) -> Optional[bool]:
+        return await asyncio.to_thread(self.classify, extracted_text)
+
+    async def extract_positions_async(self, extracted_text: str) -> Optional[Positions]:
+        return await asyncio.to_thread(self.extract_positions, extracted_text)
+
+    async def extract_total_async(self, extracted_text: str) -> Optional[int]:
+        return await asyncio.to_thread(self.extract_total, extracted_text)
+
+    async def split_async(self, extracted_text: str, num_people: int, tea_money: float,
+                          item_assignments: Dict[str, List[str]]) -> Optional[Recommendation]:
+        return await asyncio.to_thread(self.split, extracted_text, num_people, tea_money, item_assignments)
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """
+    Бэкенд для API, совместимых с OpenAI Chat Completions (например, GigaChat).
+    Настройки: OPENAI_BASE_URL, OPENAI_API_KEY, OPENAI_MODEL, OPENAI_JSON_MODE, OPENAI_TIMEOUT.
+    """
+    name = "openai"
+
+    def __init__(self, base_url: str, api_key: str, model: str, json_mode: bool = True, timeout: float = 60.0):
+        self.base_url = base_url.rstrip('/')
+        self.model = model
+        self.json_mode = json_mode
+        self.timeout = timeout
+        self._session = requests.Session() # Keep-alive соединения переиспользуются между запросами
+        self._session.headers.update({"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"})
+
+    def _chat(self, content, json_mode: bool) -> Optional[str]:
+        payload = {"model": self.model, "messages": [{"role": "user", "content": content}]}
+        if json_mode and self.json_mode:
+            payload["response_format"] = {"type": "json_object"}
+        response = self._session.post(f"{self.base_url}/chat/completions", json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        choices = response.json().get("choices") or []
+        if not choices:
+            logger.error("No choices in OpenAI-compatible response.")
+            return None
+        return choices[0].get("message", {}).get("content")
+
+    def _chat_json(self, content) -> Optional[dict]:
+        raw_text = self._chat(content, json_mode=True)
+        if not raw_text:
+            return None
+        try:
+            return json.loads(strip_json_fences(raw_text))
+        except json.JSONDecodeError as e:
+            logger.error(f"JSON parsing failed for OpenAI-compatible response: {e}. Text: {raw_text[:500]}")
+            return None
+
+    @staticmethod
+    def _image_content(prompt: str, image_bytes: bytes, filename: str):
+        mime_type = sniff_image_type(image_bytes) or mimetypes.guess_type(filename or '')[0]
+        data_url = f"data:{mime_type or 'image/jpeg'};base64,{base64.b64encode(image_bytes).decode('ascii')}"
+        return [{"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": data_url}}]
+
+    def ocr(self, image_bytes, filename):
+        return self._chat(self._image_content(OCR_PROMPT, image_bytes, filename), json_mode=False)
+
+    def extract_receipt(self, image_bytes, filename):
+        parsed_data = self._chat_json(self._image_content(FUSED_EXTRACTION_PROMPT, image_bytes, filename))
+        if parsed_data is None:
+            return None
+        try:
+            return ReceiptExtraction(**parsed_data)
+        except ValidationError as e:
+            logger.error(f"Pydantic validation failed for fused extraction: {e}")
+            return None
+
+    def classify(self, extracted_text):
+        parsed_data = self._chat_json(build_restaurant_check_prompt(extracted_text))
+        if parsed_data is None:
+            return None
+        try:
+            return RestaurantCheckResult(**parsed_data).is_restaurant
+        except ValidationError as e:
+            logger.error(f"Pydantic validation failed for restaurant check: {e}")
+            return None
+
+    def extract_positions(self, extracted_text):
+        parsed_data = self._chat_json(build_positions_prompt(extracted_text))
+        if parsed_data is None:
+            return None
+        try:
+            return clean_position_names(Positions(**parsed_data))
+        except ValidationError as e:
+            logger.error(f"Pydantic validation failed for positions: {e}")
+            return None
+
+    def extract_total(self, extracted_text):
+        parsed_data = self._chat_json(build_total_amount_prompt(extracted_text))
+        total_amount = parse_total_amount(parsed_data.get("total_amount")) if isinstance(parsed_data, dict) else None
+        return total_amount or None # 0 - итог не найден, как у get_total_amount: пусть попробует другой бэкенд
+
+    def split(self, extracted_text, num_people, tea_money, item_assignments):
+        parsed_data = self._chat_json(build_recommendations_prompt(extracted_text, num_people, tea_money, item_assignments))
+        if parsed_data is None:
+            return None
+        try:
+            return Recommendation(**parsed_data)
+        except ValidationError as e:
+            logger.error(f"Pydantic validation failed for recommendations: {e}")
+            return None
+
+
+STUB_RECEIPT_TEXT = """ООО "Ресторан Заглушка"
+Официант: Анна   Стол: 5   Гостей: 3
+Борщ 1 x 450 = 450
+Пельмени 1 x 520 = 520
+Салат Цезарь 1 x 610 = 610
+Чай черный 2 x 150 = 300
+Морс 1 x 220 = 220
+ИТОГО: 2100
+"""
+
+_STUB_POSITION_RE = re.compile(r'^(?P<name>.+?)\s+(?P<qty>\d+)\s*[xх*]\s*(?P<price>\d+(?:[.,]\d+)?)\s*=\s*(?P<sum>\d+(?:[.,]\d+)?)\s*$', re.IGNORECASE)
+_STUB_TOTAL_RE = re.compile(r'(?:ИТОГО|ИТОГ|ВСЕГО К ОПЛАТЕ)\s*:?\s*(?P<total>\d+(?:[.,]\d+)?)', re.IGNORECASE)
+
+
+class StubBackend(LLMBackend):
+    """
+    Детерминированный локальный бэкенд без сети и квот - для нагрузочных тестов и CI.
+    OCR всегда возвращает STUB_RECEIPT_TEXT (или текст из файла STUB_RECEIPT_TEXT_FILE),
+    задержка каждого вызова задается STUB_LATENCY_MS.
+    """
+    name = "stub"
+
+    def __init__(self, receipt_text: str = STUB_RECEIPT_TEXT, latency_ms: float = 0.0):
+        self.receipt_text = receipt_text
+        self.latency_ms = latency_ms
+
+    def _wait(self):
+        if self.latency_ms > 0:
+            time.sleep(self.latency_ms / 1000.0)
+
+    def ocr(self, image_bytes, filename):
+        self._wait()
+        return self.receipt_text
+
+    def extract_receipt(self, image_bytes, filename):
+        self._wait()
+        text = self.receipt_text
+        is_restaurant = self._classify(text)
+        return ReceiptExtraction(
+            is_restaurant=is_restaurant,
+            extracted_text=text,
+            positions_list=self._positions(text).positions_list if is_restaurant else [],
+            total_amount=self._total(text) if is_restaurant else 0,
+        )
+
+    def classify(self, extracted_text):
+        self._wait()
+        return self._classify(extracted_text)
+
+    def extract_positions(self, extracted_text):
+        self._wait()
+        return self._positions(extracted_text)
+
+    def extract_total(self, extracted_text):
+        self._wait()
+        return self._total(extracted_text)
+
+    def split(self, extracted_text, num_people, tea_money, item_assignments):
+        self._wait()
+        return compute_split(self._positions(extracted_text), self._total(extracted_text), num_people, tea_money, item_assignments)
+
+    @staticmethod
+    def _classify(text: str) -> bool:
+        return bool(_STUB_TOTAL_RE.search(text or ''))
+
+    @staticmethod
+    def _positions(text: str) -> Positions:
+        items = []
+        for line in (text or '').splitlines():
+            match = _STUB_POSITION_RE.match(line.strip())
+            if match:
+                items.append(PositionItem(name=match.group('name'), price=int(round(float(match.group('sum').replace(',', '.'))))))
+        return clean_position_names(Positions(positions_list=items))
+
+    @staticmethod
+    def _total(text: str) -> int:
+        match = _STUB_TOTAL_RE.search(text or '')
+        return int(round(float(match.group('total').replace(',', '.')))) if match else 0
+
+
+class _OperationStats:
+    """Скользящее окно последних вызовов одной операции одного бэкенда."""
+
+    def __init__(self, window: int):
+        self.calls = deque(maxlen=window) # (latency_ms, ok)
+        self.cooldown_until = 0.0
+
+    def error_rate(self) -> float:
+        if not self.calls:
+            return 0.0
+        return sum(1 for _, ok in self.calls if not ok) / len(self.calls)
+
+    def mean_latency_ms(self) -> Optional[float]:
+        latencies = [latency for latency, ok in self.calls if ok]
+        return statistics.mean(latencies) if latencies else None
+
+
+class LLMRouter(LLMBackend):
+    """
+    Маршрутизатор запросов между бэкендами: по каждой операции отслеживает
+    скользящие задержку и долю ошибок и отправляет запрос самому быстрому
+    здоровому бэкенду. При ошибке пробует следующий. Бэкенд с долей ошибок
+    выше max_error_rate выводится из ротации на cooldown_seconds.
+    """
+    name = "router"
+
+    def __init__(self, backends: List[LLMBackend], window: int = 50, min_samples: int = 5,
+                 max_error_rate: float = 0.5, cooldown_seconds: float = 30.0, explore_rate: float = 0.05):
+        if not backends:
+            raise ValueError("LLMRouter requires at least one backend.")
+        self.backends = backends
+        self.window = window
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.cooldown_seconds = cooldown_seconds
+        self.explore_rate = explore_rate
+        self._stats: Dict[tuple, _OperationStats] = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+
+    def _get_stats(self, backend_name: str, operation: str) -> _OperationStats:
+        key = (backend_name, operation)
+        if key not in self._stats:
+            self._stats[key] = _OperationStats(self.window)
+        return self._stats[key]
+
+    def _rank(self, operation: str) -> List[LLMBackend]:
+        """
+        Порядок бэкендов для операции: еще не опробованные (чтобы узнать их задержку), затем
+        здоровые по возрастанию задержки, затем без единого успешного вызова в окне (по доле
+        ошибок), затем выведенные из ротации.
+        """
+        now = time.time()
+        healthy, unhealthy = [], []
+        with self._lock:
+            for index, backend in enumerate(self.backends):
+                stats = self._get_stats(backend.name, operation)
+                if stats.cooldown_until > now:
+                    unhealthy.append(backend)
+                    continue
+                latency = stats.mean_latency_ms()
+                if not stats.calls:
+                    rank = (0, 0.0)
+                elif latency is not None:
+                    rank = (1, latency)
+                else: # Все вызовы в окне неудачные - задержка неизвестна, но это не повод ставить первым
+                    rank = (2, stats.error_rate())
+                healthy.append((rank, index, backend))
+            healthy.sort(key=lambda entry: (entry[0], entry[1]))
+            ordered = [backend for _, _, backend in healthy]
+            if len(ordered) > 1 and self._random.random() < self.explore_rate:
+                explored = ordered.pop(self._random.randrange(1, len(ordered)))
+                ordered.insert(0, explored)
+        return ordered + unhealthy
+
+    def _record(self, backend_name: str, operation: str, latency_ms: float, ok: bool) -> None:
+        with self._lock:
+            stats = self._get_stats(backend_name, operation)
+            stats.calls.append((latency_ms, ok))
+            if len(stats.calls) >= self.min_samples and stats.error_rate() > self.max_error_rate:
+                stats.cooldown_until = time.time() + self.cooldown_seconds
+                stats.calls.clear() # После паузы бэкенд снова получает пробные запросы
+                logger.warning(f"LLM backend '{backend_name}' unhealthy for {operation}, cooling down for {self.cooldown_seconds}s.")
+
+    def _call(self, operation: str, *args):
+        result = None
+        for backend in self._rank(operation):
+            started_at = time.perf_counter()
+            try:
+                result = getattr(backend, operation)(*args)
+            except NotImplementedError:
+                continue
+            except Exception as e:
+                logger.error(f"LLM backend '{backend.name}' failed on {operation}: {e}", exc_info=True)
+                result = None
+            ok = has_result(result)
+            self._record(backend.name, operation, (time.perf_counter() - started_at) * 1000, ok)
+            if ok:
+                return result
+            logger.warning(f"LLM backend '{backend.name}' returned no result for {operation}, trying next backend.")
+        return result
+
+    async def _call_async(self, operation: str, *args):
+        """_call для асинхронных вариантов операций (статистика общая с синхронными)."""
+        result = None
+        for backend in self._rank(operation):
+            started_at = time.perf_counter()
+            try:
+                result = await getattr(backend, f"{operation}_async")(*args)
+            except NotImplementedError:
+                continue
+            except Exception as e:
+                logger.error(f"LLM backend '{backend.name}' failed on async {operation}: {e}", exc_info=True)
+                result = None
+            ok = has_result(result)
+            self._record(backend.name, operation, (time.perf_counter() - started_at) * 1000, ok)
+            if ok:
+                return result
+            logger.warning(f"LLM backend '{backend.name}' returned no result for async {operation}, trying next backend.")
+        return result
+
+    def _stream(self, operation: str, *args) -> Iterator[str]:
+        """Как _call, но для потоков: следующий бэкенд пробуется, только пока ничего не отдано клиенту."""
+        for backend in self._rank(operation):
+            started_at = time.perf_counter()
+            produced = False
+            try:
+                for chunk in getattr(backend, operation)(*args):
+                    produced = True
+                    yield chunk
+            except NotImplementedError:
+                continue
+            except Exception as e:
+                logger.error(f"LLM backend '{backend.name}' failed on {operation}: {e}", exc_info=True)
+                self._record(backend.name, operation, (time.perf_counter() - started_at) * 1000, False)
+                if produced:
+                    raise # Часть ответа уже отдана - продолжить с другим бэкендом нельзя
+                continue
+            self._record(backend.name, operation, (time.perf_counter() - started_at) * 1000, produced)
+            if produced:
+                return
+            logger.warning(f"LLM backend '{backend.name}' returned no result for {operation}, trying next backend.")
+
+    def ocr(self, image_bytes, filename):
+        return self._call("ocr", image_bytes, filename)
+
+    def extract_receipt(self, image_bytes, filename):
+        return self._call("extract_receipt", image_bytes, filename)
+
+    def classify(self, extracted_text):
+        return self._call("classify", extracted_text)
+
+    def extract_positions(self, extracted_text):
+        return self._call("extract_positions", extracted_text)
+
+    def extract_total(self, extracted_text):
+        total_amount = self._call("extract_total", extracted_text)
+        return total_amount if total_amount is not None else 0
+
+    def split(self, extracted_text, num_people, tea_money, item_assignments):
+        return self._call("split", extracted_text, num_people, tea_money, item_assignments)
+
+    def extract_receipt_stream(self, image_bytes, filename):
+        return self._stream("extract_receipt_stream", image_bytes, filename)
+
+    async def ocr_async(self, image_bytes, filename):
+        return await self._call_async("ocr", image_bytes, filename)
+
+    async def extract_receipt_async(self, image_bytes, filename):
+        return await self._call_async("extract_receipt", image_bytes, filename)
+
+    async def classify_async(self, extracted_text):
+        return await self._call_async("classify", extracted_text)
+
+    async def extract_positions_async(self, extracted_text):
+        return await self._call_async("extract_positions", extracted_text)
+
+    async def extract_total_async(self, extracted_text):
+        total_amount = await self._call_async("extract_total", extracted_text)
+        return total_amount if total_amount is not None else 0
+
+    async def split_async(self, extracted_text, num_people, tea_money, item_assignments):
+        return await self._call_async("split", extracted_text, num_people, tea_money, item_assignments)
+
+    def extract_positions_stream(self, extracted_text):
+        return self._stream("extract_positions_stream", extracted_text)
+
+    def warm_up(self) -> Dict[str, float]:
+        """Прогревает все бэкенды; возвращает время прогрева каждого в секундах."""
+        durations = {}
+        for backend in self.backends:
+            started_at = time.perf_counter()
+            try:
+                backend.warm_up()
+            except Exception as e:
+                logger.error(f"Warm-up of LLM backend {backend.name} failed: {e}")
+            durations[backend.name] = round(time.perf_counter() - started_at, 3)
+        return durations
+
+    def stats(self) -> Dict:
+        """Задержка, доля ошибок и состояние каждого бэкенда по операциям."""
+        now = time.time()
+        result = {}
+        with self._lock:
+            for (backend_name, operation), stats in self._stats.items():
+                latency = stats.mean_latency_ms()
+                result.setdefault(backend_name, {})[operation] = {
+                    "samples": len(stats.calls),
+                    "error_rate": round(stats.error_rate(), 4),
+                    "mean_latency_ms": round(latency, 1) if latency is not None else None,
+                    "healthy": stats.cooldown_until <= now,
+                }
+        return result
+
+
+def create_backend(name: str) -> LLMBackend:
+    """Создает бэкенд по имени из LLM_BACKENDS: gemini, openai или stub."""
+    if name == "gemini":
+        from gemini_backend import GeminiBackend # Импорт здесь: gemini_backend сам зависит от этого модуля
+        return GeminiBackend()
+    if name == "openai":
+        return OpenAICompatibleBackend(
+            base_url=os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+            api_key=os.getenv("OPENAI_API_KEY", ""),
+            model=os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
+            json_mode=os.getenv("OPENAI_JSON_MODE", "True").lower() == "true",
+            timeout=float(os.getenv("OPENAI_TIMEOUT", 60)),
+        )
+    if name == "stub":
+        receipt_text = STUB_RECEIPT_TEXT
+        stub_text_file = os.getenv("STUB_RECEIPT_TEXT_FILE")
+        if stub_text_file:
+            with open(stub_text_file, 'r', encoding='utf-8') as f:
+                receipt_text = f.read()
+        return StubBackend(receipt_text=receipt_text, latency_ms=float(os.getenv("STUB_LATENCY_MS", 0)))
+    raise ValueError(f"Unknown LLM backend '{name}'.")
+
+
+def create_router_from_env() -> LLMRouter:
+    """Создает маршрутизатор по LLM_BACKENDS (через запятую, в порядке предпочтения) и LLM_ROUTER_*."""
+    names = [name.strip().lower() for name in os.getenv("LLM_BACKENDS", "gemini").split(',') if name.strip()]
+    backends = [create_backend(name) for name in names]
+    logger.info(f"LLM backends configured: {', '.join(backend.name for backend in backends)}")
+    return LLMRouter(
+        backends,
+        window=int(os.getenv("LLM_ROUTER_WINDOW", 50)),
+        min_samples=int(os.getenv("LLM_ROUTER_MIN_SAMPLES", 5)),
+        max_error_rate=float(os.getenv("LLM_ROUTER_MAX_ERROR_RATE", 0.5)),
+        cooldown_seconds=float(os.getenv("LLM_ROUTER_COOLDOWN", 30)),
+        explore_rate=float(os.getenv("LLM_ROUTER_EXPLORE_RATE", 0.05)),
+    )
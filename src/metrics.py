@@ -0,0 +1,203 @@
+# --- START OF FILE metrics.py ---
+
+import functools
+import inspect
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Tuple
+
+# Границы корзин гистограмм (секунды для задержек, байты для размеров загрузок)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (16384, 65536, 262144, 524288, 1048576, 2097152, 4194304, 8388608, 16777216)
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Последняя корзина - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Счетчики и гистограммы в памяти процесса с выводом в текстовом формате Prometheus.
+
+    Запись - одна блокировка и несколько операций со словарем, поэтому таймеры
+    можно держать на горячем пути. Метрики описываются при первой записи.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {} # name -> (type, help)
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._histograms: Dict[Tuple[str, Tuple], _Histogram] = {}
+
+    def inc(self, name: str, help_text: str, labels: Tuple[Tuple[str, str], ...] = (), value: float = 1) -> None:
+        with self._lock:
+            self._help.setdefault(name, ("counter", help_text))
+            key = (name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, help_text: str, value: float, labels: Tuple[Tuple[str, str], ...] = (),
+                buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        with self._lock:
+            self._help.setdefault(name, ("histogram", help_text))
+            key = (name, labels)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(buckets)
+            histogram.observe(value)
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus (version 0.0.4)."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (h.buckets, list(h.counts), h.sum, h.count) for key, h in self._histograms.items()}
+            help_entries = dict(self._help)
+
+        lines = []
+        for name in sorted(help_entries):
+            metric_type, help_text = help_entries[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "counter":
+                for (metric_name, labels), value in sorted(counters.items()):
+                    if metric_name == name:
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            for (metric_name, labels), (buckets, counts, total, count) in sorted(histograms.items(), key=lambda item: item[0]):
+                if metric_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else _format_value(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+# Общий реестр метрик процесса
+registry = MetricsRegistry()
+
+
+def observe_stage(stage: str, seconds: float, failed: bool = False) -> None:
+    """Время выполнения шага конвейера и ошибка шага (если была)."""
+    labels = (("stage", stage),)
+    registry.observe("receipt_stage_duration_seconds", "Duration of receipt pipeline stages.", seconds, labels)
+    registry.inc("receipt_stage_calls_total", "Receipt pipeline stage calls.", labels)
+    if failed:
+        registry.inc("receipt_stage_errors_total", "Receipt pipeline stage failures (exception or empty result).", labels)
+
+
+def timed_stage(stage: str, failed: Callable[[object], bool] = lambda result: result is None):
+    """
+    Декоратор: замеряет время вызова как шаг stage.
+
+    Ошибкой считается исключение или результат, для которого failed(result) истинно
+    (функции Gemini возвращают None вместо исключения). Поддерживает и async-функции.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception:
+                    observe_stage(stage, time.perf_counter() - started_at, failed=True)
+                    raise
+                observe_stage(stage, time.perf_counter() - started_at, failed=failed(result))
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                observe_stage(stage, time.perf_counter() - started_at, failed=True)
+                raise
+            observe_stage(stage, time.perf_counter() - started_at, failed=failed(result))
+            return result
+        return wrapper
+    return decorator
+
+
+def record_token_usage(stage: str, response) -> None:
+    """Токены из usage_metadata ответа Gemini (google.generativeai и google.genai)."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    for kind, attribute in (("prompt", "prompt_token_count"), ("output", "candidates_token_count")):
+        tokens = getattr(usage, attribute, None)
+        if tokens:
+            registry.inc("receipt_model_tokens_total", "Model tokens used by receipt pipeline stages.",
+                         (("stage", stage), ("kind", kind)), tokens)
+
+
+def record_upload_bytes(kind: str, size: int) -> None:
+    """Размер загруженного изображения: kind="raw" - как прислали, "normalized" - после предобработки."""
+    registry.observe("receipt_upload_bytes", "Size of uploaded receipt images in bytes.", size, (("kind", kind),), BYTES_BUCKETS)
+
+
+def record_upload_admission(result: str) -> None:
+    """Проверка загрузки до вызова модели: accepted или причина отказа (too_large, unsupported_type, blurry, ...)."""
+    registry.inc("receipt_upload_admission_total", "Uploaded receipt images accepted or rejected before model calls.",
+                 (("result", result),))
+
+
+def record_cache_lookup(hit: bool) -> None:
+    registry.inc("receipt_cache_lookups_total", "Receipt result cache lookups.", (("result", "hit" if hit else "miss"),))
+
+
+def record_rule_parser(hit: bool) -> None:
+    registry.inc("receipt_rule_parser_total", "Receipts parsed by local rules (hit) or sent to the LLM (fallback).",
+                 (("result", "hit" if hit else "fallback"),))
+
+
+def record_restaurant_classifier(decision: str) -> None:
+    registry.inc("receipt_restaurant_classifier_total", "Restaurant checks decided locally (yes/no) or sent to the LLM (ambiguous).",
+                 (("decision", decision),))
+
+
+def record_prompt_text_tokens(stage: str, raw_tokens: int, compacted_tokens: int) -> None:
+    """Оценка токенов текста чека в промпте этапа до и после сжатия (text_compaction.py)."""
+    for kind, tokens in (("raw", raw_tokens), ("compacted", compacted_tokens)):
+        registry.inc("receipt_prompt_text_tokens_total", "Estimated receipt text tokens in prompts before and after compaction.",
+                     (("stage", stage), ("kind", kind)), tokens)
+
+
+def record_governor_event(event: str, stage: str) -> None:
+    """События регулятора запросов к Gemini: calls, retries, coalesced, throttled, quota_timeouts, failed."""
+    registry.inc("gemini_governor_events_total", "Gemini request governor events by pipeline stage.",
+                 (("event", event), ("stage", stage)))
+
+
+def render_metrics() -> str:
+    return registry.render()
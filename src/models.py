@@ -0,0 +1,36 @@
+# --- START OF FILE models.py ---
+
+from pydantic import BaseModel
+from typing import List
+
+# --- Упрощенные Pydantic Модели ---
+# --- Новая Pydantic модель для проверки ---
+class RestaurantCheckResult(BaseModel):
+    is_restaurant: bool
+
+class PositionItem(BaseModel):
+    name: str
+    price: int # <--- Изменено на int
+
+class Positions(BaseModel):
+    positions_list: List[PositionItem]
+
+class PersonShare(BaseModel):
+    equally: int
+    who_more_eat_then_more_pay: int
+    who_more_cost_then_more_pay: int
+    proportional_division_by_the_cost_of_orders: int
+
+class PersonShareItem(BaseModel):
+    name: str
+    shares: PersonShare
+
+class Recommendation(BaseModel):
+    peoples_list: List[PersonShareItem]
+
+# --- Результат объединенного (fused) извлечения за один вызов модели ---
+class ReceiptExtraction(BaseModel):
+    is_restaurant: bool
+    extracted_text: str
+    positions_list: List[PositionItem]
+    total_amount: int
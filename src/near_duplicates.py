@@ -0,0 +1,171 @@
+# --- START OF FILE near_duplicates.py ---
+# Почти одинаковые фото одного чека (другой ракурс, переснятый кадр): индекс перцептивных хэшей недавних чеков
+
+import io
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from receipt_parser import detect_total
+
+logger = logging.getLogger(__name__)
+
+# dHash: сетка HASH_SIZE x HASH_SIZE перепадов яркости по горизонтали и по вертикали - 128 бит
+HASH_SIZE = 8
+HASH_BITS = 2 * HASH_SIZE * HASH_SIZE
+
+
+def perceptual_hash(image_bytes: bytes) -> Optional[int]:
+    """
+    Разностный хэш (dHash) изображения: бит на каждую пару соседних клеток уменьшенной
+    серой копии - светлее ли левая (верхняя) клетка правой (нижней). Небольшие сдвиг,
+    масштаб, яркость и размытие меняют лишь несколько бит. None - изображение не читается.
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            image.draft("L", (HASH_SIZE * 16, HASH_SIZE * 16)) # JPEG декодируется сразу уменьшенным
+            gray = image.convert("L")
+    except Exception as e:
+        logger.warning(f"Perceptual hash failed: {e}")
+        return None
+    value = 0
+    wide = gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BOX).tobytes()
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            offset = row * (HASH_SIZE + 1) + column
+            value = (value << 1) | (wide[offset] < wide[offset + 1])
+    tall = gray.resize((HASH_SIZE, HASH_SIZE + 1), Image.BOX).tobytes()
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            offset = row * HASH_SIZE + column
+            value = (value << 1) | (tall[offset] < tall[offset + HASH_SIZE])
+    return value
+
+
+def hamming_distance(first: int, second: int) -> int:
+    return (first ^ second).bit_count()
+
+
+class NearDuplicateMatch:
+    """Найденные в индексе похожие чеки (ближайшие первыми) для хэша загрузки."""
+
+    __slots__ = ("image_hash", "candidates")
+
+    def __init__(self, image_hash: Optional[int], candidates: List[Tuple[int, int, str]]):
+        self.image_hash = image_hash
+        self.candidates = candidates # (расстояние, итог, JSON результата)
+
+
+class NearDuplicateIndex:
+    """
+    Индекс перцептивных хэшей недавно обработанных чеков из ресторанов: LRU с TTL
+    и ограничением числа записей. Поиск - полный перебор по расстоянию Хэмминга
+    (тысячи записей - доли миллисекунды).
+
+    Похожий хэш сам по себе не доказывает, что это тот же чек: чеки одного заведения
+    сверстаны одинаково. Поэтому результат отдается только после проверки - итог из строки
+    итога в тексте OCR новой загрузки должен совпасть с итогом кандидата.
+    """
+
+    def __init__(self, enabled: bool = True, max_distance: int = 10, max_entries: int = 2048, ttl_seconds: int = 3600):
+        self.enabled = enabled
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict() # хэш -> (stored_at, итог, JSON результата)
+        self._lock = threading.Lock()
+        self._stats = {"lookups": 0, "candidates": 0, "hits": 0, "false_matches": 0, "unverified": 0,
+                       "stores": 0, "evictions": 0, "expirations": 0}
+
+    def lookup(self, image_bytes: bytes) -> NearDuplicateMatch:
+        """Хэш изображения и похожие чеки не дальше max_distance бит."""
+        if not self.enabled or not self.max_entries:
+            return NearDuplicateMatch(None, [])
+        image_hash = perceptual_hash(image_bytes)
+        if image_hash is None:
+            return NearDuplicateMatch(None, [])
+        now = time.time()
+        candidates = []
+        with self._lock:
+            self._stats["lookups"] += 1
+            for stored_hash in list(self._entries):
+                stored_at, total_amount, json_text = self._entries[stored_hash]
+                if now - stored_at > self.ttl_seconds:
+                    del self._entries[stored_hash]
+                    self._stats["expirations"] += 1
+                    continue
+                distance = hamming_distance(image_hash, stored_hash)
+                if distance <= self.max_distance:
+                    candidates.append((distance, total_amount, json_text))
+            if candidates:
+                self._stats["candidates"] += 1
+        candidates.sort(key=lambda candidate: candidate[0])
+        return NearDuplicateMatch(image_hash, candidates)
+
+    def confirm(self, match: NearDuplicateMatch, extracted_text: str) -> Optional[Dict]:
+        """
+        Проверка кандидатов по тексту OCR новой загрузки: итог из строки итога ("ИТОГО",
+        "К ОПЛАТЕ"; строки позиций не учитываются) должен совпасть с итогом кандидата. Возвращает копию результата
+        ближайшего подтвержденного кандидата или None (ложное совпадение или итог не найден).
+        """
+        detected_total = detect_total(extracted_text) if extracted_text else None
+        confirmed = None
+        if detected_total is not None:
+            confirmed = next((candidate for candidate in match.candidates if candidate[1] == detected_total), None)
+        with self._lock:
+            if confirmed is not None:
+                self._stats["hits"] += 1
+            elif detected_total is None:
+                self._stats["unverified"] += 1
+            else:
+                self._stats["false_matches"] += 1
+        if confirmed is None:
+            logger.info(f"Near-duplicate not confirmed: detected total {detected_total}, "
+                        f"candidates {[(distance, total) for distance, total, _ in match.candidates]}.")
+            return None
+        distance, total_amount, json_text = confirmed
+        logger.info(f"Near-duplicate receipt confirmed: distance {distance}/{HASH_BITS} bits, total {total_amount}.")
+        response_data = json.loads(json_text)
+        response_data['near_duplicate_distance'] = distance
+        return response_data
+
+    def add(self, match: NearDuplicateMatch, response_data: Dict) -> None:
+        """Запоминает результат чека из ресторана с итогом (без итога его нечем проверить)."""
+        if match.image_hash is None or not response_data.get('is_restaurant') or not response_data.get('total_amount_detected'):
+            return
+        stored = {key: value for key, value in response_data.items() if key not in ('receipt_id', 'cache_hit', 'near_duplicate_distance')}
+        entry = (time.time(), response_data['total_amount_detected'], json.dumps(stored, ensure_ascii=False))
+        with self._lock:
+            self._entries[match.image_hash] = entry
+            self._entries.move_to_end(match.image_hash)
+            self._stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        stats["max_entries"] = self.max_entries
+        stats["max_distance"] = self.max_distance
+        stats["hash_bits"] = HASH_BITS
+        verified = stats["hits"] + stats["false_matches"] + stats["unverified"]
+        stats["confirmed_ratio"] = round(stats["hits"] / verified, 4) if verified else 0.0
+        return stats
+
+
+def create_near_duplicate_index_from_env() -> NearDuplicateIndex:
+    """Создает индекс почти одинаковых чеков по переменным окружения NEAR_DUPLICATE_*."""
+    return NearDuplicateIndex(
+        enabled=os.getenv("NEAR_DUPLICATE", "True").lower() == "true",
+        max_distance=int(os.getenv("NEAR_DUPLICATE_MAX_DISTANCE", 10)),
+        max_entries=int(os.getenv("NEAR_DUPLICATE_MAX_ENTRIES", 2048)),
+        ttl_seconds=int(os.getenv("NEAR_DUPLICATE_TTL", 60 * 60)),
+    )
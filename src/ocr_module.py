@@ -1,79 +1,278 @@
 # --- START OF FILE ocr_module.py ---
 
+import io
 import os
-import google.generativeai as genai
+import json
+import time
+from contextlib import contextmanager, asynccontextmanager
 import mimetypes
 import logging # Добавим логирование
+from pydantic import ValidationError
+from models import ReceiptExtraction
+from gemini_clients import get_registry, generation_config
+from prompts import OCR_PROMPT, FUSED_EXTRACTION_PROMPT, strip_json_fences
+from gemini_governor import get_governor
+from metrics import timed_stage, observe_stage
+from upload_admission import sniff_image_type
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logging.getLogger("googleapiclient").setLevel(logging.DEBUG)
 
-def process_image_with_gemini(filepath):
+# Изображения больше этого порога отправляются через Files API, меньше - прямо в запросе
+INLINE_IMAGE_MAX_BYTES = int(os.getenv("INLINE_IMAGE_MAX_BYTES", 15 * 1024 * 1024))
+# Имя модели для клиента google.genai (асинхронные вызовы)
+GENAI_MODEL_NAME = "gemini-2.0-flash"
+
+def _detect_mime_type(image_bytes, filename):
+    """Detects the image MIME type from its leading bytes, falling back to the upload filename."""
+    # Определяем MIME-тип по сигнатуре файла; имя файла - только если сигнатура неизвестна
+    mime_type = sniff_image_type(image_bytes) or mimetypes.guess_type(filename or '')[0]
+    if not mime_type or not mime_type.startswith('image/'):
+         logger.error(f"Invalid or unsupported MIME type: {mime_type} for file {filename}")
+         # Inline-данные с application/octet-stream модель не принимает, пробуем как JPEG
+         mime_type = 'image/jpeg'
+         logger.warning(f"Could not determine image MIME type for {filename}. Trying {mime_type}.")
+    return mime_type
+
+def _delete_uploaded_file(sample_file):
+    """Deletes an uploaded file from Google storage, logging any failure."""
+    try:
+        get_registry().generativeai().delete_file(sample_file.name)
+        logger.info(f"File {sample_file.name} deleted from Google storage.")
+    except Exception as delete_err:
+        logger.error(f"Error deleting file {sample_file.name}: {delete_err}")
+
+def stream_chunk_text(chunk):
+    """Text of a streamed response chunk ("" for chunks without parts, e.g. the final one)."""
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+@contextmanager
+def _image_part(image_bytes, filename):
+    """
+    Builds the image content part for a Gemini request.
+
+    Small images are sent inline with the request. Images larger than
+    INLINE_IMAGE_MAX_BYTES are uploaded via the Files API from memory and
+    deleted from Google storage when the context exits.
+
+    Args:
+        image_bytes (bytes): The raw image data.
+        filename (str): The original upload filename (used for the MIME type).
+
+    Yields:
+        dict | File: The content part to pass to generate_content.
+    """
+    mime_type = _detect_mime_type(image_bytes, filename)
+    if len(image_bytes) <= INLINE_IMAGE_MAX_BYTES:
+        logger.info(f"Sending image {filename} inline ({len(image_bytes)} bytes, {mime_type}).")
+        yield {"mime_type": mime_type, "data": image_bytes}
+        return
+
+    logger.info(f"Uploading large image {filename} ({len(image_bytes)} bytes) via Files API with MIME type: {mime_type}")
+    sample_file = get_registry().generativeai().upload_file(path=io.BytesIO(image_bytes), mime_type=mime_type)
+    logger.info(f"File uploaded successfully: {sample_file.name}")
+    try:
+        yield sample_file
+    finally:
+        _delete_uploaded_file(sample_file)
+
+def _generate_with_image(model, prompt, image_bytes, filename, **kwargs):
+    """generate_content с изображением (загрузка через Files API повторяется вместе с запросом)."""
+    with _image_part(image_bytes, filename) as image_part:
+        return model.generate_content([prompt, image_part], **kwargs)
+
+@timed_stage("ocr", failed=lambda text: not text) # Пустой текст - тоже неудача OCR
+def process_image_with_gemini(image_bytes, filename):
     """
-    Processes an image file using Google Gemini for OCR.
+    Processes an image using Google Gemini for OCR.
 
     Args:
-        filepath (str): The path to the image file.
+        image_bytes (bytes): The raw image data.
+        filename (str): The original upload filename.
 
     Returns:
         str: The extracted text from the image, or None if an error occurs.
     """
     try:
-        api_key = os.getenv('GOOGLE_API_KEY')
-        if not api_key:
-            logger.error("GOOGLE_API_KEY environment variable not set.")
-            return None
-        genai.configure(api_key=api_key)
-
-        # Определяем MIME-тип файла
-        mime_type, _ = mimetypes.guess_type(filepath)
-        if not mime_type or not mime_type.startswith('image/'):
-             logger.error(f"Invalid or unsupported MIME type: {mime_type} for file {filepath}")
-             # Можно вернуть ошибку или пустую строку, в зависимости от желаемого поведения
-             # return None # Или вернуть специфичную ошибку
-             # Попробуем загрузить как application/octet-stream, если тип не определен
-             mime_type = 'application/octet-stream'
-             logger.warning(f"Could not determine image MIME type for {filepath}. Trying {mime_type}.")
-             # Если все равно не удается, можно вернуть ошибку
-             # return None
-
-        logger.info(f"Uploading file: {filepath} with MIME type: {mime_type}")
-        # Загружаем файл
-        sample_file = genai.upload_file(path=filepath, mime_type=mime_type)
-        logger.info(f"File uploaded successfully: {sample_file.name}")
-
-        # Используем модель Gemini 1.5 Flash (или Pro, если нужно)
-        # Убедитесь, что имя модели правильное. 'gemini-1.5-flash-002' может быть устаревшим или неверным.
-        # Используем 'gemini-1.5-flash' или 'gemini-1.5-pro'
-        model = genai.GenerativeModel(model_name="models/gemini-2.0-flash") # Используем стандартное имя
-        prompt = "Выполни OCR для этого изображения. Верни только извлеченный текст без дополнительных комментариев."
+        # Общая модель из реестра клиентов (без повторного genai.configure на каждый запрос)
+        model = get_registry().generative_model("models/gemini-2.0-flash")
         logger.info("Generating content with Gemini...")
-        response = model.generate_content([prompt, sample_file])
-
-        # Освобождаем ресурс файла после использования
-        # genai.delete_file(sample_file.name) # Раскомментируйте, если хотите удалять файл с серверов Google
-        # logger.info(f"File {sample_file.name} deleted from Google Cloud Storage.")
-
-        # Проверяем наличие текста в ответе
-        if response.text:
-            logger.info("OCR successful.")
-            return response.text
-        else:
-            logger.warning("OCR completed, but no text was extracted.")
-            # Проверим, есть ли ошибки в кандидатах
-            if response.candidates and response.candidates[0].finish_reason != 'STOP':
-                 logger.error(f"Gemini generation finished with reason: {response.candidates[0].finish_reason}")
-            return "" # Возвращаем пустую строку, если текст не извлечен
+        # Квота, повторы при 429/5xx; одинаковые изображения в обработке распознаются один раз
+        response = get_governor().call("ocr", "models/gemini-2.0-flash", _generate_with_image,
+                                       model, OCR_PROMPT, image_bytes, filename, dedupe_key=image_bytes)
+        return _parse_ocr_text(response)
 
     except Exception as e:
         logger.error(f"Error processing image with Gemini: {e}", exc_info=True)
-        # Попытка удалить файл, если он был загружен, но произошла ошибка
-        if 'sample_file' in locals() and sample_file:
-            try:
-                genai.delete_file(sample_file.name)
-                logger.info(f"File {sample_file.name} deleted after error.")
-            except Exception as delete_err:
-                logger.error(f"Error deleting file {sample_file.name} after error: {delete_err}")
         return None
+
+def _parse_ocr_text(response):
+    """Text of an OCR response ("" if the model extracted nothing)."""
+    # Проверяем наличие текста в ответе
+    if response.text:
+        logger.info("OCR successful.")
+        return response.text
+    else:
+        logger.warning("OCR completed, but no text was extracted.")
+        # Проверим, есть ли ошибки в кандидатах
+        if response.candidates and response.candidates[0].finish_reason != 'STOP':
+             logger.error(f"Gemini generation finished with reason: {response.candidates[0].finish_reason}")
+        return "" # Возвращаем пустую строку, если текст не извлечен
+
+@timed_stage("fused")
+def extract_receipt_with_gemini(image_bytes, filename):
+    """
+    Runs OCR, restaurant classification, positions and total extraction
+    in a single multimodal structured-output Gemini call.
+
+    Args:
+        image_bytes (bytes): The raw image data.
+        filename (str): The original upload filename.
+
+    Returns:
+        ReceiptExtraction: The parsed extraction result, or None if an error occurs.
+    """
+    try:
+        model = get_registry().generative_model("models/gemini-2.0-flash")
+        logger.info("Generating fused receipt extraction with Gemini...")
+        response = get_governor().call(
+            "fused", "models/gemini-2.0-flash", _generate_with_image,
+            model, FUSED_EXTRACTION_PROMPT, image_bytes, filename,
+            generation_config=generation_config(
+                response_mime_type="application/json",
+                response_schema=ReceiptExtraction
+            ),
+            dedupe_key=image_bytes,
+        )
+        return _parse_extraction(response)
+
+    except Exception as e:
+        logger.error(f"Error during fused receipt extraction with Gemini: {e}", exc_info=True)
+        return None
+
+def _parse_extraction(response):
+    """ReceiptExtraction from a fused-call response, or None if it is missing or invalid."""
+    if not (hasattr(response, 'text') and response.text):
+        logger.error("No usable content found in Gemini response for fused extraction.")
+        return None
+
+    cleaned_json_text = strip_json_fences(response.text)
+    try:
+        extraction = ReceiptExtraction(**json.loads(cleaned_json_text))
+    except (json.JSONDecodeError, ValidationError) as e:
+        logger.error(f"Pydantic validation or JSON parsing failed for fused extraction: {e}. JSON: {cleaned_json_text[:500]}")
+        return None
+
+    logger.info(f"Fused extraction successful: is_restaurant={extraction.is_restaurant}, items={len(extraction.positions_list)}, total_amount={extraction.total_amount}")
+    return extraction
+
+# --- Асинхронные варианты (ASGI-режим): клиент google.genai.aio, ожидание ответа не занимает поток ---
+@asynccontextmanager
+async def _image_part_async(client, image_bytes, filename):
+    """Async counterpart of _image_part for the google.genai client (Files API for large images)."""
+    from google.genai import types
+    mime_type = _detect_mime_type(image_bytes, filename)
+    if len(image_bytes) <= INLINE_IMAGE_MAX_BYTES:
+        yield types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
+        return
+
+    logger.info(f"Uploading large image {filename} ({len(image_bytes)} bytes) via async Files API with MIME type: {mime_type}")
+    uploaded = await client.aio.files.upload(file=io.BytesIO(image_bytes), config=types.UploadFileConfig(mime_type=mime_type))
+    try:
+        yield uploaded
+    finally:
+        try:
+            await client.aio.files.delete(name=uploaded.name)
+        except Exception as delete_err:
+            logger.error(f"Error deleting file {uploaded.name}: {delete_err}")
+
+async def _generate_with_image_async(client, prompt, image_bytes, filename, config):
+    async with _image_part_async(client, image_bytes, filename) as image_part:
+        return await client.aio.models.generate_content(model=GENAI_MODEL_NAME, contents=[prompt, image_part], config=config)
+
+async def generate_content_async(stage, prompt, response_schema=None, dedupe_key=None, image_bytes=None, filename=None):
+    """
+    Calls Gemini through the shared async google.genai client (quota and retries via the governor).
+
+    Args:
+        stage (str): Pipeline stage for quota, metrics and coalescing.
+        prompt (str): The prompt text.
+        response_schema: Optional schema; when set (or for text prompts) the response is JSON.
+        dedupe_key (str | bytes): Request content for coalescing identical in-flight calls.
+        image_bytes (bytes): Optional image sent together with the prompt.
+        filename (str): The original upload filename (used for the MIME type).
+
+    Returns:
+        GenerateContentResponse: The raw model response.
+    """
+    client = get_registry().genai_client()
+    config = {}
+    if image_bytes is None or response_schema is not None:
+        config['response_mime_type'] = 'application/json'
+    if response_schema is not None:
+        config['response_schema'] = response_schema
+    if image_bytes is None:
+        return await get_governor().call_async(stage, GENAI_MODEL_NAME, client.aio.models.generate_content,
+                                               model=GENAI_MODEL_NAME, contents=prompt, config=config, dedupe_key=dedupe_key)
+    return await get_governor().call_async(stage, GENAI_MODEL_NAME, _generate_with_image_async,
+                                           client, prompt, image_bytes, filename, config, dedupe_key=dedupe_key)
+
+@timed_stage("ocr", failed=lambda text: not text)
+async def process_image_with_gemini_async(image_bytes, filename):
+    """Async counterpart of process_image_with_gemini."""
+    try:
+        response = await generate_content_async("ocr", OCR_PROMPT, dedupe_key=image_bytes, image_bytes=image_bytes, filename=filename)
+        return _parse_ocr_text(response)
+    except Exception as e:
+        logger.error(f"Error processing image with async Gemini client: {e}", exc_info=True)
+        return None
+
+@timed_stage("fused")
+async def extract_receipt_with_gemini_async(image_bytes, filename):
+    """Async counterpart of extract_receipt_with_gemini."""
+    try:
+        response = await generate_content_async("fused", FUSED_EXTRACTION_PROMPT, response_schema=ReceiptExtraction,
+                                                dedupe_key=image_bytes, image_bytes=image_bytes, filename=filename)
+        return _parse_extraction(response)
+    except Exception as e:
+        logger.error(f"Error during async fused receipt extraction with Gemini: {e}", exc_info=True)
+        return None
+
+def extract_receipt_stream_with_gemini(image_bytes, filename):
+    """
+    Streaming variant of extract_receipt_with_gemini.
+
+    Args:
+        image_bytes (bytes): The raw image data.
+        filename (str): The original upload filename.
+
+    Yields:
+        str: Chunks of the ReceiptExtraction JSON as the model generates them.
+             Errors are raised to the caller (the LLM router), not swallowed.
+    """
+    started_at = time.perf_counter()
+    produced = False
+    try:
+        model = get_registry().generative_model("models/gemini-2.0-flash")
+        logger.info("Streaming fused receipt extraction with Gemini...")
+        with _image_part(image_bytes, filename) as image_part:
+            chunks = get_governor().stream(
+                "fused", "models/gemini-2.0-flash", model.generate_content,
+                [FUSED_EXTRACTION_PROMPT, image_part],
+                generation_config=generation_config(
+                    response_mime_type="application/json",
+                    response_schema=ReceiptExtraction
+                ),
+            )
+            for chunk in chunks:
+                text = stream_chunk_text(chunk)
+                if text:
+                    produced = True
+                    yield text
+    finally:
+        observe_stage("fused", time.perf_counter() - started_at, failed=not produced)
@@ -0,0 +1,154 @@
+# --- START OF FILE prompts.py ---
+# Промпты и схемы ответов, общие для всех LLM-бэкендов (Gemini, OpenAI-совместимых)
+
+import re
+from typing import Dict, List
+
+from text_compaction import compact_for_stage
+
+OCR_PROMPT = "Выполни OCR для этого изображения. Верни только извлеченный текст без дополнительных комментариев."
+
+FUSED_EXTRACTION_PROMPT = """
+Выполни OCR для этого изображения и проанализируй полученный текст.
+
+Верни результат СТРОГО в формате JSON со следующими полями:
+1.  'extracted_text' - весь распознанный текст изображения без комментариев.
+2.  'is_restaurant' - true, если это чек из ресторана, кафе, бара или похожего заведения общепита, иначе false.
+3.  'positions_list' - СПИСОК позиций (блюда, напитки) с ценами. Каждый объект содержит 'name' (строка, название позиции) и 'price' (**целое число int**, округленная цена в рублях). Игнорируй строки типа "Итого", "Скидка", "Обслуживание", "НДС", "Официант" и т.п. Если это не чек из ресторана или позиций нет, верни ПУСТОЙ СПИСОК `[]`. Старайся нормализовать названия. Любые кавычки (одинарные и двойные) в названиях замени на что-то другое или удали.
+4.  'total_amount' - итоговая сумма (обычно в поле "Итого", "ИТОГ", "ВСЕГО К ОПЛАТЕ" или похожем), ЦЕЛОЕ ЧИСЛО, округленное до рублей. Если итоговая сумма не найдена, верни 0.
+Не добавляй никаких других пояснений или текста вне JSON.
+"""
+
+def build_restaurant_check_prompt(extracted_text: str) -> str:
+    extracted_text = compact_for_stage("classify", extracted_text)
+    return f"""
+Проанализируй следующий текст:
+--- ТЕКСТ ---
+{extracted_text}
+--- КОНЕЦ ТЕКСТА --- """ + """
+
+
+Является ли этот текст чеком из ресторана, кафе, бара или похожего заведения общепита?
+Верни ответ СТРОГО в формате JSON с одним булевым полем 'is_restaurant'.
+Пример: {{ "is_restaurant": true }} или {{ "is_restaurant": false }}
+Не добавляй никаких других пояснений или текста вне JSON.
+"""
+
+def build_positions_prompt(extracted_text: str) -> str:
+    extracted_text = compact_for_stage("positions", extracted_text)
+    # --- ИЗМЕНЕНО: Упрощенный промпт ---
+    return f"""
+Анализируй следующий текст, извлеченный из изображения чека:
+--- ТЕКСТ ЧЕКА ---
+{extracted_text}
+--- КОНЕЦ ТЕКСТА ЧЕКА ---""" + """
+
+Твоя задача:
+1.  Извлеки все позиции (блюда, напитки) с их ценами. Игнорируй строки типа "Итого", "Скидка", "Обслуживание", "НДС", "Официант" и т.п. Формируй результат как СПИСОК объектов в поле 'positions_list'. Каждый объект в списке должен содержать два поля: 'name' (строка, название позиции) и 'price' (**целое число int**, округленная цена в рублях). Если позиций нет, верни ПУСТОЙ СПИСОК `[]` для 'positions_list'. Старайся нормализовать названия.
+2.  Верни результат СТРОГО в формате JSON, соответствующем структуре: {{ "positions_list": [{{ "name": "...", "price": ЦЕЛОЕ_ЧИСЛО }}] }}. **Только поле 'positions_list' должно присутствовать в ответе.** Не добавляй никаких других пояснений или текста вне JSON.
+3.  Любые кавычки (одинарные и двойные) и другие символы, которые могут вызвать ошибки типа Invalid or unexpected token в JavaScript, не должны присутствовать в твоем ответе, замени на что-то другое или удали.
+"""
+
+def build_total_amount_prompt(extracted_text: str) -> str:
+    extracted_text = compact_for_stage("total", extracted_text)
+    return f"""
+Тебе дан текст чека:
+---Начало текста чека---
+{extracted_text}
+---Конец текста чека---
+Извлеки из этого чека итоговую сумму (обычно находится в поле "Итого", "ИТОГ", "ВСЕГО К ОПЛАТЕ" или похожем).
+Ответ выдай СТРОГО в формате JSON с одним полем "total_amount", значение которого - ЦЕЛОЕ ЧИСЛО (int). Если в чеке указана десятичная часть суммы, округли до ближайшего целого числа рублей. Если итоговая сумма не найдена, верни 0.
+Пример ответа: {{ "total_amount": 1234 }}
+Не давай никаких пояснений, только JSON."""
+
+def build_recommendations_prompt(extracted_text: str, num_people: int, tea_money: float, item_assignments: Dict[str, List[str]]) -> str:
+    assignments_str = "\n".join([f"- {name}: {', '.join(items)}" for name, items in item_assignments.items()])
+    if not assignments_str:
+        assignments_str = "Распределение блюд по людям не указано."
+
+    tea_money_int = int(round(tea_money))
+    extracted_text = compact_for_stage("split", extracted_text)
+
+    # --- ОБНОВЛЕННЫЙ ПРОМПТ без описаний ---
+    return f"""
+Проанализируй счет из ресторана/кафе и рассчитай варианты его разделения на {num_people} человек.
+
+--- ТЕКСТ СЧЕТА ---
+{extracted_text}
+--- КОНЕЦ ТЕКСТА СЧЕТА ---
+
+--- ДОПОЛНИТЕЛЬНАЯ ИНФОРМАЦИЯ ---
+- Количество человек: {num_people}
+- Желаемые чаевые (добавить к итогу, если не включены): {tea_money_int} (целое число рублей). Проверь, нет ли строк "Сервисный сбор", "Чаевые", или им подобных с этой же суммой (если округлять до целых рублей) в тексте счета - если есть, НЕ добавляй эти {tea_money_int} повторно.
+- Кто что ел/пил (если указано):
+{assignments_str}
+
+--- ЗАДАЧА ---
+
+Рассчитай доли для КАЖДОГО человека (с учетом скидок из чека и добавленных чаевых, если они не были включены в сам чек) по следующим методам деления (все суммы округляй до целых рублей):
+1.  `equally`: Разделить итоговую сумму поровну.
+2.  `who_more_eat_then_more_pay`: Разделить так, чтобы те, кто съел БОЛЬШЕ позиций (по количеству штук), заплатили больше. Если распределение блюд по людям не указано, используй равное деление.
+3.  `who_more_cost_then_more_pay`: Разделить так, чтобы те, кто заказал на БОЛЬШУЮ СУММУ (сумма их блюд), заплатили больше. Если распределение блюд по людям не указано, используй равное деление.
+4.  `proportional_division_by_the_cost_of_orders`: Разделить итоговую сумму ПРОПОРЦИОНАЛЬНО стоимости заказа каждого человека. Если распределение блюд по людям не указано, используй равное деление.
+
+Сформируй СПИСОК объектов `peoples_list`. Каждый объект в списке должен представлять одного человека и иметь два поля:
+    - `name`: Имя человека (из `item_assignments`, если есть, иначе используй "Человек 1", "Человек 2" и т.д.).
+    - `shares`: Объект со следующими полями (все **целые числа int**, округленные до целого деньги): `equally`, `who_more_eat_then_more_pay`, `who_more_cost_then_more_pay`, `proportional_division_by_the_cost_of_orders`.
+
+Верни результат СТРОГО в формате JSON, соответствующем структуре:""" + """
+{
+  "peoples_list": [
+    {
+      "name": "Имя1",
+      "shares": {
+        "equally": ЦЕЛОЕ,
+        "who_more_eat_then_more_pay": ЦЕЛОЕ,
+        "who_more_cost_then_more_pay": ЦЕЛОЕ,
+        "proportional_division_by_the_cost_of_orders": ЦЕЛОЕ
+      }
+    },
+    {
+      "name": "Имя2",
+      "shares": {
+        "equally": ЦЕЛОЕ,
+        "who_more_eat_then_more_pay": ЦЕЛОЕ,
+        "who_more_cost_then_more_pay": ЦЕЛОЕ,
+        "proportional_division_by_the_cost_of_orders": ЦЕЛОЕ
+      }
+    }
+  ]
+}
+и так далее
+**Все числовые значения сумм должны быть ЦЕЛЫМИ ЧИСЛАМИ (int).** Не добавляй никаких других пояснений или текста вне JSON. Валюта по умолчанию, если другая явно не указана в чеке - Российский рубль.
+"""
+
+RECOMMENDATION_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "peoples_list": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "shares": {
+                        "type": "object",
+                        "properties": {
+                            "equally": {"type": "integer"},
+                            "who_more_eat_then_more_pay": {"type": "integer"},
+                            "who_more_cost_then_more_pay": {"type": "integer"},
+                            "proportional_division_by_the_cost_of_orders": {"type": "integer"}
+                        },
+                        "required": ["equally", "who_more_eat_then_more_pay", "who_more_cost_then_more_pay", "proportional_division_by_the_cost_of_orders"]
+                    }
+                },
+                "required": ["name", "shares"]
+            }
+        }
+    },
+    "required": ["peoples_list"]
+}
+
+def strip_json_fences(json_text: str) -> str:
+    """Удаляет возможные артефакты ```json ... ``` вокруг ответа модели."""
+    return re.sub(r'^```json\s*|\s*```$', '', json_text, flags=re.MULTILINE | re.DOTALL).strip()
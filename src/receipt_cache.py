@@ -0,0 +1,202 @@
+# --- START OF FILE receipt_cache.py ---
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Переполненный дисковый кэш очищается с запасом - до этой доли disk_max_bytes, чтобы не обходить каталог на каждой записи
+DISK_PRUNE_TARGET = 0.9
+
+
+def image_cache_key(image_bytes: bytes) -> str:
+    """Ключ кэша - SHA-256 от байтов загруженного изображения."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class ReceiptCache:
+    """
+    Кэш результатов обработки чеков (OCR текст, позиции, итог), адресуемый по хэшу изображения.
+
+    Память: LRU с TTL и ограничением размера в байтах.
+    Диск (необязательно): JSON-файлы в disk_dir, переживают перезапуск процесса. Размер
+    каталога считается при старте и дальше ведется в памяти; каталог обходится (и самые
+    старые файлы удаляются) только когда размер превысил disk_max_bytes.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: int, disk_dir: Optional[str] = None, disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict() # key -> (stored_at, json_text)
+        self._current_bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._prune_lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expirations": 0}
+        if self.disk_dir and not os.path.exists(self.disk_dir):
+            os.makedirs(self.disk_dir)
+        if self.disk_dir:
+            self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Возвращает копию закэшированного результата или None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, json_text = entry
+                if now - stored_at <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return json.loads(json_text)
+                self._remove(key)
+                self._stats["expirations"] += 1
+
+        json_text, stored_at = self._disk_read(key, now)
+        with self._lock:
+            if json_text is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["disk_hits"] += 1
+            self._insert(key, stored_at, json_text) # Поднимаем запись с диска в память
+        return json.loads(json_text)
+
+    def put(self, key: str, value: Dict) -> None:
+        """Сохраняет результат в память и, если настроено, на диск."""
+        json_text = json.dumps(value, ensure_ascii=False)
+        stored_at = time.time()
+        with self._lock:
+            self._insert(key, stored_at, json_text)
+            self._stats["stores"] += 1
+        self._disk_write(key, stored_at, json_text)
+
+    def stats(self) -> Dict:
+        """Счетчики попаданий/промахов и текущий размер кэша."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._current_bytes
+            stats["max_bytes"] = self.max_bytes
+            stats["disk_bytes"] = self._disk_bytes
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        stats["disk_enabled"] = bool(self.disk_dir)
+        return stats
+
+    # --- Память (вызывать под self._lock) ---
+    def _insert(self, key: str, stored_at: float, json_text: str) -> None:
+        size = len(json_text.encode('utf-8'))
+        if size > self.max_bytes:
+            logger.info(f"Receipt cache entry {key[:12]} ({size} bytes) exceeds memory limit, not stored in memory.")
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (stored_at, json_text)
+        self._current_bytes += size
+        while self._current_bytes > self.max_bytes and self._entries:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self._stats["evictions"] += 1
+
+    def _remove(self, key: str) -> None:
+        _, json_text = self._entries.pop(key)
+        self._current_bytes -= len(json_text.encode('utf-8'))
+
+    # --- Диск ---
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_read(self, key: str, now: float):
+        if not self.disk_dir:
+            return None, None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+            stored_at = record["stored_at"]
+            if now - stored_at > self.ttl_seconds:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self._disk_add_bytes(-size)
+                return None, None
+            return json.dumps(record["value"], ensure_ascii=False), stored_at
+        except FileNotFoundError:
+            return None, None
+        except Exception as e:
+            logger.error(f"Error reading receipt cache file {path}: {e}")
+            return None, None
+
+    def _disk_write(self, key: str, stored_at: float, json_text: str) -> None:
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            data = f'{{"stored_at": {stored_at}, "value": {json_text}}}'.encode('utf-8')
+            try:
+                replaced_size = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced_size = 0
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path) # Атомарная замена, чтобы не читать недописанный файл
+            if self._disk_add_bytes(len(data) - replaced_size) > self.disk_max_bytes > 0:
+                self._disk_prune()
+        except Exception as e:
+            logger.error(f"Error writing receipt cache file {path}: {e}")
+
+    def _disk_add_bytes(self, delta: int) -> int:
+        with self._lock:
+            self._disk_bytes += delta
+            return self._disk_bytes
+
+    def _disk_files(self):
+        """[(mtime, размер, путь)] файлов дискового кэша."""
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and entry.name.endswith('.json'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _disk_prune(self) -> None:
+        """
+        Удаляет самые старые файлы, пока размер дискового кэша больше DISK_PRUNE_TARGET от
+        disk_max_bytes. Размер пересчитывается по каталогу: в него могут писать и другие процессы.
+        """
+        if not self._prune_lock.acquire(blocking=False):
+            return # Каталог уже очищает другой поток
+        try:
+            files = sorted(self._disk_files())
+            total = sum(size for _, size, _ in files)
+            target = self.disk_max_bytes * DISK_PRUNE_TARGET
+            for _, size, path in files:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+            with self._lock:
+                self._disk_bytes = total
+        finally:
+            self._prune_lock.release()
+
+
+def create_receipt_cache_from_env() -> ReceiptCache:
+    """Создает кэш по переменным окружения RECEIPT_CACHE_*."""
+    return ReceiptCache(
+        max_bytes=int(os.getenv("RECEIPT_CACHE_MAX_BYTES", 32 * 1024 * 1024)),
+        ttl_seconds=int(os.getenv("RECEIPT_CACHE_TTL", 24 * 60 * 60)),
+        disk_dir=os.getenv("RECEIPT_CACHE_DIR") or None,
+        disk_max_bytes=int(os.getenv("RECEIPT_CACHE_DISK_MAX_BYTES", 256 * 1024 * 1024)),
+    )
@@ -0,0 +1,232 @@
+# --- START OF FILE receipt_parser.py ---
+# Локальный разбор текста чека правилами (без LLM): итог и позиции с оценкой уверенности
+
+import logging
+import os
+import re
+import threading
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, List, Optional, Tuple
+
+from models import Positions, PositionItem
+from llm_backends import clean_position_names
+from metrics import record_rule_parser
+
+logger = logging.getLogger(__name__)
+
+_AMOUNT = r'\d{1,3}(?:[  ]\d{3})+(?:[.,]\d{1,2})?|\d+(?:[.,]\d{1,2})?'
+# Сумма, похожая на цену: с копейками ("450.00") - для строк без "кол-во x цена"
+_PRICE = r'\d{1,3}(?:[  ]\d{3})+[.,]\d{2}|\d+[.,]\d{2}'
+_RUBLES = r'(?:руб\.?|р\.?|₽)'
+_QTY = r'\d+(?:[.,]\d{1,3})?'
+_TIMES = r'\s*(?:шт\.?\s*)?[xх×*]\s*'
+_EQUALS = r'\s*[=≡]\s*'
+_LETTERS = re.compile(r'[A-Za-zА-Яа-яЁё]{2,}')
+
+# "Борщ 1 x 450 = 450", "Чай 2 шт x 150,00 ≡300,00", "Морс 1 x 220"
+_ROW_FULL_RE = re.compile(rf'^(?P<name>.+?)\s+(?P<qty>{_QTY}){_TIMES}(?P<price>{_AMOUNT})(?:{_EQUALS}(?P<sum>{_AMOUNT}))?\s*$', re.IGNORECASE)
+# Вторая строка позиции фискального чека: "1.000 x 450.00 ≡450.00" (название - строкой выше)
+_ROW_CALC_RE = re.compile(rf'^(?P<qty>{_QTY}){_TIMES}(?P<price>{_AMOUNT})(?:{_EQUALS}(?P<sum>{_AMOUNT}))?\s*$', re.IGNORECASE)
+# "Борщ ........ 450.00", "Борщ 450 руб" - только название и сумма; сумма - с копейками или с "руб"/"₽",
+# иначе любая строка с числом в конце ("д. 12, стр. 1") стала бы позицией
+_ROW_LOOSE_RE = re.compile(rf'^(?P<name>.+?)(?:\s*\.{{2,}}\s*|\s+)(?:(?P<price>{_PRICE})\s*{_RUBLES}?|(?P<rubles>{_AMOUNT})\s*{_RUBLES})$',
+                           re.IGNORECASE)
+_AMOUNT_ONLY_RE = re.compile(rf'^[=≡:\s]*(?P<amount>{_AMOUNT})\s*(?:руб\.?|р\.?|₽)?$', re.IGNORECASE)
+# Строки итога; чем больше ранг, тем надежнее ("к оплате" учитывает скидки и обслуживание)
+_TOTAL_RE = re.compile(rf'^(?P<label>всего\s+к\s+оплате|итого\s+к\s+оплате|к\s+оплате|итого|итог|всего)\b[^0-9]*(?P<amount>{_AMOUNT})?', re.IGNORECASE)
+_ROW_NUMBER_RE = re.compile(r'^\d{1,3}[.)]\s+')
+# Строки, которые не являются позициями (как в промпте get_positions). Слова - целиком или с начала слова:
+# подстроки "карт", "тел", "гост" есть и в названиях блюд ("Картофель фри", "Стейк из телятины")
+_NOT_POSITION_RE = re.compile(
+    r'\bитог|\bвсего\b|\bк\s+оплате\b|\bскидк|\bобслуживани|\bсервисн|\bчаев|\bндс\b|\bофициант|\bкассир|\bстол\b|'
+    r'\bгост(?:ь|и|ей|ям|ев\w*)\b|\bсмена\b|\bчек\b|\bинн\b|\bналичн|\bбезнал|\bкарт(?:а|ой|е|у|ы)\b|\bсдача\b|\bполучено\b|'
+    r'\bоплат(?:а|ы|ой|е)?\b|\bдата\b|\bвремя\b|\bфн\b|\bфд\b|\bфп\b|\bккт\b|\bсно\b|\bтел\b|www|http|'
+    r'\bсумма\b|\bооо\b|\bоао\b|\bзао\b|\bпао\b|\bип\b|\bкпп\b|\bогрн\b|'
+    # Адрес: "г. Москва", "ул. Ленина", "д. 12", "стр. 1" (но не "Стейк 200 г." в конце названия)
+    r'(?:^|[\s,])(?:г|ул|пр|пр-т|пер|ш|д|стр|корп|оф)\.\s*\w',
+    re.IGNORECASE)
+
+
+def _to_decimal(amount: str) -> Decimal:
+    return Decimal(amount.replace(' ', '').replace(' ', '').replace(',', '.'))
+
+
+def _to_rubles(amount: Decimal) -> int:
+    return int(amount.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def _total_rank(label: str) -> int:
+    label = label.lower()
+    if 'оплат' in label:
+        return 2
+    return 1 if label.startswith('итог') else 0
+
+
+class ParsedReceipt:
+    """Результат разбора правилами: позиции, итог, уверенность и причина (если итог не сошелся)."""
+
+    __slots__ = ("positions", "total_amount", "confidence", "reason", "loose_rows")
+
+    def __init__(self, positions: Positions, total_amount: Optional[int], confidence: float, reason: Optional[str],
+                 loose_rows: int = 0):
+        self.positions = positions
+        self.total_amount = total_amount
+        self.confidence = confidence
+        self.reason = reason
+        self.loose_rows = loose_rows # Позиции без "кол-во x цена": название угадано по числу в конце строки
+
+
+def find_total(lines: List[str]) -> Optional[Decimal]:
+    """Итоговая сумма: строка с самой надежной меткой, при равных - последняя."""
+    best = None # (rank, index, amount)
+    for index, line in enumerate(lines):
+        match = _TOTAL_RE.match(line)
+        if not match:
+            continue
+        amount_text = match.group('amount')
+        if amount_text is None and index + 1 < len(lines): # Сумма на следующей строке
+            next_match = _AMOUNT_ONLY_RE.match(lines[index + 1])
+            amount_text = next_match.group('amount') if next_match else None
+        if amount_text is None:
+            continue
+        candidate = (_total_rank(match.group('label')), index, _to_decimal(amount_text))
+        if best is None or candidate[:2] >= best[:2]:
+            best = candidate
+    return best[2] if best is not None else None
+
+
+def parse_positions(lines: List[str]) -> Tuple[List[Tuple[str, Decimal]], bool]:
+    """
+    Позиции (название, сумма строки) до первой строки итога.
+    Второе значение - все строки были в строгом формате "кол-во x цена = сумма" и сошлись,
+    третье - сколько позиций разобрано из строк только с названием и суммой.
+    """
+    items, strict, loose_rows = [], True, 0
+    pending_name = None
+    for line in lines:
+        if _TOTAL_RE.match(line):
+            break
+        match = _ROW_FULL_RE.match(line) or _ROW_CALC_RE.match(line)
+        if match:
+            name = match.groupdict().get('name') or pending_name
+            pending_name = None
+            if not name or not _LETTERS.search(name) or _NOT_POSITION_RE.search(name):
+                continue
+            qty, price = _to_decimal(match.group('qty')), _to_decimal(match.group('price'))
+            line_sum = _to_decimal(match.group('sum')) if match.group('sum') else qty * price
+            if abs(qty * price - line_sum) > Decimal('0.01'):
+                strict = False # OCR исказил цифры в строке
+            items.append((name, line_sum))
+            continue
+        match = _ROW_LOOSE_RE.match(line)
+        if match and _LETTERS.search(match.group('name')) and not _NOT_POSITION_RE.search(match.group('name')):
+            items.append((match.group('name'), _to_decimal(match.group('price') or match.group('rubles'))))
+            strict = False
+            loose_rows += 1
+            pending_name = None
+            continue
+        # Строка только с названием - возможно, цена на следующей строке (фискальный формат)
+        pending_name = line if _LETTERS.search(line) and not _NOT_POSITION_RE.search(line) and not re.search(r'\d', line) else None
+    return items, strict, loose_rows
+
+
+def _receipt_lines(extracted_text: str) -> List[str]:
+    lines = []
+    for raw_line in (extracted_text or '').splitlines():
+        line = _ROW_NUMBER_RE.sub('', raw_line.strip().strip('*').strip())
+        if line:
+            lines.append(line)
+    return lines
+
+
+def detect_total(extracted_text: str) -> Optional[int]:
+    """Итог, найденный только по строке итога ("ИТОГО", "К ОПЛАТЕ"), без разбора позиций; None - такой строки нет."""
+    total = find_total(_receipt_lines(extracted_text))
+    return _to_rubles(total) if total is not None else None
+
+
+def parse_receipt_text(extracted_text: str) -> ParsedReceipt:
+    """
+    Разбирает текст чека правилами. Уверенность 1.0 - строгие строки позиций и их сумма
+    совпала с итогом, 0.9 - сумма совпала, но часть строк без "кол-во x цена" (тогда -
+    до копейки: такая строка может оказаться реквизитом, и с допуском сумма сошлась бы
+    случайно), меньше 0.5 - итог не найден или не сошелся (нужен LLM).
+    """
+    lines = _receipt_lines(extracted_text)
+    total = find_total(lines)
+    rows, strict, loose_rows = parse_positions(lines)
+    items = [PositionItem(name=re.sub(r'[\s.]+$', '', name).strip(), price=_to_rubles(line_sum)) for name, line_sum in rows]
+    positions = clean_position_names(Positions(positions_list=items))
+    total_amount = _to_rubles(total) if total is not None else None
+
+    if total is None:
+        return ParsedReceipt(positions, None, 0.0, "no_total", loose_rows)
+    if not rows:
+        return ParsedReceipt(positions, total_amount, 0.0, "no_items", loose_rows)
+    items_sum = sum(line_sum for _, line_sum in rows)
+    tolerance = Decimal(0) if loose_rows else Decimal(1) # Допуск - округление копеек
+    if abs(items_sum - total) > tolerance:
+        ratio = float(min(items_sum, total) / max(items_sum, total)) if max(items_sum, total) > 0 else 0.0
+        return ParsedReceipt(positions, total_amount, round(0.5 * ratio, 3), "mismatch", loose_rows)
+    return ParsedReceipt(positions, total_amount, 1.0 if strict else 0.9, None, loose_rows)
+
+
+class RuleParserStats:
+    """Сколько чеков разобрано правилами (вызовы LLM пропущены), а сколько ушло в LLM и почему."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = {"hits": 0, "fallbacks": 0}
+        self._reasons: Dict[str, int] = {}
+
+    def record(self, hit: bool, reason: Optional[str] = None) -> None:
+        with self._lock:
+            self._counts["hits" if hit else "fallbacks"] += 1
+            if not hit:
+                self._reasons[reason or "low_confidence"] = self._reasons.get(reason or "low_confidence", 0) + 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._counts)
+            stats["fallback_reasons"] = dict(self._reasons)
+        parsed = stats["hits"] + stats["fallbacks"]
+        stats["hit_rate"] = round(stats["hits"] / parsed, 4) if parsed else 0.0
+        stats["fallback_rate"] = round(stats["fallbacks"] / parsed, 4) if parsed else 0.0
+        stats["llm_calls_saved"] = stats["hits"] * 2 # get_positions и get_total_amount
+        return stats
+
+
+class RuleParser:
+    """Быстрый путь перед LLM: результат разбора, если уверенность не ниже min_confidence, иначе None."""
+
+    def __init__(self, enabled: bool = True, min_confidence: float = 0.9):
+        self.enabled = enabled
+        self.min_confidence = min_confidence
+        self.counters = RuleParserStats()
+
+    def parse(self, extracted_text: str) -> Optional[ParsedReceipt]:
+        if not self.enabled or not extracted_text:
+            return None
+        parsed = parse_receipt_text(extracted_text)
+        hit = parsed.confidence >= self.min_confidence
+        self.counters.record(hit, parsed.reason)
+        record_rule_parser(hit)
+        if hit:
+            logger.info(f"Rule parser hit: items={len(parsed.positions.positions_list)}, total_amount={parsed.total_amount}, confidence={parsed.confidence}")
+            return parsed
+        logger.info(f"Rule parser fallback to LLM: reason={parsed.reason or 'low_confidence'}, confidence={parsed.confidence}")
+        return None
+
+    def stats(self) -> Dict:
+        stats = self.counters.stats()
+        stats["enabled"] = self.enabled
+        stats["min_confidence"] = self.min_confidence
+        return stats
+
+
+def create_rule_parser_from_env() -> RuleParser:
+    """Создает парсер по RULE_PARSER и RULE_PARSER_MIN_CONFIDENCE."""
+    return RuleParser(
+        enabled=os.getenv("RULE_PARSER", "True").lower() == "true",
+        min_confidence=float(os.getenv("RULE_PARSER_MIN_CONFIDENCE", 0.9)),
+    )
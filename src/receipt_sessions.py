@@ -0,0 +1,210 @@
+# --- START OF FILE receipt_sessions.py ---
+# Серверные сессии чеков: позиции и итог хранятся по receipt_id, /calculate_split получает только изменения
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from models import Positions
+from shared_store import SharedStore, pack_positions, unpack_positions, encode_record, decode_record
+
+logger = logging.getLogger(__name__)
+
+
+class ReceiptSession:
+    """Разобранный чек и последнее состояние деления (кол-во людей, чаевые, распределение позиций)."""
+
+    __slots__ = ("receipt_id", "positions", "total_amount", "extracted_text", "num_people", "tea_money",
+                 "item_assignments", "touched_at", "size")
+
+    def __init__(self, positions: Positions, total_amount: int, extracted_text: str, receipt_id: Optional[str] = None):
+        self.receipt_id = receipt_id or uuid.uuid4().hex
+        self.positions = positions
+        self.total_amount = total_amount
+        self.extracted_text = extracted_text
+        self.num_people: Optional[int] = None
+        self.tea_money = 0.0
+        self.item_assignments: Dict[str, List[str]] = {}
+        self.touched_at = time.time()
+        self.size = len((extracted_text or '').encode('utf-8')) + len(positions.json().encode('utf-8'))
+
+
+def encode_session(session: ReceiptSession) -> bytes:
+    """Сессия в компактной записи общего хранилища (позиции - списками [название, цена])."""
+    return encode_record({"p": pack_positions(session.positions), "a": session.total_amount, "t": session.extracted_text,
+                          "n": session.num_people, "m": session.tea_money, "i": session.item_assignments})
+
+
+def decode_session(receipt_id: str, data: bytes) -> ReceiptSession:
+    record = decode_record(data)
+    session = ReceiptSession(unpack_positions(record["p"]), record["a"], record["t"], receipt_id=receipt_id)
+    session.num_people, session.tea_money, session.item_assignments = record["n"], record["m"], record["i"]
+    return session
+
+
+def merge_assignments(current: Dict[str, List[str]], changes: Dict[str, Optional[List[str]]]) -> Dict[str, List[str]]:
+    """Применяет изменения распределения: список заменяет позиции человека, null удаляет человека."""
+    merged = dict(current)
+    for person, items in changes.items():
+        if items is None:
+            merged.pop(person, None)
+        else:
+            merged[person] = list(items)
+    return merged
+
+
+class ReceiptSessionStore:
+    """
+    Хранилище сессий чеков в памяти: LRU с TTL (отсчитывается от последнего обращения),
+    ограничением числа сессий и суммарного размера позиций и текста в байтах.
+    С shared_store сессии (и состояние деления) видны всем процессам: сессия, которой
+    нет в памяти этого процесса, читается из общего хранилища.
+    """
+
+    def __init__(self, max_sessions: int, max_bytes: int, ttl_seconds: int, shared_store: Optional[SharedStore] = None):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.shared_store = shared_store
+        self._sessions: "OrderedDict[str, ReceiptSession]" = OrderedDict()
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"created": 0, "hits": 0, "shared_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def create(self, positions: Positions, total_amount: int, extracted_text: str) -> str:
+        session = ReceiptSession(positions, total_amount, extracted_text)
+        with self._lock:
+            self._stats["created"] += 1
+            self._insert(session)
+        self._share(session)
+        return session.receipt_id
+
+    def _insert(self, session: ReceiptSession) -> None:
+        """Добавляет сессию в память, вытесняя самые старые (вызывать под self._lock)."""
+        self._expire(session.touched_at)
+        self._sessions[session.receipt_id] = session
+        self._current_bytes += session.size
+        while self._sessions and (len(self._sessions) > self.max_sessions or self._current_bytes > self.max_bytes):
+            _, oldest = self._sessions.popitem(last=False)
+            self._current_bytes -= oldest.size
+            self._stats["evictions"] += 1
+
+    def _share(self, session: ReceiptSession) -> None:
+        if self.shared_store is not None:
+            self.shared_store.write(f"session:{session.receipt_id}", session, encode_session, self.ttl_seconds)
+
+    def get(self, receipt_id: str) -> Optional[ReceiptSession]:
+        """Сессия по receipt_id (продлевает TTL) или None, если ее нет или она истекла."""
+        # Общее хранилище читается первым: сессию мог создать или изменить другой процесс
+        shared = self.shared_store.read(f"session:{receipt_id}", lambda data: decode_session(receipt_id, data)) \
+            if self.shared_store is not None else None
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(receipt_id)
+            if session is None and shared is not None:
+                self._stats["shared_hits"] += 1
+                self._insert(shared)
+                return shared
+            if session is None:
+                self._stats["misses"] += 1
+                return None
+            if shared is not None: # Состояние деления из другого процесса новее копии в памяти
+                session.num_people, session.tea_money, session.item_assignments = \
+                    shared.num_people, shared.tea_money, shared.item_assignments
+            session.touched_at = now
+            self._sessions.move_to_end(receipt_id)
+            self._stats["hits"] += 1
+            return session
+
+    def save_state(self, session: ReceiptSession, num_people: int, tea_money: float, item_assignments: Dict[str, List[str]]) -> None:
+        """Запоминает состояние деления, относительно которого придут следующие изменения."""
+        with self._lock:
+            session.num_people = num_people
+            session.tea_money = tea_money
+            session.item_assignments = item_assignments
+        self._share(session) # Заодно продлевает TTL сессии в общем хранилище
+
+    def _expire(self, now: float) -> None:
+        """Удаляет сессии старше ttl_seconds с последнего обращения (вызывать под self._lock)."""
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if now - oldest.touched_at <= self.ttl_seconds:
+                break
+            del self._sessions[oldest.receipt_id]
+            self._current_bytes -= oldest.size
+            self._stats["expirations"] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["sessions"] = len(self._sessions)
+            stats["bytes"] = self._current_bytes
+            stats["max_sessions"] = self.max_sessions
+            stats["max_bytes"] = self.max_bytes
+            stats["ttl_seconds"] = self.ttl_seconds
+        return stats
+
+
+class SplitMemo:
+    """LRU-кэш рассчитанных делений: одинаковые входные данные - готовый ответ без пересчета."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def make_key(receipt_key: str, total_amount: int, num_people: int, tea_money: float, item_assignments: Dict[str, List[str]]) -> str:
+        """receipt_key - receipt_id сессии или JSON позиций, если расчет без сессии."""
+        canonical = json.dumps([receipt_key, total_amount, num_people, tea_money, item_assignments], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def put(self, key: str, value: Dict) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["max_entries"] = self.max_entries
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+def create_session_store_from_env(shared_store: Optional[SharedStore] = None) -> ReceiptSessionStore:
+    """Создает хранилище сессий по RECEIPT_SESSION_*."""
+    return ReceiptSessionStore(
+        max_sessions=int(os.getenv("RECEIPT_SESSION_MAX", 10000)),
+        max_bytes=int(os.getenv("RECEIPT_SESSION_MAX_BYTES", 64 * 1024 * 1024)),
+        ttl_seconds=int(os.getenv("RECEIPT_SESSION_TTL", 2 * 60 * 60)),
+        shared_store=shared_store,
+    )
+
+
+def create_split_memo_from_env() -> SplitMemo:
+    return SplitMemo(max_entries=int(os.getenv("SPLIT_MEMO_SIZE", 1024)))
@@ -0,0 +1,174 @@
+# --- START OF FILE restaurant_classifier.py ---
+# Локальная проверка "чек из ресторана?" по ключевым словам и структуре текста (до вызова LLM)
+
+import logging
+import os
+import random
+import re
+import threading
+from collections import deque
+from concurrent.futures import Executor
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from metrics import record_restaurant_classifier
+
+logger = logging.getLogger(__name__)
+
+# (шаблон, вес): положительные - признаки ресторана/кафе, отрицательные - других чеков
+RESTAURANT_SIGNALS: List[Tuple[str, float]] = [
+    (r'официант', 3.0),
+    (r'\bстол(?:ик)?\b|\bстол\s*(?:№|n)?\s*\d', 2.0),
+    (r'гост(?:ей|и|ь)\b|кол-?во\s+персон|\bперсон\b', 2.0),
+    # Только названия заведений: "гриль", "суши" встречаются и в названиях товаров магазина ("курица гриль")
+    (r'ресторан|кафе\b|\bбар\b|кофейн|пиццери|бистро|трактир|таверн|\bпаб\b|закусочн|столов|чайхон|шаурмичн|бургерн', 2.5),
+    (r'пречек|гостевой\s+сч[её]т|сч[её]т\s*(?:№|n)|\bсч[её]т\b', 1.5),
+    (r'обслуживани|сервисн\w*\s+сбор|чаев', 1.5),
+    (r'\bзал\b|веранд|\bкухн[яи]\b|\bбарн\w*', 1.0),
+    (r'магазин|супермаркет|гипермаркет|пят[её]рочка|перекр[её]ст|магнит|ашан|лента\b|вкусвилл|дикси|окей\b', -3.0),
+    (r'\bазс\b|топлив|бензин|дизел|\bаи-?9[25]|\bколонк', -3.0),
+    (r'аптек|лекарств|таблет|рецепт', -3.0),
+    (r'такси|поездк|маршрут', -2.0),
+    (r'\bвес\b|\d\s*кг\b|штрих-?код|артикул', -1.0),
+]
+# Блюда и напитки, которые подают, а не продают упакованными: каждое совпадение добавляет MENU_WORD_WEIGHT,
+# но не больше MENU_WORDS_MAX. Товары магазинов и АЗС (пельмени, сок, чай, пиво, кофе, салат, пицца) не считаются -
+# по ним продуктовый чек не отличить от ресторанного (пороги подобраны на benchmarks/fixtures/restaurant_labels.json)
+MENU_WORDS = (r'борщ|солянк|бургер|хачапури|хинкал|шаурм|плов|гарнир|тирамису|капучино|латте|эспрессо|американо|'
+              r'\bраф\b|коктейл|глинтвейн|бизнес-?ланч|\bпорци')
+MENU_WORD_WEIGHT = 0.5
+MENU_WORDS_MAX = 3.0
+# Без строки итога и без сумм текст, скорее всего, вообще не чек
+_TOTAL_LINE_RE = re.compile(r'итог|всего|к\s+оплате', re.IGNORECASE)
+_AMOUNT_RE = re.compile(r'\d+[.,]\d{2}\b|\d+\s*(?:руб|р\.|₽)|[=≡]\s*\d+', re.IGNORECASE)
+NO_RECEIPT_PENALTY = -3.0
+
+_COMPILED_SIGNALS = [(re.compile(pattern, re.IGNORECASE), weight) for pattern, weight in RESTAURANT_SIGNALS]
+_MENU_RE = re.compile(MENU_WORDS, re.IGNORECASE)
+
+# Сколько последних неуверенных случаев хранить для подбора порогов
+SCORE_SAMPLES = 200
+
+
+def restaurant_score(extracted_text: str) -> float:
+    """Взвешенная сумма признаков ресторанного чека (микросекунды, без сети)."""
+    text = extracted_text or ''
+    score = sum(weight for pattern, weight in _COMPILED_SIGNALS if pattern.search(text))
+    score += min(len(_MENU_RE.findall(text)) * MENU_WORD_WEIGHT, MENU_WORDS_MAX)
+    if not _TOTAL_LINE_RE.search(text) and not _AMOUNT_RE.search(text):
+        score += NO_RECEIPT_PENALTY
+    return score
+
+
+class RestaurantClassifier:
+    """
+    Локальный классификатор перед is_restaurant_check: score >= yes_threshold - ресторан,
+    score <= no_threshold - не ресторан, между порогами решает LLM. Доля audit_rate
+    уверенных решений в фоне перепроверяется LLM, согласие пишется в лог и статистику.
+    """
+
+    def __init__(self, enabled: bool = True, yes_threshold: float = 3.5, no_threshold: float = -1.5,
+                 audit_rate: float = 0.0, audit_executor: Optional[Executor] = None):
+        self.enabled = enabled
+        self.yes_threshold = yes_threshold
+        self.no_threshold = no_threshold
+        self.audit_rate = audit_rate
+        self.audit_executor = audit_executor
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._stats = {"local_yes": 0, "local_no": 0, "ambiguous": 0, "audited": 0, "audit_agreed": 0, "audit_disagreed": 0}
+        self._ambiguous_scores = deque(maxlen=SCORE_SAMPLES) # (score, ответ LLM)
+
+    def local_verdict(self, extracted_text: str, llm_classify: Optional[Callable[[str], Optional[bool]]] = None) -> Optional[bool]:
+        """
+        Решение без LLM или None, если score в неуверенной полосе.
+        llm_classify нужен для фоновой перепроверки уверенных решений.
+        """
+        if not self.enabled or not extracted_text:
+            return None
+        score = restaurant_score(extracted_text)
+        if score >= self.yes_threshold:
+            verdict = True
+        elif score <= self.no_threshold:
+            verdict = False
+        else:
+            with self._lock:
+                self._stats["ambiguous"] += 1
+            record_restaurant_classifier("ambiguous")
+            logger.info(f"Restaurant classifier ambiguous (score={score}), asking LLM.")
+            return None
+        with self._lock:
+            self._stats["local_yes" if verdict else "local_no"] += 1
+            audit = llm_classify is not None and self.audit_executor is not None and self._random.random() < self.audit_rate
+        record_restaurant_classifier("yes" if verdict else "no")
+        logger.info(f"Restaurant classifier decided locally: is_restaurant={verdict} (score={score}).")
+        if audit:
+            self.audit_executor.submit(self._audit, extracted_text, score, verdict, llm_classify)
+        return verdict
+
+    def classify(self, extracted_text: str, llm_classify: Callable[[str], Optional[bool]]) -> Optional[bool]:
+        """Локальное решение, а для неуверенных случаев - ответ LLM."""
+        verdict = self.local_verdict(extracted_text, llm_classify)
+        if verdict is not None:
+            return verdict
+        return self.llm_verdict(extracted_text, llm_classify)
+
+    def llm_verdict(self, extracted_text: str, llm_classify: Callable[[str], Optional[bool]]) -> Optional[bool]:
+        """Ответ LLM для неуверенного случая; score и ответ запоминаются для подбора порогов."""
+        verdict = llm_classify(extracted_text)
+        self._remember_llm_verdict(extracted_text, verdict)
+        return verdict
+
+    async def llm_verdict_async(self, extracted_text: str, llm_classify_async: Callable[[str], Awaitable[Optional[bool]]]) -> Optional[bool]:
+        """llm_verdict с асинхронным вызовом LLM (ASGI-режим)."""
+        verdict = await llm_classify_async(extracted_text)
+        self._remember_llm_verdict(extracted_text, verdict)
+        return verdict
+
+    def _remember_llm_verdict(self, extracted_text: str, verdict: Optional[bool]) -> None:
+        if self.enabled and extracted_text and verdict is not None:
+            score = restaurant_score(extracted_text)
+            with self._lock:
+                self._ambiguous_scores.append((score, verdict))
+            logger.info(f"Restaurant classifier ambiguous case resolved by LLM: score={score}, llm={verdict}")
+
+    def _audit(self, extracted_text: str, score: float, verdict: bool, llm_classify: Callable[[str], Optional[bool]]) -> None:
+        try:
+            llm_verdict = llm_classify(extracted_text)
+        except Exception as e:
+            logger.error(f"Restaurant classifier audit failed: {e}")
+            return
+        if llm_verdict is None:
+            return
+        agreed = llm_verdict == verdict
+        with self._lock:
+            self._stats["audited"] += 1
+            self._stats["audit_agreed" if agreed else "audit_disagreed"] += 1
+        log = logger.info if agreed else logger.warning
+        log(f"Restaurant classifier audit: score={score}, local={verdict}, llm={llm_verdict}, agree={agreed}")
+
+    def stats(self) -> Dict:
+        """Решения локально/через LLM, согласие с LLM и средний score неуверенных случаев по ответу LLM."""
+        with self._lock:
+            stats = dict(self._stats)
+            samples = list(self._ambiguous_scores)
+        decided = stats["local_yes"] + stats["local_no"]
+        total = decided + stats["ambiguous"]
+        stats["local_rate"] = round(decided / total, 4) if total else 0.0
+        stats["llm_calls_saved"] = decided - stats["audited"] # Перепроверки тоже вызывают LLM
+        stats["audit_agreement"] = round(stats["audit_agreed"] / stats["audited"], 4) if stats["audited"] else None
+        for llm_verdict, key in ((True, "ambiguous_llm_yes"), (False, "ambiguous_llm_no")):
+            scores = [score for score, verdict in samples if verdict is llm_verdict]
+            stats[key] = {"count": len(scores), "mean_score": round(sum(scores) / len(scores), 2) if scores else None}
+        stats.update(enabled=self.enabled, yes_threshold=self.yes_threshold, no_threshold=self.no_threshold, audit_rate=self.audit_rate)
+        return stats
+
+
+def create_restaurant_classifier_from_env(audit_executor: Optional[Executor] = None) -> RestaurantClassifier:
+    """Создает классификатор по RESTAURANT_CLASSIFIER_*."""
+    return RestaurantClassifier(
+        enabled=os.getenv("RESTAURANT_CLASSIFIER", "True").lower() == "true",
+        yes_threshold=float(os.getenv("RESTAURANT_CLASSIFIER_YES", 3.5)),
+        no_threshold=float(os.getenv("RESTAURANT_CLASSIFIER_NO", -1.5)),
+        audit_rate=float(os.getenv("RESTAURANT_CLASSIFIER_AUDIT_RATE", 0.02)),
+        audit_executor=audit_executor,
+    )
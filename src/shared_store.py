@@ -0,0 +1,367 @@
+# --- START OF FILE shared_store.py ---
+# Общее для нескольких процессов хранилище результатов (разбор чеков, сессии, деления) с атомарным get-or-compute
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from models import PersonShare, PersonShareItem, PositionItem, Positions, Recommendation
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Записи длиннее порога сжимаются zlib (текст чека сжимается в 3-4 раза)
+COMPRESS_MIN_BYTES = 512
+# Пока держатель аренды считает результат, остальные процессы перечитывают ключ с этим интервалом
+LEASE_POLL_SECONDS = 0.05
+
+
+# --- Компактная сериализация ---
+def pack_positions(positions: Positions) -> List[list]:
+    """Positions -> [[название, цена], ...] (без имен полей в каждой позиции)."""
+    return [[item.name, item.price] for item in positions.positions_list]
+
+
+def unpack_positions(packed: List[list]) -> Positions:
+    return Positions(positions_list=[PositionItem(name=name, price=price) for name, price in packed])
+
+
+_SHARE_FIELDS = ("equally", "who_more_eat_then_more_pay", "who_more_cost_then_more_pay", "proportional_division_by_the_cost_of_orders")
+
+
+def pack_recommendation(recommendation: Recommendation) -> List[list]:
+    """Recommendation -> [[имя, equally, who_more_eat, who_more_cost, proportional], ...]."""
+    return [[person.name] + [getattr(person.shares, field) for field in _SHARE_FIELDS] for person in recommendation.peoples_list]
+
+
+def unpack_recommendation(packed: List[list]) -> Recommendation:
+    return Recommendation(peoples_list=[PersonShareItem(name=row[0], shares=PersonShare(**dict(zip(_SHARE_FIELDS, row[1:]))))
+                                        for row in packed])
+
+
+def encode_record(record) -> bytes:
+    """JSON без пробелов; длинные записи - zlib. Первый байт - формат (j или z)."""
+    data = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(data) >= COMPRESS_MIN_BYTES:
+        return b"z" + zlib.compress(data, 6)
+    return b"j" + data
+
+
+def decode_record(data: bytes):
+    if data[:1] == b"z":
+        return json.loads(zlib.decompress(data[1:]))
+    return json.loads(data[1:])
+
+
+def encode_receipt_result(result: Tuple[Dict, int]) -> Optional[bytes]:
+    """(ответ /preprocess_receipt, статус) -> запись хранилища; ошибки не сохраняются (None)."""
+    response_data, status_code = result
+    if status_code != 200:
+        return None
+    extra = {key: value for key, value in response_data.items()
+             if key not in ("positions_list", "is_restaurant", "extracted_text", "total_amount_detected", "receipt_id", "cache_hit")}
+    try:
+        positions = pack_positions(Positions(positions_list=response_data.get("positions_list") or []))
+    except Exception as e:
+        logger.error(f"Receipt result not shared, invalid positions_list: {e}")
+        return None
+    return encode_record({"p": positions, "r": bool(response_data.get("is_restaurant")), "t": response_data.get("extracted_text", ""),
+                          "a": response_data.get("total_amount_detected", 0), "x": extra})
+
+
+def decode_receipt_result(data: bytes) -> Tuple[Dict, int]:
+    record = decode_record(data)
+    response_data = unpack_positions(record["p"]).dict()
+    response_data.update(is_restaurant=record["r"], extracted_text=record["t"], total_amount_detected=record["a"], **record["x"])
+    return response_data, 200
+
+
+# --- Хранилища ---
+class SharedStore:
+    """
+    Интерфейс общего хранилища: байтовые значения по строковому ключу с TTL.
+    Пять операций соответствуют командам Redis-совместимого сервиса:
+    get - GET, set - SET key value EX ttl, add - SET key value NX EX ttl, delete - DEL,
+    delete_if - DEL, только если значение совпадает (скрипт EVAL из документации Redis о блокировках).
+    На них построен get_or_compute: результат считает один процесс (держатель аренды
+    "lease:<ключ>" со своим токеном), остальные ждут его в хранилище, а не вызывают модель второй раз.
+    """
+    name = "base"
+
+    def __init__(self, lease_seconds: float = 60.0):
+        self.lease_seconds = lease_seconds # Дольше самого медленного расчета; после - аренда считается брошенной
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "sets": 0, "computed": 0, "waited": 0, "lease_timeouts": 0, "errors": 0}
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl_seconds: float) -> None:
+        raise NotImplementedError
+
+    def add(self, key: str, value: bytes, ttl_seconds: float) -> bool:
+        """Записывает значение, только если ключа нет (или он истек); True - записано."""
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def delete_if(self, key: str, value: bytes) -> bool:
+        """Удаляет ключ, только если в нем value (сравнение и удаление атомарны); True - удален."""
+        raise NotImplementedError
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def read(self, key: str, decode: Callable[[bytes], T], count: bool = True) -> Optional[T]:
+        """Значение по ключу или None (нет, истекло, хранилище недоступно)."""
+        try:
+            data = self.get(key)
+            value = decode(data) if data is not None else None
+        except Exception as e:
+            logger.error(f"Shared store read failed for {key}: {e}")
+            self._count("errors")
+            return None
+        if count:
+            self._count("hits" if value is not None else "misses")
+        return value
+
+    def write(self, key: str, value: T, encode: Callable[[T], Optional[bytes]], ttl_seconds: float) -> None:
+        """Сохраняет значение (encode вернул None - не сохраняется); ошибки хранилища только пишутся в лог."""
+        try:
+            data = encode(value)
+            if data is not None:
+                self.set(key, data, ttl_seconds)
+                self._count("sets")
+        except Exception as e:
+            logger.error(f"Shared store write failed for {key}: {e}")
+            self._count("errors")
+
+    def _step(self, key: str, decode: Callable[[bytes], T], token: bytes, deadline: float, waited: bool):
+        """
+        Один шаг get-or-compute: ("done", значение) - значение уже в хранилище; ("compute", True/False) -
+        считать самим (с арендой или без, если держатель не успел за lease_seconds); ("wait", None) - ждать.
+        """
+        value = self.read(key, decode, count=not waited)
+        if value is not None:
+            if waited:
+                self._count("waited")
+            return "done", value
+        try:
+            if self.add(f"lease:{key}", token, self.lease_seconds):
+                return "compute", True
+        except Exception as e:
+            logger.error(f"Shared store lease failed for {key}: {e}")
+            self._count("errors")
+            return "compute", False # Хранилище недоступно - считаем сами, как без него
+        if time.monotonic() > deadline:
+            self._count("lease_timeouts")
+            return "compute", False
+        return "wait", None
+
+    def _finish(self, key: str, value: T, encode: Callable[[T], Optional[bytes]], ttl_seconds: float) -> None:
+        self.write(key, value, encode, ttl_seconds)
+        self._count("computed")
+
+    def _release(self, key: str, token: bytes) -> None:
+        """
+        Снимает свою аренду. Держатель, считавший дольше lease_seconds, мог потерять ее: аренду
+        уже взял другой процесс, и удалять ее нельзя - сравниваем токен.
+        """
+        try:
+            if not self.delete_if(f"lease:{key}", token):
+                logger.warning(f"Shared store lease for {key} expired before release and was taken over.")
+        except Exception as e:
+            logger.error(f"Shared store lease release failed for {key}: {e}")
+
+    def claim(self, key: str, decode: Callable[[bytes], T]) -> Tuple[Optional[T], str, Optional[bytes]]:
+        """
+        Первая половина get_or_compute - для результатов, которые нельзя получить одним вызовом
+        compute() (потоковый ответ). Возвращает (значение, "hit"/"waited", None), если значение
+        уже в хранилище, или (None, "compute", токен): считать самим и затем вызвать finish_claim
+        (токен None - без аренды: хранилище недоступно или держатель не успел за lease_seconds).
+        """
+        token, deadline, waited = uuid.uuid4().hex.encode("ascii"), time.monotonic() + self.lease_seconds, False
+        state, value = self._step(key, decode, token, deadline, waited)
+        while state == "wait":
+            waited = True
+            time.sleep(LEASE_POLL_SECONDS)
+            state, value = self._step(key, decode, token, deadline, waited)
+        if state == "done":
+            return value, "waited" if waited else "hit", None
+        return None, "compute", token if value else None
+
+    def finish_claim(self, key: str, token: Optional[bytes], value: Optional[T] = None,
+                     encode: Optional[Callable[[T], Optional[bytes]]] = None, ttl_seconds: float = 0.0) -> None:
+        """Сохраняет посчитанное после claim значение (None - расчет не удался) и снимает аренду."""
+        try:
+            if value is not None:
+                self._finish(key, value, encode, ttl_seconds)
+        finally:
+            if token is not None:
+                self._release(key, token)
+
+    def get_or_compute(self, key: str, compute: Callable[[], T], encode: Callable[[T], Optional[bytes]],
+                       decode: Callable[[bytes], T], ttl_seconds: float) -> Tuple[T, str]:
+        """
+        Значение из хранилища или результат compute(), посчитанный одним процессом.
+        Возвращает (значение, источник): "hit", "waited" (посчитал другой процесс) или "computed".
+        """
+        value, source, token = self.claim(key, decode)
+        if source != "compute":
+            return value, source
+        try:
+            value = compute()
+            self._finish(key, value, encode, ttl_seconds)
+            return value, "computed"
+        finally:
+            if token is not None:
+                self._release(key, token)
+
+    async def get_or_compute_async(self, key: str, compute: Callable[[], Awaitable[T]], encode: Callable[[T], Optional[bytes]],
+                                   decode: Callable[[bytes], T], ttl_seconds: float) -> Tuple[T, str]:
+        """
+        get_or_compute для event loop: ожидание аренды - asyncio.sleep, а обращения к хранилищу
+        (файл SQLite или сеть) - в пуле потоков, чтобы не останавливать остальные запросы.
+        """
+        token, deadline, waited = uuid.uuid4().hex.encode("ascii"), time.monotonic() + self.lease_seconds, False
+        state, value = await asyncio.to_thread(self._step, key, decode, token, deadline, waited)
+        while state == "wait":
+            waited = True
+            await asyncio.sleep(LEASE_POLL_SECONDS)
+            state, value = await asyncio.to_thread(self._step, key, decode, token, deadline, waited)
+        if state == "done":
+            return value, "waited" if waited else "hit"
+        leased = value
+        try:
+            value = await compute()
+            await asyncio.to_thread(self._finish, key, value, encode, ttl_seconds)
+            return value, "computed"
+        finally:
+            if leased:
+                await asyncio.to_thread(self._release, key, token)
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["backend"] = self.name
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+class SQLiteSharedStore(SharedStore):
+    """
+    Хранилище в файле SQLite для процессов на одной машине (несколько waitress за балансировщиком).
+    WAL-журнал позволяет читать во время записи, mmap_size - читать страницы через отображение
+    файла в память без копирования. Истекшие записи не отдаются и удаляются каждые PRUNE_EVERY
+    записей вместе с самыми старыми сверх max_entries.
+    """
+    name = "sqlite"
+    PRUNE_EVERY = 256
+
+    def __init__(self, path: str, max_entries: int = 100000, mmap_bytes: int = 64 * 1024 * 1024, lease_seconds: float = 60.0):
+        super().__init__(lease_seconds)
+        self.path = path
+        self.max_entries = max_entries
+        self.mmap_bytes = mmap_bytes
+        self._local = threading.local() # Соединение SQLite - свое у каждого потока
+        self._writes = 0
+        # В хранилище тексты чеков и сессии: файл доступен только владельцу (журналы WAL SQLite создает с теми же правами)
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None) # autocommit: каждая команда - транзакция
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL") # Кэш: потеря последних записей при сбое питания допустима
+            connection.execute(f"PRAGMA mmap_size={int(self.mmap_bytes)}")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self._connection().execute("SELECT value FROM entries WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return bytes(row[0]) if row is not None else None
+
+    def set(self, key: str, value: bytes, ttl_seconds: float) -> None:
+        self._connection().execute("INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+                                   (key, value, time.time() + ttl_seconds))
+        self._after_write()
+
+    def add(self, key: str, value: bytes, ttl_seconds: float) -> bool:
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT INTO entries (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at WHERE entries.expires_at <= ?",
+            (key, value, now + ttl_seconds, now))
+        return cursor.rowcount == 1
+
+    def delete(self, key: str) -> None:
+        self._connection().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def delete_if(self, key: str, value: bytes) -> bool:
+        cursor = self._connection().execute("DELETE FROM entries WHERE key = ? AND value = ?", (key, value))
+        return cursor.rowcount == 1
+
+    def _after_write(self) -> None:
+        with self._stats_lock:
+            self._writes += 1
+            prune = self._writes % self.PRUNE_EVERY == 0
+        if not prune:
+            return
+        connection = self._connection()
+        connection.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),))
+        if self.max_entries > 0:
+            connection.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                               (self.max_entries,))
+
+    def stats(self) -> Dict:
+        stats = super().stats()
+        try:
+            stats["entries"] = self._connection().execute("SELECT COUNT(*) FROM entries WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+            stats["file_bytes"] = os.path.getsize(self.path)
+        except Exception as e:
+            logger.error(f"Shared store stats failed: {e}")
+        stats["path"] = self.path
+        stats["max_entries"] = self.max_entries
+        return stats
+
+
+def create_shared_store_from_env() -> Optional[SharedStore]:
+    """
+    Создает общее хранилище по SHARED_STORE (none или sqlite) и SHARED_STORE_*; None - без него.
+    По умолчанию выключено: одному процессу хватает кэшей в памяти, а файл нужен, только
+    когда процессов несколько - его путь (SHARED_STORE_PATH) задается явно.
+    """
+    backend = os.getenv("SHARED_STORE", "none").lower()
+    if backend in ("", "none", "false"):
+        return None
+    if backend != "sqlite":
+        logger.warning(f"Unknown SHARED_STORE '{backend}', using 'sqlite'.")
+    path = os.getenv("SHARED_STORE_PATH", "")
+    if not path:
+        logger.error("SHARED_STORE=sqlite needs SHARED_STORE_PATH, results stay per process.")
+        return None
+    try:
+        return SQLiteSharedStore(
+            path,
+            max_entries=int(os.getenv("SHARED_STORE_MAX_ENTRIES", 100000)),
+            mmap_bytes=int(os.getenv("SHARED_STORE_MMAP_BYTES", 64 * 1024 * 1024)),
+            lease_seconds=float(os.getenv("SHARED_STORE_LEASE_SECONDS", 60)),
+        )
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Shared store at {path} unavailable, results stay per process: {e}")
+        return None
@@ -0,0 +1,157 @@
+# --- START OF FILE split_engine.py ---
+
+import logging
+import math
+from fractions import Fraction
+from typing import Dict, List, Optional
+
+from models import Positions, PersonShare, PersonShareItem, Recommendation
+
+logger = logging.getLogger(__name__)
+
+# Допуск (в рублях) при сравнении "сервисного сбора" в чеке с указанными чаевыми
+SERVICE_CHARGE_TOLERANCE = 1
+
+
+def build_price_index(positions: Positions) -> Dict[str, int]:
+    """
+    Строит словарь {уникальное_имя: цена} так же, как это делает фронтенд:
+    повторяющиеся позиции получают суффиксы "_2", "_3" и т.д.
+    """
+    index: Dict[str, int] = {}
+    for item in positions.positions_list:
+        unique_name = item.name
+        counter = 1
+        while unique_name in index:
+            counter += 1
+            unique_name = f"{item.name}_{counter}"
+        index[unique_name] = item.price
+    return index
+
+
+def _resolve_item(item_name: str, index: Dict[str, int], folded_index: Dict[str, str]) -> Optional[str]:
+    """Находит позицию по имени: сначала точное совпадение, затем без учета регистра и пробелов."""
+    if item_name in index:
+        return item_name
+    return folded_index.get(item_name.strip().casefold())
+
+
+def distribute(amount: int, weights: List[Fraction]) -> List[int]:
+    """
+    Делит целую сумму пропорционально весам методом наибольших остатков,
+    так что сумма долей всегда равна amount. При нулевых весах делит поровну.
+    """
+    count = len(weights)
+    if count == 0:
+        return []
+    total_weight = sum(weights, Fraction(0))
+    if total_weight <= 0:
+        weights = [Fraction(1)] * count
+        total_weight = Fraction(count)
+
+    exact = [Fraction(amount) * weight / total_weight for weight in weights]
+    shares = [math.floor(value) for value in exact]
+    remainder = amount - sum(shares)
+    # Копейки раздаем тем, у кого наибольшая дробная часть; при равенстве - по порядку
+    order = sorted(range(count), key=lambda i: (-(exact[i] - shares[i]), i))
+    for i in order[:remainder]:
+        shares[i] += 1
+    return shares
+
+
+def _people_names(num_people: int, item_assignments: Dict[str, List[str]]) -> List[str]:
+    """Имена из item_assignments, дополненные "Человек N" до num_people."""
+    names = list(item_assignments.keys())
+    counter = 1
+    while len(names) < num_people:
+        default_name = f"Человек {counter}"
+        if default_name not in names:
+            names.append(default_name)
+        counter += 1
+    return names
+
+
+def compute_split(positions: Positions, total_amount: int, num_people: int, tea_money: float,
+                  item_assignments: Dict[str, List[str]]) -> Optional[Recommendation]:
+    """
+    Локально рассчитывает варианты деления счета без обращения к модели.
+
+    Args:
+        positions (Positions): Позиции, извлеченные из чека.
+        total_amount (int): Итог по чеку (0, если не найден - тогда берется сумма позиций).
+        num_people (int): Количество человек.
+        tea_money (float): Желаемые чаевые.
+        item_assignments (Dict[str, List[str]]): Кто что ел (имена позиций как на фронтенде).
+
+    Returns:
+        Recommendation: Доли каждого человека, или None, если позиции из
+        item_assignments не удалось сопоставить с чеком.
+    """
+    if num_people <= 0 and not item_assignments:
+        logger.warning("Invalid input for compute_split.")
+        return None
+
+    index = build_price_index(positions)
+    folded_index = {name.strip().casefold(): name for name in index}
+
+    # Кто ест каждую позицию (общие блюда делятся между всеми, кто их отметил)
+    eaters: Dict[str, List[str]] = {}
+    for person, items in item_assignments.items():
+        for item_name in items:
+            resolved = _resolve_item(item_name, index, folded_index)
+            if resolved is None:
+                logger.warning(f"Split engine could not match item '{item_name}' assigned to '{person}'.")
+                return None
+            if person not in eaters.setdefault(resolved, []):
+                eaters[resolved].append(person)
+
+    names = _people_names(num_people, item_assignments)
+    items_sum = sum(index.values())
+
+    # Скидки и сервисный сбор учтены в итоге чека; если итога нет - считаем по позициям
+    base_total = total_amount if total_amount and total_amount > 0 else items_sum
+    tea_money_int = int(round(tea_money))
+    service_charge = base_total - items_sum
+    tea_included = tea_money_int > 0 and abs(service_charge - tea_money_int) <= SERVICE_CHARGE_TOLERANCE
+    if tea_included:
+        logger.info(f"Tea money {tea_money_int} already included in receipt as service charge, not adding.")
+    grand_total = base_total + (0 if tea_included else tea_money_int)
+    if grand_total < 0:
+        logger.warning(f"Negative grand total {grand_total} in compute_split.")
+        return None
+
+    # Коэффициент, переносящий цены позиций на итог чека (скидки/сбор распределяются пропорционально)
+    scale = Fraction(base_total, items_sum) if items_sum > 0 else Fraction(1)
+
+    eaten_count = {name: Fraction(0) for name in names}
+    own_cost = {name: Fraction(0) for name in names}
+    for item_name, persons in eaters.items():
+        portion = Fraction(1, len(persons))
+        for person in persons:
+            eaten_count[person] += portion
+            own_cost[person] += Fraction(index[item_name]) * portion
+
+    # Каждый платит за свое (с учетом скидок), остаток (чаевые, ничьи позиции) - поровну
+    own_adjusted = [own_cost[name] * scale for name in names]
+    rest = Fraction(grand_total) - sum(own_adjusted, Fraction(0))
+    cost_weights = [value + rest / len(names) for value in own_adjusted]
+
+    equally = distribute(grand_total, [Fraction(1)] * len(names))
+    by_count = distribute(grand_total, [eaten_count[name] for name in names])
+    by_cost = distribute(grand_total, cost_weights)
+    proportional = distribute(grand_total, [own_cost[name] for name in names])
+
+    peoples_list = [
+        PersonShareItem(
+            name=name,
+            shares=PersonShare(
+                equally=equally[i],
+                who_more_eat_then_more_pay=by_count[i],
+                who_more_cost_then_more_pay=by_cost[i],
+                proportional_division_by_the_cost_of_orders=proportional[i],
+            ),
+        )
+        for i, name in enumerate(names)
+    ]
+    logger.info(f"Split computed locally: total={grand_total}, people={len(names)}, tea_included={tea_included}")
+    return Recommendation(peoples_list=peoples_list)
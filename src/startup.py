@@ -0,0 +1,76 @@
+# --- START OF FILE startup.py ---
+# Холодный старт: время загрузки приложения и прогрев тяжелых зависимостей (SDK Gemini, WebP) после открытия порта
+
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+# lazy - SDK импортирует первый запрос, которому они нужны; background - фоновый поток сразу после
+# открытия порта; eager - прогрев до открытия порта (прежнее поведение: первый запрос ничего не ждет)
+STARTUP_WARMUP_MODES = ("lazy", "background", "eager")
+
+
+class StartupProfile:
+    """
+    Этапы старта процесса в секундах от начала загрузки app.py: модули загружены,
+    порт открыт, прогрев закончен, и время каждой задачи прогрева (для /startup_stats).
+    """
+
+    def __init__(self, mode: str, started_at: float):
+        self.mode = mode
+        self.started_at = started_at # time.perf_counter() в начале app.py
+        self._marks: Dict[str, float] = {}
+        self._warmup: Dict[str, object] = {}
+        self._warmup_started = False
+        self._lock = threading.Lock()
+
+    def mark(self, name: str) -> None:
+        """Запоминает момент этапа name ("loaded", "listening", "warmed_up")."""
+        elapsed = round(time.perf_counter() - self.started_at, 3)
+        with self._lock:
+            self._marks.setdefault(name, elapsed)
+        logger.info(f"Startup: {name} after {elapsed:.3f}s (warm-up mode {self.mode}).")
+
+    def start_warmup(self, tasks: Dict[str, Callable[[], object]]) -> None:
+        """Запускает прогрев по режиму (повторный вызов ничего не делает)."""
+        if self._warmup_started:
+            return
+        with self._lock:
+            if self._warmup_started:
+                return
+            self._warmup_started = True
+        if self.mode == "lazy":
+            return
+        if self.mode == "eager":
+            self._run_warmup(tasks)
+        else:
+            threading.Thread(target=self._run_warmup, args=(tasks,), name="startup-warmup", daemon=True).start()
+
+    def _run_warmup(self, tasks: Dict[str, Callable[[], object]]) -> None:
+        for name, task in tasks.items():
+            started_at = time.perf_counter()
+            try:
+                result = task()
+            except Exception as e:
+                logger.error(f"Startup warm-up task {name} failed: {e}")
+                result = None
+            with self._lock:
+                self._warmup[name] = {"seconds": round(time.perf_counter() - started_at, 3), "result": result}
+        self.mark("warmed_up")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"mode": self.mode, "marks": dict(self._marks), "warmup": dict(self._warmup)}
+
+
+def create_startup_profile_from_env(started_at: float) -> StartupProfile:
+    """Создает профиль старта по STARTUP_WARMUP (lazy, background или eager)."""
+    mode = os.getenv("STARTUP_WARMUP", "background").lower()
+    if mode not in STARTUP_WARMUP_MODES:
+        logger.warning(f"Unknown STARTUP_WARMUP '{mode}', using 'background'.")
+        mode = "background"
+    return StartupProfile(mode, started_at)
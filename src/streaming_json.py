@@ -0,0 +1,90 @@
+# --- START OF FILE streaming_json.py ---
+
+import json
+import logging
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class JsonStreamScanner:
+    """
+    Инкрементальный разбор JSON-объекта, который модель отдает по частям.
+
+    feed() принимает очередной кусок текста и возвращает события, ставшие
+    известными к этому моменту:
+        ("field", key, value) - завершенное поле корневого объекта;
+        ("item", key, obj)    - завершенный объект внутри массива в поле key
+                                (например, очередная позиция из positions_list).
+    Текст вокруг корневого объекта (```json ... ```) пропускается.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._key = None
+        self._value_start = None
+        self._item_start = None
+
+    def feed(self, chunk: str) -> List[Tuple]:
+        self.text += chunk
+        events = []
+        text, stack = self.text, self._stack
+        while self._pos < len(text):
+            i = self._pos
+            ch = text[i]
+            self._pos += 1
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if len(stack) == 1 and self._value_start is None:
+                        self._key = self._loads(text[self._string_start:i + 1])
+                continue
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch == ':' and len(stack) == 1:
+                self._value_start = i + 1
+            elif ch in '{[':
+                if ch == '{' and len(stack) == 2 and stack[1] == '[':
+                    self._item_start = i
+                stack.append(ch)
+            elif ch in '}]':
+                if stack:
+                    stack.pop()
+                if ch == '}' and len(stack) == 2 and self._item_start is not None:
+                    item = self._loads(text[self._item_start:i + 1])
+                    if isinstance(item, dict):
+                        events.append(("item", self._key, item))
+                    self._item_start = None
+                elif ch == '}' and not stack:
+                    self._finish_field(text[:i], events)
+            elif ch == ',' and len(stack) == 1:
+                self._finish_field(text[:i], events)
+        return events
+
+    def _finish_field(self, text: str, events: List[Tuple]) -> None:
+        if self._key is not None and self._value_start is not None:
+            value_text = text[self._value_start:].strip()
+            if value_text:
+                value = self._loads(value_text)
+                if value is not None or value_text == "null":
+                    events.append(("field", self._key, value))
+        self._key = None
+        self._value_start = None
+
+    @staticmethod
+    def _loads(fragment: str):
+        try:
+            return json.loads(fragment)
+        except json.JSONDecodeError:
+            logger.debug(f"Skipping malformed JSON fragment in stream: {fragment[:100]}")
+            return None
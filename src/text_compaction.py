@@ -0,0 +1,92 @@
+# --- START OF FILE text_compaction.py ---
+# Сжатие текста OCR перед промптами: без фискальных реквизитов и лишних пробелов, для извлечения - только область позиций и итога
+
+import logging
+import math
+import os
+import re
+from typing import List, Optional
+
+from metrics import record_prompt_text_tokens
+
+logger = logging.getLogger(__name__)
+
+TEXT_COMPACTION = os.getenv("TEXT_COMPACTION", "True").lower() == "true"
+# Для позиций, итога и деления оставлять только строки от первой позиции до итога/оплаты
+TEXT_COMPACTION_REGION = os.getenv("TEXT_COMPACTION_REGION", "True").lower() == "true"
+
+# Этапы, которым нужна только область позиций и итога; проверке на ресторан нужна и "шапка" чека
+REGION_STAGES = ("positions", "total", "split")
+
+# Оценка токенов без обращения к API: для русского текста Gemini в среднем ~3 символа на токен
+CHARS_PER_TOKEN = 3.0
+
+# Фискальные реквизиты и служебные строки, которые не нужны ни одному из промптов
+_BOILERPLATE_RE = re.compile(
+    r'^(?:инн|кпп|огрн|рн\s*ккт|зн\s*ккт|ккт|фн|фд|фп|фпд|фпп|сно|ффд|№\s*смены|смена\s*№|чек\s*№|'
+    r'сайт\s+фнс|www\.|http|nalog\.|адрес\s+сайта|эл\.?\s*адр|e-?mail|тел\.?|телефон|место\s+расч[её]тов|'
+    r'адрес\s+расч[её]тов|признак\s+расч[её]та|приход\b|кассовый\s+чек|спасибо|ждем\s+вас|благодарим|'
+    r'\[?\s*qr|<\s*qr|qr-?код)\b', re.IGNORECASE)
+# Строки из одних разделителей ("-----", "*****", "=====")
+_SEPARATOR_RE = re.compile(r'^[\s\-=_*~.#|]+$')
+_SPACES_RE = re.compile(r'[ \t ]+')
+# Начало области позиций: строка с суммой (или "кол-во x цена")
+_AMOUNT_LINE_RE = re.compile(r'\d+[.,]\d{2}\b|\d\s*[xх×*]\s*\d|[=≡]\s*\d|\d+\s*(?:руб|р\.|₽)', re.IGNORECASE)
+# Конец области: последняя строка итога или оплаты (сумма может быть на следующей строке)
+_TOTAL_LINE_RE = re.compile(r'итог|всего|к\s+оплате|обслуживани|сервисн|чаев|скидк', re.IGNORECASE)
+_DATE_TIME_RE = re.compile(r'\d{1,2}[./-]\d{1,2}[./-]\d{2,4}|\d{1,2}:\d{2}(?::\d{2})?')
+_AMOUNT_ONLY_RE = re.compile(r'^[=≡:\s]*\d[\d\s]*(?:[.,]\d{1,2})?\s*(?:руб\.?|р\.?|₽)?$', re.IGNORECASE)
+
+
+def _is_amount_line(line: str) -> bool:
+    return bool(_AMOUNT_LINE_RE.search(_DATE_TIME_RE.sub(' ', line)))
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text or '') / CHARS_PER_TOKEN)
+
+
+def normalize_receipt_text(extracted_text: str) -> str:
+    """Схлопывает пробелы, убирает пустые строки, разделители и фискальные реквизиты."""
+    lines = []
+    for raw_line in (extracted_text or '').splitlines():
+        line = _SPACES_RE.sub(' ', raw_line).strip()
+        if not line or _SEPARATOR_RE.match(line) or _BOILERPLATE_RE.match(line):
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def item_region(lines: List[str]) -> Optional[List[str]]:
+    """
+    Строки от первой позиции (строка перед первой суммой - возможное название
+    в двухстрочном фискальном формате) до последней строки итога, скидки или
+    обслуживания. None - область не найдена (в промпт уйдет весь текст).
+    """
+    first_amount = next((index for index, line in enumerate(lines) if _is_amount_line(line)), None)
+    last_total = next((index for index in range(len(lines) - 1, -1, -1) if _TOTAL_LINE_RE.search(lines[index])), None)
+    if first_amount is None or last_total is None or last_total < first_amount:
+        return None
+    end = last_total + 1
+    if end < len(lines) and _AMOUNT_ONLY_RE.match(lines[end]): # Сумма итога на отдельной строке
+        end += 1
+    start = first_amount - 1 if first_amount > 0 and not _is_amount_line(lines[first_amount - 1]) else first_amount
+    return lines[start:end]
+
+
+def compact_for_stage(stage: str, extracted_text: str) -> str:
+    """
+    Текст чека для промпта этапа stage (classify, positions, total, split).
+    Записывает оценку токенов до и после в лог и метрики.
+    """
+    if not TEXT_COMPACTION or not extracted_text:
+        return extracted_text
+    compacted = normalize_receipt_text(extracted_text)
+    if TEXT_COMPACTION_REGION and stage in REGION_STAGES:
+        region = item_region(compacted.splitlines())
+        if region:
+            compacted = "\n".join(region)
+    raw_tokens, compacted_tokens = estimate_tokens(extracted_text), estimate_tokens(compacted)
+    record_prompt_text_tokens(stage, raw_tokens, compacted_tokens)
+    logger.info(f"Compacted receipt text for {stage}: {len(extracted_text)} -> {len(compacted)} chars (~{raw_tokens} -> ~{compacted_tokens} tokens).")
+    return compacted
@@ -0,0 +1,184 @@
+# --- START OF FILE tiled_ocr.py ---
+# Длинные чеки: высокое фото режется на перекрывающиеся полосы, OCR полос идет параллельно, текст склеивается
+
+import asyncio
+import io
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import Executor
+from difflib import SequenceMatcher
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from image_preprocessing import load_receipt_image, IMAGE_MAX_EDGE, IMAGE_JPEG_QUALITY
+
+logger = logging.getLogger(__name__)
+
+# Одна совпавшая строка считается стыком полос, только если она не короче (короткие "1 x" повторяются в чеке)
+MIN_ANCHOR_CHARS = 8
+
+Tile = Tuple[bytes, str]
+
+
+def plan_tiles(height: int, tile_height: int, overlap: float, max_tiles: int) -> List[Tuple[int, int]]:
+    """
+    Полосы (верх, низ) для изображения высотой height: соседние перекрываются не меньше
+    чем на долю overlap высоты полосы. Если полос больше max_tiles, они становятся выше.
+    """
+    if height <= tile_height:
+        return [(0, height)]
+    count = -(-(height - tile_height) // int(tile_height * (1 - overlap))) + 1
+    if count > max_tiles:
+        count = max_tiles
+        tile_height = int(height / (max_tiles * (1 - overlap) + overlap)) + 1
+    step = (height - tile_height) / (count - 1)
+    return [(round(index * step), min(height, round(index * step) + tile_height)) for index in range(count)]
+
+
+def _normalize_line(line: str) -> str:
+    return re.sub(r"\s+", " ", line).strip().lower()
+
+
+def stitch_tile_texts(texts: List[str], window_lines: int = 12) -> Tuple[str, int]:
+    """
+    Склеивает текст полос сверху вниз. Стык ищется как самая длинная общая серия строк
+    в конце предыдущего текста и в начале следующего (последние и первые window_lines строк):
+    строки перекрытия берутся один раз, а обрезанные краем полосы строки после серии
+    (в предыдущей) и до нее (в следующей) отбрасываются - целиком они есть в соседней полосе.
+    Возвращает текст и число стыков, где общих строк не нашлось (там тексты просто идут подряд).
+    """
+    lines: List[str] = []
+    unmatched = 0
+    for index, text in enumerate(texts):
+        next_lines = [line for line in text.splitlines() if line.strip()]
+        if index == 0 or not lines:
+            lines = next_lines
+            continue
+        tail_start = max(0, len(lines) - window_lines)
+        tail = [_normalize_line(line) for line in lines[tail_start:]]
+        head = [_normalize_line(line) for line in next_lines[:window_lines]]
+        match = SequenceMatcher(None, tail, head, autojunk=False).find_longest_match(0, len(tail), 0, len(head))
+        if match.size >= 2 or (match.size == 1 and len(tail[match.a]) >= MIN_ANCHOR_CHARS):
+            lines = lines[:tail_start + match.a + match.size] + next_lines[match.b + match.size:]
+        else:
+            unmatched += 1
+            lines = lines + next_lines
+    return "\n".join(lines), unmatched
+
+
+class TiledOcr:
+    """
+    OCR длинных чеков по полосам. Фото, у которого после обрезки по листу высота больше
+    ширины в min_aspect раз, режется в полном разрешении на полосы высотой tile_aspect
+    ширин с перекрытием overlap; каждая полоса уменьшается до IMAGE_MAX_EDGE отдельно,
+    поэтому строки остаются читаемыми, а ответ модели на полосу короче. OCR полос идет
+    параллельно в executor (время - примерно одной полосы), текст склеивается по перекрытию.
+    """
+
+    def __init__(self, executor: Optional[Executor], enabled: bool = True, min_aspect: float = 2.5, tile_aspect: float = 1.5,
+                 overlap: float = 0.2, max_tiles: int = 8):
+        self.executor = executor
+        self.enabled = enabled
+        self.min_aspect = min_aspect
+        self.tile_aspect = tile_aspect
+        self.overlap = overlap
+        self.max_tiles = max_tiles
+        self._lock = threading.Lock()
+        self._stats = {"checked": 0, "tiled": 0, "tiles": 0, "joins": 0, "unmatched_joins": 0, "failures": 0,
+                       "split_seconds": 0.0, "read_seconds": 0.0}
+
+    def split(self, image_bytes: bytes, filename: str, ocr_bytes: bytes) -> Optional[List[Tile]]:
+        """
+        Полосы JPEG для высокого чека или None (обычное фото, режим выключен, ошибка).
+        Высота проверяется по заголовку уже нормализованного ocr_bytes; режется исходное image_bytes.
+        """
+        if not self.enabled or self.max_tiles < 2:
+            return None
+        try:
+            with Image.open(io.BytesIO(ocr_bytes)) as probe: # Только заголовок
+                width, height = probe.size
+        except Exception:
+            return None
+        with self._lock:
+            self._stats["checked"] += 1
+        if height < width * self.min_aspect:
+            return None
+
+        started_at = time.perf_counter()
+        try:
+            image, _ = load_receipt_image(image_bytes)
+            tile_height = int(image.width * self.tile_aspect)
+            bounds = plan_tiles(image.height, tile_height, self.overlap, self.max_tiles)
+            base_name = os.path.splitext(filename or "image")[0]
+            tiles = []
+            for index, (top, bottom) in enumerate(bounds):
+                tile = image.crop((0, top, image.width, bottom))
+                tile.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+                output = io.BytesIO()
+                tile.save(output, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+                tiles.append((output.getvalue(), f"{base_name}.tile{index}.jpg"))
+        except Exception as e:
+            logger.error(f"Splitting tall receipt {filename} into tiles failed: {e}", exc_info=True)
+            return None
+        elapsed = time.perf_counter() - started_at
+        with self._lock:
+            self._stats["tiled"] += 1
+            self._stats["tiles"] += len(tiles)
+            self._stats["split_seconds"] += elapsed
+        logger.info(f"Tall receipt {filename} {image.width}x{image.height} split into {len(tiles)} tiles in {elapsed * 1000:.1f} ms.")
+        return tiles
+
+    def read(self, tiles: List[Tile], ocr: Callable[[bytes, str], Optional[str]]) -> Optional[str]:
+        """OCR всех полос параллельно и склейка; None - OCR хотя бы одной полосы не удался."""
+        started_at = time.perf_counter()
+        futures = [self.executor.submit(ocr, tile_bytes, tile_name) for tile_bytes, tile_name in tiles]
+        return self._stitch([future.result() for future in futures], started_at)
+
+    async def read_async(self, tiles: List[Tile], ocr_async: Callable[[bytes, str], Awaitable[Optional[str]]]) -> Optional[str]:
+        """read для event loop: полосы распознаются одновременно через asyncio.gather."""
+        started_at = time.perf_counter()
+        texts = await asyncio.gather(*(ocr_async(tile_bytes, tile_name) for tile_bytes, tile_name in tiles))
+        return self._stitch(list(texts), started_at)
+
+    def _stitch(self, texts: List[Optional[str]], started_at: float) -> Optional[str]:
+        if any(text is None for text in texts):
+            with self._lock:
+                self._stats["failures"] += 1
+            logger.warning(f"OCR failed for {sum(text is None for text in texts)} of {len(texts)} tiles, reading the whole image.")
+            return None
+        extracted_text, unmatched = stitch_tile_texts(texts)
+        with self._lock:
+            self._stats["joins"] += len(texts) - 1
+            self._stats["unmatched_joins"] += unmatched
+            self._stats["read_seconds"] += time.perf_counter() - started_at
+        if unmatched:
+            logger.warning(f"Tiled OCR: {unmatched} of {len(texts) - 1} tile joins had no common lines.")
+        return extracted_text
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        split_seconds, read_seconds = stats.pop("split_seconds"), stats.pop("read_seconds")
+        read = stats["tiled"] - stats["failures"]
+        stats["mean_tiles"] = round(stats["tiles"] / stats["tiled"], 2) if stats["tiled"] else 0.0
+        stats["mean_split_ms"] = round(1000 * split_seconds / stats["tiled"], 1) if stats["tiled"] else 0.0
+        stats["mean_read_ms"] = round(1000 * read_seconds / read, 1) if read > 0 else 0.0
+        stats["config"] = {"enabled": self.enabled, "min_aspect": self.min_aspect, "tile_aspect": self.tile_aspect,
+                           "overlap": self.overlap, "max_tiles": self.max_tiles}
+        return stats
+
+
+def create_tiled_ocr_from_env(executor: Optional[Executor] = None) -> TiledOcr:
+    """Создает OCR длинных чеков по переменным окружения TILED_OCR_*."""
+    return TiledOcr(
+        executor,
+        enabled=os.getenv("TILED_OCR", "True").lower() == "true",
+        min_aspect=float(os.getenv("TILED_OCR_MIN_ASPECT", 2.5)),
+        tile_aspect=float(os.getenv("TILED_OCR_TILE_ASPECT", 1.5)),
+        overlap=float(os.getenv("TILED_OCR_OVERLAP", 0.2)),
+        max_tiles=int(os.getenv("TILED_OCR_MAX_TILES", 8)),
+    )
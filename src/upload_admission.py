@@ -0,0 +1,196 @@
+# --- START OF FILE upload_admission.py ---
+# Проверка загрузок до вызова модели: размер, формат по сигнатуре, размеры кадра из заголовка, пустые и размытые фото
+
+import io
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from PIL import Image, ImageFilter, ImageStat
+
+from metrics import record_upload_admission
+
+logger = logging.getLogger(__name__)
+
+# Сигнатуры (magic bytes) форматов, которые принимает Gemini; имя файла и Content-Type не учитываются
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+)
+# ISO BMFF (HEIC/HEIF): "ftyp" с 4-го байта и бренд за ним
+_HEIF_BRANDS = {b"heic": "image/heic", b"heix": "image/heic", b"heim": "image/heic", b"heis": "image/heic",
+                b"mif1": "image/heif", b"msf1": "image/heif", b"heif": "image/heif"}
+# Лапласиан для оценки резкости: у размытого фото почти нет перепадов яркости
+_LAPLACIAN = ImageFilter.Kernel((3, 3), (0, 1, 0, 1, -4, 1, 0, 1, 0), scale=1, offset=128)
+# Резкость и пустоту оцениваем на уменьшенной копии (JPEG декодируется сразу в уменьшенном виде)
+QUALITY_PROBE_EDGE = 1024
+
+# Причина отказа -> (HTTP-статус, сообщение для клиента)
+REJECTIONS = {
+    "too_large": (413, "Image file is too large"),
+    "request_too_large": (413, "Request body is too large"),
+    "empty": (400, "Image file is empty"),
+    "unsupported_type": (415, "Unsupported file type, please upload a JPEG, PNG, WebP or HEIC photo"),
+    "corrupt": (422, "Image file is damaged or truncated"),
+    "too_small_dimensions": (422, "Image is too small to read the receipt"),
+    "too_large_dimensions": (422, "Image resolution is too large"),
+    "blank": (422, "Image looks blank, please photograph the receipt"),
+    "blurry": (422, "Image is too blurry to read, please retake the photo"),
+}
+
+
+def sniff_image_type(data: bytes) -> Optional[str]:
+    """MIME-тип изображения по первым байтам или None, если формат не поддерживается."""
+    for signature, mime_type in _SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:8] == b"ftyp":
+        return _HEIF_BRANDS.get(data[8:12])
+    return None
+
+
+class UploadRejected(Exception):
+    """Загрузка отклонена до вызова модели; reason - ключ REJECTIONS."""
+
+    def __init__(self, reason: str, detail: str = ""):
+        super().__init__(f"{reason}: {detail}" if detail else reason)
+        self.reason = reason
+        self.status_code, self.message = REJECTIONS[reason]
+
+    def response(self):
+        """(JSON-тело, статус) для ответа маршрута."""
+        return {'error': self.message, 'rejected': self.reason}, self.status_code
+
+
+class UploadAdmission:
+    """
+    Дешевые проверки загруженного изображения до кэша, нормализации и вызовов модели:
+    размер файла, формат по сигнатуре, размеры кадра из заголовка (без декодирования
+    пикселей), затем пустой кадр (разброс яркости) и размытость (дисперсия лапласиана)
+    на уменьшенной копии. Отклонения считаются по причинам для /admission_stats.
+    """
+
+    def __init__(self, enabled: bool = True, max_bytes: int = 25 * 1024 * 1024, min_edge: int = 200,
+                 max_pixels: int = 120_000_000, min_contrast: float = 6.0, min_sharpness: float = 3.0):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.min_edge = min_edge
+        self.max_pixels = max_pixels
+        self.min_contrast = min_contrast # Стандартное отклонение яркости; 0 - не проверять
+        self.min_sharpness = min_sharpness # Дисперсия лапласиана; 0 - не проверять
+        self._lock = threading.Lock()
+        self._rejected: Dict[str, int] = {reason: 0 for reason in REJECTIONS}
+        self._stats = {"checked": 0, "accepted": 0, "rejected_bytes": 0, "check_seconds": 0.0}
+
+    def check(self, image_bytes: bytes) -> str:
+        """
+        Проверяет изображение и возвращает его MIME-тип по сигнатуре.
+
+        Raises:
+            UploadRejected: Изображение не стоит отправлять модели.
+        """
+        started_at = time.perf_counter()
+        try:
+            mime_type = self._check(image_bytes)
+        except UploadRejected as rejection:
+            self._record(started_at, rejection.reason, len(image_bytes))
+            logger.warning(f"Upload rejected before model calls: {rejection} ({len(image_bytes)} bytes).")
+            raise
+        self._record(started_at, None, len(image_bytes))
+        return mime_type
+
+    def _check(self, image_bytes: bytes) -> str:
+        if not image_bytes:
+            raise UploadRejected("empty")
+        mime_type = sniff_image_type(image_bytes)
+        if not self.enabled:
+            return mime_type or "image/jpeg"
+        if len(image_bytes) > self.max_bytes:
+            raise UploadRejected("too_large", f"{len(image_bytes)} > {self.max_bytes} bytes")
+        if mime_type is None:
+            raise UploadRejected("unsupported_type", repr(image_bytes[:12]))
+        if mime_type in ("image/heic", "image/heif"):
+            return mime_type # Pillow без плагина HEIF не читает, остальные проверки пропускаем
+
+        try:
+            image = Image.open(io.BytesIO(image_bytes)) # Читает только заголовок
+            width, height = image.size
+        except Exception as e:
+            raise UploadRejected("corrupt", str(e))
+        if min(width, height) < self.min_edge:
+            raise UploadRejected("too_small_dimensions", f"{width}x{height}")
+        if width * height > self.max_pixels:
+            raise UploadRejected("too_large_dimensions", f"{width}x{height}")
+        if self.min_contrast or self.min_sharpness:
+            self._check_quality(image)
+        return mime_type
+
+    def _check_quality(self, image: Image.Image) -> None:
+        try:
+            image.draft("L", (QUALITY_PROBE_EDGE, QUALITY_PROBE_EDGE))
+            if image.mode == "P":
+                image = image.convert("RGBA") # Палитра с прозрачностью иначе конвертируется с предупреждением
+            probe = image.convert("L")
+            probe.thumbnail((QUALITY_PROBE_EDGE, QUALITY_PROBE_EDGE))
+        except Exception as e:
+            raise UploadRejected("corrupt", str(e))
+        contrast = ImageStat.Stat(probe).stddev[0]
+        if contrast < self.min_contrast:
+            raise UploadRejected("blank", f"brightness stddev {contrast:.1f}")
+        if self.min_sharpness and probe.width > 2 and probe.height > 2:
+            # Крайние пиксели после свертки не учитываются: там перепад с краем кадра
+            edges = probe.filter(_LAPLACIAN).crop((1, 1, probe.width - 1, probe.height - 1))
+            sharpness = ImageStat.Stat(edges).var[0]
+            if sharpness < self.min_sharpness:
+                raise UploadRejected("blurry", f"laplacian variance {sharpness:.1f}")
+
+    def reject_request(self, size: Optional[int]) -> UploadRejected:
+        """Учитывает тело запроса больше лимита сервера (до чтения файлов) и возвращает отказ."""
+        with self._lock:
+            self._stats["checked"] += 1
+            self._rejected["request_too_large"] += 1
+            self._stats["rejected_bytes"] += size or 0
+        record_upload_admission("request_too_large")
+        logger.warning(f"Upload rejected before reading the body: request of {size} bytes is too large.")
+        return UploadRejected("request_too_large")
+
+    def _record(self, started_at: float, reason: Optional[str], size: int) -> None:
+        with self._lock:
+            self._stats["checked"] += 1
+            self._stats["check_seconds"] += time.perf_counter() - started_at
+            if reason is None:
+                self._stats["accepted"] += 1
+            else:
+                self._rejected[reason] += 1
+                self._stats["rejected_bytes"] += size
+        record_upload_admission(reason or "accepted")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            rejected = dict(self._rejected)
+        check_seconds = stats.pop("check_seconds")
+        stats["rejected"] = sum(rejected.values())
+        stats["rejected_by_reason"] = rejected
+        stats["rejected_ratio"] = round(stats["rejected"] / stats["checked"], 4) if stats["checked"] else 0.0
+        timed_checks = stats["checked"] - rejected["request_too_large"]
+        stats["mean_check_ms"] = round(1000 * check_seconds / timed_checks, 2) if timed_checks else 0.0
+        stats["limits"] = {"enabled": self.enabled, "max_bytes": self.max_bytes, "min_edge": self.min_edge,
+                           "max_pixels": self.max_pixels, "min_contrast": self.min_contrast, "min_sharpness": self.min_sharpness}
+        return stats
+
+
+def create_upload_admission_from_env() -> UploadAdmission:
+    """Создает проверку загрузок по переменным окружения UPLOAD_*."""
+    return UploadAdmission(
+        enabled=os.getenv("UPLOAD_ADMISSION", "True").lower() == "true",
+        max_bytes=int(os.getenv("UPLOAD_MAX_BYTES", 25 * 1024 * 1024)),
+        min_edge=int(os.getenv("UPLOAD_MIN_EDGE", 200)),
+        max_pixels=int(os.getenv("UPLOAD_MAX_PIXELS", 120_000_000)),
+        min_contrast=float(os.getenv("UPLOAD_MIN_CONTRAST", 6.0)),
+        min_sharpness=float(os.getenv("UPLOAD_MIN_SHARPNESS", 3.0)),
+    )
@@ -0,0 +1,8 @@
+# Модули приложения импортируются из src/, как при запуске python src/app.py
+import os
+import sys
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+
+FIXTURES_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'fixtures')
@@ -0,0 +1,80 @@
+import pytest
+
+import gemini_governor
+from gemini_governor import GeminiGovernor
+
+
+class ApiError(Exception):
+    def __init__(self, code):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+def make_governor(max_retries=3):
+    return GeminiGovernor({}, default_rpm=1000000, burst=1000, max_retries=max_retries, budget_seconds=5,
+                          backoff_base=0.001, backoff_max=0.001)
+
+
+@pytest.fixture
+def events(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(gemini_governor, "record_governor_event", lambda event, stage: recorded.append(event))
+    return recorded
+
+
+def flaky_stream(failures):
+    """generate_content(stream=True): каждая попытка отдает фрагменты, пока не встретит ошибку."""
+    attempts = []
+
+    def generate_content(prompt, stream=False):
+        assert stream
+        script = failures[len(attempts)] if len(attempts) < len(failures) else ["a", "b"]
+        attempts.append(script)
+
+        def chunks():
+            for item in script:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        return chunks()
+    return generate_content, attempts
+
+
+def test_error_before_first_chunk_is_retried(events):
+    generate_content, attempts = flaky_stream([[ApiError(503)], [ApiError(429)]])
+    assert list(make_governor().stream("fused", "gemini-2.0-flash", generate_content, "prompt")) == ["a", "b"]
+    assert len(attempts) == 3
+    assert events.count("retries") == 2
+    assert "failed" not in events
+
+
+def test_error_when_calling_func_is_retried(events):
+    calls = []
+
+    def generate_content(prompt, stream=False):
+        calls.append(prompt)
+        if len(calls) == 1:
+            raise ApiError(503)
+        return iter(["a"])
+    assert list(make_governor().stream("positions", "gemini-2.0-flash", generate_content, "prompt")) == ["a"]
+    assert events.count("retries") == 1
+
+
+def test_mid_stream_error_is_not_retried_and_recorded(events):
+    generate_content, attempts = flaky_stream([["a", ApiError(503)]])
+    received = []
+    with pytest.raises(ApiError):
+        for chunk in make_governor().stream("fused", "gemini-2.0-flash", generate_content, "prompt"):
+            received.append(chunk)
+    assert received == ["a"]
+    assert len(attempts) == 1
+    assert "retries" not in events
+    assert events.count("failed") == 1
+
+
+def test_exhausted_retries_recorded_as_failed(events):
+    generate_content, attempts = flaky_stream([[ApiError(503)]] * 5)
+    with pytest.raises(ApiError):
+        list(make_governor(max_retries=1).stream("fused", "gemini-2.0-flash", generate_content, "prompt"))
+    assert len(attempts) == 2
+    assert events.count("failed") == 1
@@ -0,0 +1,87 @@
+from llm_backends import LLMBackend, LLMRouter, OpenAICompatibleBackend
+
+
+class FakeBackend(LLMBackend):
+    def __init__(self, name, text="text", total=2100):
+        self.name = name
+        self.text = text
+        self.total = total
+        self.calls = 0
+
+    def ocr(self, image_bytes, filename):
+        self.calls += 1
+        return self.text
+
+    def extract_total(self, extracted_text):
+        self.calls += 1
+        return self.total
+
+
+def ranked(router, operation="ocr"):
+    return [backend.name for backend in router._rank(operation)]
+
+
+def test_untried_backends_go_first():
+    router = LLMRouter([FakeBackend("a"), FakeBackend("b")], explore_rate=0)
+    router._record("a", "ocr", 100.0, True)
+    assert ranked(router) == ["b", "a"]
+
+
+def test_measured_backends_by_latency():
+    router = LLMRouter([FakeBackend("a"), FakeBackend("b")], explore_rate=0)
+    router._record("a", "ocr", 300.0, True)
+    router._record("b", "ocr", 100.0, True)
+    assert ranked(router) == ["b", "a"]
+
+
+def test_backend_with_only_failures_goes_after_measured():
+    router = LLMRouter([FakeBackend("failing"), FakeBackend("slow"), FakeBackend("flaky")], min_samples=5, explore_rate=0)
+    for _ in range(2): # Меньше min_samples - еще не в cooldown
+        router._record("failing", "ocr", 10.0, False)
+    router._record("slow", "ocr", 900.0, True)
+    router._record("flaky", "ocr", 50.0, False)
+    router._record("flaky", "ocr", 50.0, True)
+    assert ranked(router) == ["flaky", "slow", "failing"]
+
+
+def test_failed_backends_ordered_by_error_rate():
+    router = LLMRouter([FakeBackend("a"), FakeBackend("b")], min_samples=10, explore_rate=0)
+    router._record("a", "ocr", 10.0, False)
+    router._record("b", "ocr", 10.0, False)
+    assert ranked(router) == ["a", "b"]
+
+
+def test_failed_backend_not_retried_first_before_min_samples():
+    failing, healthy = FakeBackend("failing", text=None), FakeBackend("healthy")
+    router = LLMRouter([failing, healthy], min_samples=5, explore_rate=0)
+    for _ in range(3):
+        assert router.ocr(b"", "a.jpg") == "text"
+    assert ranked(router) == ["healthy", "failing"]
+    assert failing.calls == 1
+
+
+def broken_openai_backend(reply):
+    backend = OpenAICompatibleBackend("http://127.0.0.1:9", "key", "model")
+    backend._chat = lambda content, json_mode: reply
+    return backend
+
+
+def test_openai_total_parse_error_fails_over_and_cools_down():
+    broken, healthy = broken_openai_backend("not json"), FakeBackend("healthy")
+    assert broken.extract_total("ИТОГО 2100") is None
+    router = LLMRouter([broken, healthy], min_samples=1, explore_rate=0)
+    assert router.extract_total("ИТОГО 2100") == 2100
+    assert router._get_stats("openai", "extract_total").cooldown_until > 0
+    assert ranked(router, "extract_total") == ["healthy", "openai"]
+
+
+def test_empty_ocr_text_is_a_failure():
+    empty, healthy = broken_openai_backend("  \n"), FakeBackend("healthy")
+    router = LLMRouter([empty, healthy], explore_rate=0)
+    assert router.ocr(b"", "a.jpg") == "text"
+    assert router._get_stats("openai", "ocr").error_rate() == 1.0
+
+
+def test_total_is_zero_when_every_backend_fails():
+    router = LLMRouter([broken_openai_backend(None), FakeBackend("empty", total=None)], explore_rate=0)
+    assert router.extract_total("ИТОГО 2100") == 0
@@ -0,0 +1,35 @@
+from near_duplicates import NearDuplicateIndex, NearDuplicateMatch
+from receipt_parser import detect_total
+
+RECEIPT = "\n".join([
+    'ООО "Ромашка"',
+    "г. Москва, ул. Ленина, д. 12",
+    "Борщ 1 x 450 = 450",
+    "Морс 2 x 150 = 300",
+    "ИТОГО 750",
+])
+
+
+def match_with_total(total):
+    return NearDuplicateMatch(1, [(3, total, '{"total_amount_detected": %d}' % total)])
+
+
+def test_detect_total_uses_only_total_line():
+    assert detect_total(RECEIPT) == 750
+    assert detect_total("г. Москва, д. 12\nБорщ 1 x 450 = 450") is None
+
+
+def test_confirm_by_total_line():
+    index = NearDuplicateIndex()
+    confirmed = index.confirm(match_with_total(750), RECEIPT)
+    assert confirmed == {"total_amount_detected": 750, "near_duplicate_distance": 3}
+    assert index.stats()["hits"] == 1
+
+
+def test_positions_sum_does_not_confirm_without_total_line():
+    index = NearDuplicateIndex()
+    # Без строки итога сумма позиций (и числа из адреса) не подтверждает совпадение
+    assert index.confirm(match_with_total(750), RECEIPT.replace("ИТОГО 750", "")) is None
+    assert index.confirm(match_with_total(762), RECEIPT) is None
+    stats = index.stats()
+    assert (stats["unverified"], stats["false_matches"], stats["hits"]) == (1, 1, 0)
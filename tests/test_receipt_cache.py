@@ -0,0 +1,38 @@
+import os
+
+import receipt_cache
+from receipt_cache import ReceiptCache
+
+
+def disk_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if name.endswith(".json"))
+
+
+def test_disk_cache_tracks_size_without_listing_directory(tmp_path, monkeypatch):
+    cache = ReceiptCache(max_bytes=1024 * 1024, ttl_seconds=60, disk_dir=str(tmp_path), disk_max_bytes=100000)
+    scans = []
+    real_scandir = os.scandir
+    monkeypatch.setattr(receipt_cache.os, "scandir", lambda path: scans.append(path) or real_scandir(path))
+    for index in range(20):
+        cache.put(f"key{index}", {"extracted_text": "x" * 100})
+    cache.put("key0", {"extracted_text": "y" * 300}) # Замена файла учитывает прежний размер
+    assert scans == []
+    assert cache.stats()["disk_bytes"] == disk_size(tmp_path)
+
+
+def test_disk_cache_pruned_below_limit_with_headroom(tmp_path, monkeypatch):
+    cache = ReceiptCache(max_bytes=1024 * 1024, ttl_seconds=60, disk_dir=str(tmp_path), disk_max_bytes=20000)
+    scans = []
+    real_scandir = os.scandir
+    monkeypatch.setattr(receipt_cache.os, "scandir", lambda path: scans.append(path) or real_scandir(path))
+    for index in range(300):
+        cache.put(f"key{index:03d}", {"extracted_text": "x" * 100})
+        assert disk_size(tmp_path) <= 20000 + 200
+    assert cache.stats()["disk_bytes"] == disk_size(tmp_path)
+    assert 0 < len(scans) <= 30 # Очистка с запасом - не на каждой записи
+    assert cache.get("key299") is not None
+
+
+def test_disk_size_counted_at_start(tmp_path):
+    ReceiptCache(max_bytes=1024, ttl_seconds=60, disk_dir=str(tmp_path), disk_max_bytes=100000).put("key", {"text": "x"})
+    assert ReceiptCache(max_bytes=1024, ttl_seconds=60, disk_dir=str(tmp_path), disk_max_bytes=100000).stats()["disk_bytes"] == disk_size(tmp_path)
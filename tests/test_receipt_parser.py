@@ -0,0 +1,100 @@
+import json
+import os
+
+import pytest
+
+from conftest import FIXTURES_DIR
+from receipt_parser import RuleParser, parse_receipt_text
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, 'ocr_texts.json'), 'r', encoding='utf-8') as f:
+        return next(fixture for fixture in json.load(f) if fixture['name'] == name)
+
+
+def positions(parsed):
+    return [(item.name, item.price) for item in parsed.positions.positions_list]
+
+
+def test_fiscal_cafe_address_is_not_a_position():
+    fixture = load_fixture('fiscal_cafe')
+    parsed = parse_receipt_text(fixture['text'])
+    assert positions(parsed) == [(item['name'], item['price']) for item in fixture['expected_positions']]
+    assert parsed.total_amount == fixture['expected_total']
+    assert parsed.loose_rows == 0
+    assert RuleParser().parse(fixture['text']) is not None
+
+
+def test_bar_service_charge_subtotal_is_not_a_position():
+    fixture = load_fixture('bar_service_charge')
+    parsed = parse_receipt_text(fixture['text'])
+    assert positions(parsed) == [(item['name'], item['price']) for item in fixture['expected_positions']]
+    assert parsed.total_amount == fixture['expected_total']
+    # Итог с обслуживанием и скидкой не равен сумме позиций - решает LLM
+    assert parsed.reason == "mismatch"
+    assert RuleParser().parse(fixture['text']) is None
+
+
+def test_address_number_does_not_hide_mismatch():
+    text = "\n".join([
+        'ООО "Ромашка"',
+        "г. Москва, ул. Ленина, д. 12",
+        "Борщ 1 x 450 = 450",
+        "Морс 2 x 150 = 300",
+        "ИТОГО 762",
+    ])
+    parsed = parse_receipt_text(text)
+    assert positions(parsed) == [("Борщ", 450), ("Морс", 300)]
+    assert parsed.reason == "mismatch"
+    assert RuleParser().parse(text) is None
+
+
+@pytest.mark.parametrize("line", ["д. 12", "стр. 1", "ИНН 7701234567", "ИП Иванов 12", "ККТ 0001", "Сумма: 2730,00"])
+def test_requisite_lines_are_not_positions(line):
+    parsed = parse_receipt_text(f"{line}\nБорщ 1 x 450 = 450\nИТОГО 450")
+    assert positions(parsed) == [("Борщ", 450)]
+
+
+def test_loose_rows_need_price_format():
+    text = "Чай ......... 150.00\nМорс 200 руб\nХлеб 12\nИТОГО 350"
+    parsed = parse_receipt_text(text)
+    assert positions(parsed) == [("Чай", 150), ("Морс", 200)]
+    assert parsed.loose_rows == 2
+
+
+def test_loose_rows_accepted_when_sum_matches_exactly():
+    text = "Чай ......... 150.00\nМорс 200 руб\nИТОГО 350"
+    parsed = RuleParser(min_confidence=0.9).parse(text)
+    assert parsed is not None
+    assert positions(parsed) == [("Чай", 150), ("Морс", 200)]
+    assert parsed.confidence == 0.9
+
+
+def test_loose_rows_need_exact_total():
+    # С допуском в рубль строгие строки сошлись бы, угаданные по числу в конце - нет
+    text = "Чай ......... 150.00\nМорс 200.50 руб\nИТОГО 350"
+    parser = RuleParser(min_confidence=0.5)
+    assert parser.parse(text) is None
+    assert parser.stats()["fallback_reasons"] == {"mismatch": 1}
+
+
+def test_strict_rows_are_accepted():
+    text = "Борщ 1 x 450 = 450\nСтейк 200 г. 1 x 900 = 900\nИТОГО 1350"
+    parsed = RuleParser().parse(text)
+    assert parsed is not None
+    assert positions(parsed) == [("Борщ", 450), ("Стейк 200 г", 900)]
+    assert parsed.confidence == 1.0
+
+
+def test_dish_names_containing_skip_words_are_positions():
+    text = "Картофель фри 1 x 200 = 200\nСтейк из телятины 1 x 900 = 900\nКарбонара 1 x 500 = 500\nИТОГО 1600"
+    parsed = parse_receipt_text(text)
+    assert positions(parsed) == [("Картофель фри", 200), ("Стейк из телятины", 900), ("Карбонара", 500)]
+    assert parsed.reason is None
+
+
+@pytest.mark.parametrize("line", ["Оплата картой 1600.00", "Скидка по карте 11.00", "Гостей 3", "тел. +7 812 555-12-34",
+                                  "Дата 12.03.2024", "Сумма НДС 20% 266.67"])
+def test_service_lines_are_not_positions(line):
+    parsed = parse_receipt_text(f"Борщ 1 x 450 = 450\n{line}\nИТОГО 450")
+    assert positions(parsed) == [("Борщ", 450)]
@@ -0,0 +1,47 @@
+import json
+import os
+
+import pytest
+
+from conftest import FIXTURES_DIR
+from restaurant_classifier import RestaurantClassifier, restaurant_score
+
+
+def load_labelled_texts():
+    texts = []
+    for file_name in ("restaurant_labels.json", "ocr_texts.json"):
+        with open(os.path.join(FIXTURES_DIR, file_name), encoding="utf-8") as f:
+            texts.extend(json.load(f))
+    return texts
+
+
+LABELLED = load_labelled_texts()
+NEGATIVES = [fixture for fixture in LABELLED if not fixture["is_restaurant"]]
+POSITIVES = [fixture for fixture in LABELLED if fixture["is_restaurant"]]
+
+
+@pytest.mark.parametrize("fixture", NEGATIVES, ids=[fixture["name"] for fixture in NEGATIVES])
+def test_other_receipts_never_decided_as_restaurant(fixture):
+    assert RestaurantClassifier().local_verdict(fixture["text"]) is not True
+
+
+@pytest.mark.parametrize("fixture", POSITIVES, ids=[fixture["name"] for fixture in POSITIVES])
+def test_restaurants_never_decided_as_other(fixture):
+    assert RestaurantClassifier().local_verdict(fixture["text"]) is not False
+
+
+def test_thresholds_keep_margin_from_labelled_set():
+    classifier = RestaurantClassifier()
+    assert max(restaurant_score(fixture["text"]) for fixture in NEGATIVES) <= classifier.yes_threshold - 2.5
+    assert min(restaurant_score(fixture["text"]) for fixture in POSITIVES) >= classifier.no_threshold + 2.5
+
+
+def test_grocery_with_grill_chicken_goes_to_llm():
+    text = "ООО Продукты у дома\nПельмени 0.9 кг 1 x 329.00\nСок 119.00\nЧай 249.00\nКурица гриль 399.00\nПиво 178.00\nИТОГ 1274.00"
+    assert restaurant_score(text) < RestaurantClassifier().yes_threshold
+    assert RestaurantClassifier().local_verdict(text) is None
+
+
+@pytest.mark.parametrize("text", ["Курица гриль 399.00", "Пельмени сок чай пиво кофе 500.00", "Салат пицца морс 300.00"])
+def test_shop_goods_are_not_restaurant_signals(text):
+    assert restaurant_score(text) == 0
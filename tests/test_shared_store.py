@@ -0,0 +1,114 @@
+import asyncio
+import os
+import stat
+import threading
+import time
+
+from shared_store import SQLiteSharedStore, create_shared_store_from_env
+
+
+def identity(value):
+    return value
+
+
+def make_store(tmp_path, lease_seconds=60.0):
+    return SQLiteSharedStore(str(tmp_path / "store.sqlite3"), lease_seconds=lease_seconds)
+
+
+def test_get_or_compute_stores_result(tmp_path):
+    store = make_store(tmp_path)
+    assert store.get_or_compute("k", lambda: b"v", identity, identity, 60) == (b"v", "computed")
+    assert store.get_or_compute("k", lambda: b"other", identity, identity, 60) == (b"v", "hit")
+    assert store.get("lease:k") is None
+
+
+def test_delete_if_compares_value(tmp_path):
+    store = make_store(tmp_path)
+    store.set("lease:k", b"mine", 60)
+    assert not store.delete_if("lease:k", b"other")
+    assert store.get("lease:k") == b"mine"
+    assert store.delete_if("lease:k", b"mine")
+    assert store.get("lease:k") is None
+
+
+def test_slow_holder_does_not_release_taken_over_lease(tmp_path):
+    store = make_store(tmp_path, lease_seconds=0.1)
+    other_process = make_store(tmp_path) # Тот же файл, аренда второго держателя не истекает
+    second_computing, second_release = threading.Event(), threading.Event()
+    results = {}
+
+    def first_compute():
+        time.sleep(0.3) # Дольше lease_seconds - аренду за это время берет второй процесс
+        return b"first"
+
+    def second_compute():
+        second_computing.set()
+        second_release.wait(5)
+        return b"second"
+
+    first = threading.Thread(target=lambda: results.update(first=store.get_or_compute("k", first_compute, identity, identity, 60)))
+    second = threading.Thread(target=lambda: results.update(second=other_process.get_or_compute("k", second_compute, identity, identity, 60)))
+    first.start()
+    time.sleep(0.15)
+    second.start()
+    assert second_computing.wait(5)
+    first.join(5)
+    assert results["first"] == (b"first", "computed")
+    # Первый держатель снял бы чужую аренду, и третий процесс стал бы считать тот же ключ
+    assert store.get("lease:k") is not None
+    assert not store.add("lease:k", b"third", 60)
+    second_release.set()
+    second.join(5)
+    assert results["second"] == (b"second", "computed")
+    assert store.get("lease:k") is None
+
+
+def test_store_is_opt_in(monkeypatch, tmp_path):
+    monkeypatch.delenv("SHARED_STORE", raising=False)
+    monkeypatch.setenv("SHARED_STORE_PATH", str(tmp_path / "store.sqlite3"))
+    assert create_shared_store_from_env() is None
+    monkeypatch.setenv("SHARED_STORE", "sqlite")
+    monkeypatch.delenv("SHARED_STORE_PATH")
+    assert create_shared_store_from_env() is None
+
+
+def test_store_file_readable_only_by_owner(monkeypatch, tmp_path):
+    path = tmp_path / "store.sqlite3"
+    monkeypatch.setenv("SHARED_STORE", "sqlite")
+    monkeypatch.setenv("SHARED_STORE_PATH", str(path))
+    store = create_shared_store_from_env()
+    store.set("receipt:k", b"text", 60)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_get_or_compute_async_waits_for_other_holder(tmp_path):
+    store = make_store(tmp_path)
+
+    async def compute():
+        await asyncio.sleep(0.1)
+        return b"v"
+
+    async def run():
+        return await asyncio.gather(store.get_or_compute_async("k", compute, identity, identity, 60),
+                                    store.get_or_compute_async("k", compute, identity, identity, 60))
+
+    assert sorted(asyncio.run(run())) == [(b"v", "computed"), (b"v", "waited")]
+    assert store.get("lease:k") is None
+
+
+def test_claim_for_streamed_result(tmp_path):
+    store = make_store(tmp_path)
+    value, source, token = store.claim("k", identity)
+    assert (value, source) == (None, "compute")
+    assert not store.add("lease:k", b"other", 60) # Второй запрос того же чека ждет, а не считает
+    store.finish_claim("k", token, b"v", identity, 60)
+    assert store.get("lease:k") is None
+    assert store.claim("k", identity) == (b"v", "hit", None)
+
+
+def test_failed_claim_releases_lease(tmp_path):
+    store = make_store(tmp_path)
+    _, _, token = store.claim("k", identity)
+    store.finish_claim("k", token)
+    assert store.get("k") is None
+    assert store.get("lease:k") is None
@@ -0,0 +1,109 @@
+from fractions import Fraction
+
+import pytest
+
+from models import Positions, PositionItem
+from split_engine import build_price_index, compute_split, distribute
+
+SHARE_FIELDS = ("equally", "who_more_eat_then_more_pay", "who_more_cost_then_more_pay", "proportional_division_by_the_cost_of_orders")
+
+
+def make_positions(*items):
+    return Positions(positions_list=[PositionItem(name=name, price=price) for name, price in items])
+
+
+def shares(recommendation, field):
+    return {person.name: getattr(person.shares, field) for person in recommendation.peoples_list}
+
+
+def assert_totals(recommendation, grand_total):
+    for field in SHARE_FIELDS:
+        assert sum(shares(recommendation, field).values()) == grand_total, field
+
+
+@pytest.mark.parametrize("amount, weights", [
+    (100, [Fraction(1)] * 3),
+    (1001, [Fraction(1), Fraction(2), Fraction(3)]),
+    (7, [Fraction(1, 3), Fraction(1, 3), Fraction(1, 3)]),
+    (50, [Fraction(0), Fraction(0)]),
+])
+def test_distribute_keeps_sum(amount, weights):
+    result = distribute(amount, weights)
+    assert sum(result) == amount
+    assert min(result) >= 0
+
+
+def test_distribute_largest_remainder():
+    # 100 / 3 = 33.33: лишний рубль - первому при равных остатках
+    assert distribute(100, [Fraction(1)] * 3) == [34, 33, 33]
+    # Нулевые веса - поровну
+    assert distribute(50, [Fraction(0), Fraction(0)]) == [25, 25]
+    assert distribute(10, []) == []
+
+
+def test_build_price_index_suffixes_duplicates_like_frontend():
+    index = build_price_index(make_positions(("Чай", 100), ("Чай", 120), ("Борщ", 450), ("Чай", 90)))
+    assert index == {"Чай": 100, "Чай_2": 120, "Борщ": 450, "Чай_3": 90}
+
+
+def test_duplicate_names_are_matched_by_suffix():
+    positions = make_positions(("Чай", 100), ("Чай", 300))
+    recommendation = compute_split(positions, 400, 2, 0, {"Аня": ["Чай"], "Боря": ["Чай_2"]})
+    assert shares(recommendation, "proportional_division_by_the_cost_of_orders") == {"Аня": 100, "Боря": 300}
+    assert_totals(recommendation, 400)
+
+
+def test_unknown_item_returns_none():
+    assert compute_split(make_positions(("Чай", 100)), 100, 2, 0, {"Аня": ["Кофе"]}) is None
+
+
+def test_totals_add_up_with_uneven_rounding():
+    positions = make_positions(("Борщ", 451), ("Пельмени", 523), ("Салат", 617), ("Морс", 221))
+    assignments = {"Аня": ["Борщ", "Морс"], "Боря": ["Пельмени", "Морс"], "Вика": ["Салат", "Морс"]}
+    recommendation = compute_split(positions, 1812, 3, 0, assignments)
+    assert_totals(recommendation, 1812)
+
+
+def test_discount_in_total_is_spread():
+    positions = make_positions(("Борщ", 500), ("Стейк", 1500))
+    recommendation = compute_split(positions, 1800, 2, 0, {"Аня": ["Борщ"], "Боря": ["Стейк"]})
+    assert shares(recommendation, "who_more_cost_then_more_pay") == {"Аня": 450, "Боря": 1350}
+    assert_totals(recommendation, 1800)
+
+
+@pytest.mark.parametrize("tea_money, expected_total", [
+    (200, 2200), # Сбор 200 в чеке совпадает с чаевыми - не добавляется
+    (201, 2200), # Расхождение в пределах допуска 1
+    (199, 2200),
+    (202, 2402), # Больше допуска - чаевые добавляются к итогу
+])
+def test_service_charge_tolerance(tea_money, expected_total):
+    positions = make_positions(("Борщ", 1000), ("Стейк", 1000))
+    recommendation = compute_split(positions, 2200, 2, tea_money, {"Аня": ["Борщ"], "Боря": ["Стейк"]})
+    assert_totals(recommendation, expected_total)
+
+
+def test_person_without_items():
+    positions = make_positions(("Борщ", 600), ("Стейк", 1200))
+    recommendation = compute_split(positions, 1800, 3, 300, {"Аня": ["Борщ"], "Боря": ["Стейк"], "Вика": []})
+    assert_totals(recommendation, 2100)
+    assert shares(recommendation, "proportional_division_by_the_cost_of_orders")["Вика"] == 0
+    assert shares(recommendation, "who_more_eat_then_more_pay")["Вика"] == 0
+    # Вика платит только долю чаевых
+    assert shares(recommendation, "who_more_cost_then_more_pay")["Вика"] == 100
+    assert shares(recommendation, "equally")["Вика"] == 700
+
+
+def test_default_names_fill_up_to_num_people():
+    recommendation = compute_split(make_positions(("Борщ", 300)), 300, 3, 0, {"Аня": ["Борщ"]})
+    assert [person.name for person in recommendation.peoples_list] == ["Аня", "Человек 1", "Человек 2"]
+    assert_totals(recommendation, 300)
+
+
+def test_empty_positions():
+    recommendation = compute_split(make_positions(), 0, 2, 100, {})
+    assert [person.name for person in recommendation.peoples_list] == ["Человек 1", "Человек 2"]
+    assert_totals(recommendation, 100)
+    assert shares(recommendation, "equally") == {"Человек 1": 50, "Человек 2": 50}
+    # Позиции из пустого чека не сопоставить
+    assert compute_split(make_positions(), 0, 2, 0, {"Аня": ["Борщ"]}) is None
@@ -0,0 +1,42 @@
+import json
+import os
+import re
+from decimal import Decimal, ROUND_HALF_UP
+
+import pytest
+
+from conftest import FIXTURES_DIR
+from receipt_parser import find_total
+from text_compaction import compact_for_stage
+
+with open(os.path.join(FIXTURES_DIR, 'ocr_texts.json'), 'r', encoding='utf-8') as f:
+    FIXTURES = json.load(f)
+
+# Этапы, промпты которых получают сжатый текст с позициями и итогом (classify - только признаки ресторана)
+STAGES = ("positions", "total", "split")
+CASES = [pytest.param(fixture, stage, id=f"{fixture['name']}-{stage}") for fixture in FIXTURES for stage in STAGES]
+
+
+def has_price(line, price):
+    """В строке есть сумма, которая округляется до price (89.99 -> 90)."""
+    amounts = re.findall(r'\d+(?:[.,]\d{1,2})?', line)
+    return any(Decimal(amount.replace(',', '.')).quantize(Decimal(1), rounding=ROUND_HALF_UP) == price for amount in amounts)
+
+
+@pytest.mark.parametrize("fixture, stage", CASES)
+def test_total_is_kept(fixture, stage):
+    compacted = compact_for_stage(stage, fixture["text"])
+    raw_total = find_total(fixture["text"].splitlines())
+    compacted_total = find_total([line.strip() for line in compacted.splitlines()])
+    assert compacted_total == raw_total
+    assert compacted_total is not None and round(compacted_total) == fixture["expected_total"]
+
+
+@pytest.mark.parametrize("fixture, stage", CASES)
+def test_positions_are_kept(fixture, stage):
+    lines = compact_for_stage(stage, fixture["text"]).splitlines()
+    for item in fixture["expected_positions"]:
+        index = next((i for i, line in enumerate(lines) if item["name"] in line), None)
+        assert index is not None, f"position '{item['name']}' lost"
+        # Цена - в строке позиции или в следующей (фискальный формат "1.000 x 650.00 ≡650.00")
+        assert any(has_price(line, item["price"]) for line in lines[index:index + 2]), f"price of '{item['name']}' lost"